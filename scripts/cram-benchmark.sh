@@ -0,0 +1,121 @@
+#!/bin/bash
+
+set -euo pipefail
+
+function usage () {
+    echo " Usage: $(basename "$0") [opts]* REFERENCE.fa INPUTBAM+
+
+  Compare the size and decode throughput of bam and cram encodings of
+  the same reads. Each INPUTBAM is converted to cram against REFERENCE,
+  and both files are decoded with samtools view (all records), --repeat
+  times. Prints one tab-separated line per input and format:
+
+    INPUT FORMAT BYTES RATIO RECORDS SECONDS MB_PER_S RECORDS_PER_S
+
+  RATIO is the size relative to the bam. Timings are the best of the
+  repeats, with a warm page cache.
+
+  [opts] is one of:
+
+    --help         show this text
+    --samtools SAMTOOLSBIN  path to samtools binary
+    --threads N    decode/encode threads (default 4)
+    --repeat N     decode each file N times (default 3)
+    --workdir DIR  where the crams are written (default: a temp dir)
+"
+}
+
+samtools_cmd=${samtools_cmd:-samtools}
+num_threads=4
+repeat=3
+work_dir=""
+
+POSARGS=()
+while [[ "$#" -gt 0 ]]; do
+    arg="$1"
+    shift
+    case "$arg" in
+	--help|-h)
+	    usage
+	    exit 0
+	    ;;
+	--samtools)
+	    samtools_cmd="$1"
+	    shift
+	    ;;
+	--threads)
+	    num_threads="$1"
+	    shift
+	    ;;
+	--repeat)
+	    repeat="$1"
+	    shift
+	    ;;
+	--workdir)
+	    work_dir="$1"
+	    shift
+	    ;;
+	-*)
+	    echo "Invalid flag: $arg" >&2
+	    exit 1
+	    ;;
+	*)
+	    POSARGS+=("$arg")
+	    ;;
+    esac
+done
+
+if [[ "${#POSARGS[@]}" -lt 2 ]]; then
+    echo "missing reference and input bam files" >&2
+    usage >&2
+    exit 1
+fi
+
+reference="${POSARGS[0]}"
+unset POSARGS[0]
+
+if [[ -z "${work_dir}" ]]; then
+    work_dir=$(mktemp -d -t "cram-benchmark.XXXXXXXX")
+    trap 'rm --one-file-system -r "${work_dir}"' EXIT
+fi
+mkdir -p "${work_dir}"
+
+function best_decode_time ()
+{
+    # prints "RECORDS SECONDS" for the fastest of $repeat full decodes
+    local infile="$1"
+    local best="" records="" start end elapsed
+    for _ in $(seq "${repeat}"); do
+	start=$(date +%s.%N)
+	records=$(${samtools_cmd} view -c -@ "${num_threads}" --reference "${reference}" "${infile}")
+	end=$(date +%s.%N)
+	elapsed=$(echo "$end - $start" | bc -l)
+	if [[ -z "$best" ]] || (( $(echo "$elapsed < $best" | bc -l) )); then
+	    best="$elapsed"
+	fi
+    done
+    echo "$records $best"
+}
+
+function report ()
+{
+    # INPUT FORMAT FILE BAMBYTES
+    local input="$1" fmt="$2" infile="$3" bam_bytes="$4"
+    local bytes records seconds
+    bytes=$(stat -c %s "${infile}")
+    read -r records seconds < <(best_decode_time "${infile}")
+    printf "%s\t%s\t%d\t%.3f\t%d\t%.3f\t%.1f\t%.0f\n" \
+	   "$(basename "${input}")" "${fmt}" "${bytes}" "$(echo "$bytes / $bam_bytes" | bc -l)" \
+	   "${records}" "${seconds}" \
+	   "$(echo "$bytes / 1048576 / $seconds" | bc -l)" \
+	   "$(echo "$records / $seconds" | bc -l)"
+}
+
+printf "INPUT\tFORMAT\tBYTES\tRATIO\tRECORDS\tSECONDS\tMB_PER_S\tRECORDS_PER_S\n"
+for bam in "${POSARGS[@]}"; do
+    cram="${work_dir}/$(basename "${bam%.bam}").cram"
+    ${samtools_cmd} view -C -@ "${num_threads}" -T "${reference}" -o "${cram}" "${bam}"
+    bam_bytes=$(stat -c %s "${bam}")
+    report "${bam}" bam "${bam}" "${bam_bytes}"
+    report "${bam}" cram "${cram}" "${bam_bytes}"
+done
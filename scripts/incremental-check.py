@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+
+"""
+Check that adding samples to the cohort stores of --stage vcf --incremental
+gives the same joint calls as importing all of them at once.
+
+The stores are planned by variants.cohort.plan_stores, against a registry
+kept in memory, and the gvcfs given on the command line (bgzipped and
+indexed) stand in for the Genotype nodes of their samples:
+
+  1. all but the last --added gvcfs are planned: a GenomicsDBImport per shard
+  2. all the gvcfs are planned: a GenomicsDBUpdate of each store of 1
+  3. all the gvcfs are planned again: the stores of 2 are reused as they are
+
+The planned stores are built on local disk, and registered after each
+step. Each shard of the incremental stores, and of a scratch import of all
+the gvcfs, is genotyped with GenotypeGVCFs, and the calls are compared.
+
+Exits with status 1 if a plan isn't the expected one, or the calls differ.
+"""
+
+import os
+import os.path
+import sys
+import gzip
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOPDIR = os.path.join(HERE, "..")
+
+
+def gvcf_sample(path):
+    """the sample name of a single-sample gvcf"""
+    with gzip.open(path, "rt") as infd:
+        for line in infd:
+            if line.startswith("#CHROM"):
+                return line.rstrip("\n").split("\t")[9]
+    raise ValueError("%s has no #CHROM header" % (path,))
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as infd:
+        for block in iter(lambda: infd.read(4*1024*1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def fixture_kind():
+    """Transform of a gvcf on local disk, standing in for the Genotype node of its sample"""
+    import bunnies
+
+    class FixtureGvcf(bunnies.Transform):
+        __slots__ = ("sample_name", "path", "ref", "ref_idx")
+
+        def __init__(self, path, ref, ref_idx):
+            super().__init__("fixturegvcf", version="1", image=None)
+            self.sample_name = gvcf_sample(path)
+            self.path = os.path.abspath(path)
+            self.ref = ref
+            self.ref_idx = ref_idx
+            self.add_input("ref", ref, desc="reference fasta")
+            self.add_input("ref_idx", ref_idx, desc="reference index")
+            # the canonical id follows the contents of the gvcf
+            self.params['sample_name'] = self.sample_name
+            self.params['md5'] = file_md5(path)
+
+        def exists(self):
+            return True
+
+        def ls(self):
+            return {
+                'gvcf': {'url': self.path, 'size': os.stat(self.path).st_size},
+                'gvcf_idx': {'url': self.path + ".tbi", 'size': os.stat(self.path + ".tbi").st_size}
+            }
+
+    return FixtureGvcf
+
+
+class LocalStores(object):
+    """
+    cohort stores built on local disk, in workdir, with a registry kept in
+    memory instead of the repository
+    """
+    def __init__(self, workdir, reference, gatk="gatk"):
+        self.workdir = workdir
+        self.reference = reference
+        self.gatk = gatk
+        self.registries = {}
+
+    def install(self):
+        """point the registry and the stores of variants.cohort at this object"""
+        from variants import cohort
+        from variants.genomicsdb import GenomicsDBImport
+        from variants.genomicsdbupdate import GenomicsDBUpdate
+
+        cohort.registry_url = lambda node, name, shard: "%s/shard%04d.json" % (name, shard)
+        cohort.read_registry = lambda url: list(self.registries.get(url, []))
+        cohort.write_registry = lambda url, records: self.registries.__setitem__(url, list(records))
+        for kind in (GenomicsDBImport, GenomicsDBUpdate):
+            kind.exists = lambda store: os.path.isdir(self.workspace(store))
+            kind.output_prefix = lambda store, write_url=None: self.workspace(store)
+
+    def workspace(self, store):
+        return os.path.join(self.workdir, "stores", "%s.shard%04d-%s.genomicsdb" % (
+            store.name, store.shard, store.canonical_id))
+
+    def _run(self, args):
+        subprocess.run([self.gatk] + args + ["--tmp-dir", self.workdir], check=True)
+
+    def _sample_map(self, store, gvcfs):
+        path = self.workspace(store) + ".sample_map"
+        with open(path, "w") as map_fd:
+            for gvcf in gvcfs:
+                map_fd.write("%s\t%s\n" % (gvcf.sample_name, gvcf.path))
+        return path
+
+    def _bed(self, store):
+        from variants.intervals import write_bed
+        path = self.workspace(store) + ".bed"
+        write_bed(path, store.params['intervals'])
+        return path
+
+    def build(self, store):
+        """the workspace of store, built with its base first, like the jobs would"""
+        from variants.genomicsdbupdate import GenomicsDBUpdate
+        workspace = self.workspace(store)
+        if os.path.isdir(workspace):
+            return workspace
+        os.makedirs(os.path.dirname(workspace), exist_ok=True)
+        if isinstance(store, GenomicsDBUpdate):
+            shutil.copytree(self.build(store.base), workspace + ".tmp")
+            self._run(["GenomicsDBImport", "--genomicsdb-update-workspace-path", workspace + ".tmp",
+                       "--sample-name-map", self._sample_map(store, store.gvcfs)])
+        else:
+            self._run(["GenomicsDBImport", "--genomicsdb-workspace-path", workspace + ".tmp",
+                       "--sample-name-map", self._sample_map(store, store.gvcfs),
+                       "-L", self._bed(store), "--merge-input-intervals"])
+        os.rename(workspace + ".tmp", workspace)
+        return workspace
+
+    def genotype(self, store, out):
+        """joint calls of a store, as JointGenotype makes them"""
+        self._run(["GenotypeGVCFs", "-R", self.reference, "-V", "gendb://" + self.build(store),
+                   "-L", self._bed(store), "--only-output-calls-starting-in-intervals", "-O", out])
+        return out
+
+
+def check_plan(label, stores, expected):
+    """problems of the stores planned in a step. expected=[(kind, cid of base or None, samples added)]"""
+    problems = []
+    for store, (kind, base_cid, added) in zip(stores, expected):
+        planned = (type(store).__name__, store.base.canonical_id if hasattr(store, "base") else None,
+                   [gvcf.sample_name for gvcf in store.gvcfs])
+        if planned != (kind, base_cid, added):
+            problems.append("%s, shard %d: planned %s, expected %s" % (
+                label, store.shard, planned, (kind, base_cid, added)))
+    if len(stores) != len(expected):
+        problems.append("%s: planned %d stores, expected %d" % (label, len(stores), len(expected)))
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("reference", metavar="REFERENCE.fa", help="indexed reference of the gvcfs")
+    parser.add_argument("intervals", metavar="INTERVALS.bed", help="intervals of the cohort")
+    parser.add_argument("gvcfs", metavar="GVCF", nargs="+", help="bgzipped and indexed gvcfs, one per sample")
+    parser.add_argument("--added", metavar="N", type=int, default=1,
+                        help="gvcfs added to the stores in the second step (default: %(default)s)")
+    parser.add_argument("--shards", metavar="N", type=int, default=2,
+                        help="shards the intervals are split in (default: %(default)s)")
+    parser.add_argument("--gatk", metavar="GATKBIN", default="gatk", help="path to gatk")
+    parser.add_argument("--workdir", metavar="DIR", default=None,
+                        help="where the workspaces and vcfs are written (default: a temp dir)")
+    args = parser.parse_args()
+
+    if not 0 < args.added < len(args.gvcfs):
+        parser.error("--added must leave 1 or more gvcfs for the first step")
+
+    sys.path.insert(0, TOPDIR)
+    from variants import InputFile, setup_logging
+    from variants.cohort import plan_stores, register_stores, compare_vcfs
+    from variants.genomicsdb import GenomicsDBImport
+    from variants.intervals import read_bed, split_intervals
+    setup_logging()
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="incremental-check.")
+    os.makedirs(workdir, exist_ok=True)
+    local = LocalStores(os.path.abspath(workdir), os.path.abspath(args.reference), gatk=args.gatk)
+    local.install()
+
+    ref = InputFile(os.path.abspath(args.reference), desc="reference fasta")
+    ref_idx = InputFile(os.path.abspath(args.reference) + ".fai", desc="reference index")
+    FixtureGvcf = fixture_kind()
+    gvcfs = [FixtureGvcf(path, ref, ref_idx) for path in args.gvcfs]
+    base, added = gvcfs[:-args.added], gvcfs[-args.added:]
+    shards = split_intervals(read_bed(args.intervals), args.shards)
+    cohort = "incremental"
+
+    problems = []
+
+    def _step(label, step_gvcfs, expected):
+        stores = plan_stores(cohort, step_gvcfs, shards)
+        problems.extend(check_plan(label, stores, expected(stores)))
+        for store in stores:
+            local.build(store)
+        register_stores(stores)
+        return stores
+
+    first = _step("import", base, lambda stores: [
+        ("GenomicsDBImport", None, [gvcf.sample_name for gvcf in base])] * len(shards))
+    second = _step("update", gvcfs, lambda stores: [
+        ("GenomicsDBUpdate", store.canonical_id, [gvcf.sample_name for gvcf in added]) for store in first])
+    third = plan_stores(cohort, gvcfs, shards)
+    if [store.canonical_id for store in third] != [store.canonical_id for store in second]:
+        problems.append("reuse: the stores of the update were planned again")
+
+    for shard_i, (store, intervals) in enumerate(zip(second, shards)):
+        scratch = GenomicsDBImport(cohort, gvcfs, intervals=intervals, shard=shard_i)
+        scratch_vcf = local.genotype(scratch, os.path.join(local.workdir, "scratch.shard%04d.vcf.gz" % (shard_i,)))
+        incremental_vcf = local.genotype(store, os.path.join(local.workdir,
+                                                             "incremental.shard%04d.vcf.gz" % (shard_i,)))
+        diffs, num_sites = compare_vcfs(scratch_vcf, incremental_vcf)
+        print("# shard %d: %d sites, %d differences" % (shard_i, num_sites, len(diffs)))
+        problems.extend("shard %d: %s" % (shard_i, diff) for diff in diffs)
+
+    for problem in problems:
+        print(problem)
+    if not args.workdir:
+        shutil.rmtree(workdir)
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
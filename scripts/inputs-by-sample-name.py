@@ -4,6 +4,8 @@ import argparse
 import os.path
 import json
 import re
+import hashlib
+import tempfile
 from collections import OrderedDict
 
 """Preprocessing script for the variants main file.
@@ -16,6 +18,12 @@ the input is a tsv whose first column contains the name of a sample.
 the output (STDOUT), will have the URLs for the files to use, as well as
 some species information.
 
+With --output, the manifest is written to a file instead, and updated
+incrementally: entries of samples whose sample name row, sequence
+sources and species records are unchanged since the last run are
+copied over from the previous manifest as-is. A fingerprint of those
+records is kept next to the manifest, in MANIFEST.state.json. The new
+manifest replaces the old one atomically.
 """
 
 topdir = os.path.dirname(__file__) + "/.."
@@ -35,7 +43,11 @@ def species_db():
     return by_name
 
 
-def sources_db():
+def sources_db(rows=None):
+    """
+    parse the sequence sources table, grouped by sample and run. if rows is
+    a dict, the raw lines of each sample are also collected in rows[samplename].
+    """
     by_sample = OrderedDict()
 
     is_header = True
@@ -60,6 +72,9 @@ def sources_db():
             samplename, src_type, src_project, src_samplename, src_run, src_url = toks[0:6]
             extra = toks[6:] if len(toks) > 6 else []
 
+            if rows is not None:
+                rows.setdefault(samplename, []).append(line)
+
             item = {
                 'samplename': samplename,
                 'runid': src_run,
@@ -98,10 +113,94 @@ def sources_db():
     return by_sample
 
 
+def sample_fingerprint(name_row, source_rows, species_record):
+    """digest of all the input records that determine the entries of a sample"""
+    doc = json.dumps([name_row, source_rows, species_record], sort_keys=True)
+    return hashlib.sha1(doc.encode("utf-8")).hexdigest()
+
+
+def sample_entries(samplename, runs, sample_meta):
+    for runid, run in runs.items():
+        yield {
+            'sample_name': samplename,
+            'species': sample_meta.get('species', None),
+            'species_abbr': sample_meta.get('species_abbr', None),
+            'runid': runid,
+            'r1': run['r1'],
+            'r2': run['r2']
+        }
+
+
+def load_manifest(path):
+    """
+    read a previous manifest. returns the lines of each sample, in order.
+    """
+    by_sample = OrderedDict()
+    if not os.path.exists(path):
+        return by_sample
+    with open(path, "r") as infd:
+        for line in infd:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            entry = json.loads(line)
+            by_sample.setdefault(entry['sample_name'], []).append(line)
+    return by_sample
+
+
+def manifest_diff(old_lines, new_lines):
+    """
+    compare two manifests, by run. both are dicts of samplename => [lines]
+    """
+    def _by_run(by_sample):
+        runs = OrderedDict()
+        for lines in by_sample.values():
+            for line in lines:
+                entry = json.loads(line)
+                runs[(entry['sample_name'], entry['runid'])] = entry
+        return runs
+
+    old_runs, new_runs = _by_run(old_lines), _by_run(new_lines)
+    diff = {'added': [], 'removed': [], 'changed': []}
+    for key, entry in new_runs.items():
+        if key not in old_runs:
+            diff['added'].append({'sample_name': key[0], 'runid': key[1]})
+        elif old_runs[key] != entry:
+            fields = sorted(field for field in set(entry) | set(old_runs[key])
+                            if entry.get(field) != old_runs[key].get(field))
+            diff['changed'].append({'sample_name': key[0], 'runid': key[1], 'fields': fields})
+    for key in old_runs:
+        if key not in new_runs:
+            diff['removed'].append({'sample_name': key[0], 'runid': key[1]})
+    return diff
+
+
+def write_atomic(path, text):
+    """replace the file at path with text. readers see either the old or the new file."""
+    dirname = os.path.dirname(os.path.abspath(path))
+    with tempfile.NamedTemporaryFile(mode="w", dir=dirname, prefix="." + os.path.basename(path) + ".",
+                                     suffix=".tmp", delete=False) as tmpfd:
+        try:
+            tmpfd.write(text)
+            tmpfd.flush()
+            os.fsync(tmpfd.fileno())
+        except BaseException:
+            os.unlink(tmpfd.name)
+            raise
+    os.replace(tmpfd.name, path)
+
+
 def main():
     parser = argparse.ArgumentParser(description=__doc__)
     parser.add_argument("source", metavar="SOURCE", type=str, default="-",
                         help="path to samplenames")
+    parser.add_argument("--output", metavar="MANIFEST", type=str, default=None,
+                        help="write (or incrementally update) this manifest instead of printing to stdout")
+    parser.add_argument("--diff", metavar="DIFFJSON", type=str, default=None,
+                        help="write the runs added, removed and changed relative to the previous "
+                             "--output manifest to this file (- for stdout)")
+    parser.add_argument("--full", action="store_true", default=False,
+                        help="ignore the saved fingerprints and regenerate every entry")
 
     args = parser.parse_args()
 
@@ -111,12 +210,22 @@ def main():
     else:
         infd = open(args.source, "r")
 
-    sources = sources_db()
+    source_rows = {}
+    sources = sources_db(rows=source_rows)
     species = species_db()
-    outfd = sys.stdout
+
+    state_path = args.output + ".state.json" if args.output else None
+    previous_lines = load_manifest(args.output) if args.output else OrderedDict()
+    previous_prints = {}
+    if state_path and os.path.exists(state_path) and not args.full:
+        with open(state_path, "r") as statefd:
+            previous_prints = json.load(statefd).get('samples', {})
 
     sample_errors = {}
     seen_names = {}
+    manifest_lines = OrderedDict()
+    fingerprints = {}
+    num_reused = 0
     for lineno, line in enumerate(infd):
         line = line.strip()
         if not line or line.startswith("#"):
@@ -142,16 +251,33 @@ def main():
 
         sample_meta = species.get(samplename, {})
 
-        for runid, run in runs.items():
-            entry = {
-                'sample_name': samplename,
-                'species': sample_meta.get('species', None),
-                'species_abbr': sample_meta.get('species_abbr', None),
-                'runid': runid,
-                'r1': run['r1'],
-                'r2': run['r2']
-            }
-            outfd.write(json.dumps(entry, sort_keys=True)+"\n")
+        fingerprint = sample_fingerprint(toks, source_rows[samplename], sample_meta)
+        fingerprints[samplename] = fingerprint
+        if previous_prints.get(samplename) == fingerprint and samplename in previous_lines:
+            manifest_lines[samplename] = previous_lines[samplename]
+            num_reused += 1
+            continue
+
+        manifest_lines[samplename] = [json.dumps(entry, sort_keys=True)
+                                      for entry in sample_entries(samplename, runs, sample_meta)]
+
+    text = "".join(line + "\n" for lines in manifest_lines.values() for line in lines)
+    if args.output:
+        write_atomic(args.output, text)
+        write_atomic(state_path, json.dumps({'samples': fingerprints}, indent=1, sort_keys=True) + "\n")
+        sys.stderr.write("%d samples reused, %d regenerated.\n" % (num_reused, len(manifest_lines) - num_reused))
+    else:
+        sys.stdout.write(text)
+
+    if args.diff:
+        diff = manifest_diff(previous_lines, manifest_lines)
+        diff_text = json.dumps(diff, indent=1, sort_keys=True) + "\n"
+        if args.diff == "-":
+            sys.stdout.write(diff_text)
+        else:
+            write_atomic(args.diff, diff_text)
+        sys.stderr.write("runs: %d added, %d removed, %d changed.\n" % (
+            len(diff['added']), len(diff['removed']), len(diff['changed'])))
 
     if sample_errors:
         sys.stderr.write("%d samples generated errors.\n" % (len(sample_errors),))
@@ -13,6 +13,10 @@ function usage () {
   If a single input bam is provided, the output bam will be a symlink
   to the single input file.
 
+  Inputs and output may also be CRAM files (.cram, with .crai indexes).
+  The output format follows the extension of OUTPUTBAM. CRAMs require
+  --reference.
+
   [opts] is one of:
 
     --help         show this text
@@ -22,8 +26,13 @@ function usage () {
     --delete-old   delete input bam files after a merge is successful
                    (default is to keep them)
 
+    --no-md5       don't write OUTPUTBAM.md5. for callers which checksum
+                   the output as they upload it.
+
     --samplename   NAME name to use in the manifest and headers
 
+    --reference FASTA  reference the CRAM inputs/output are encoded against
+
     --samtools SAMTOOLSBIN  path to samtools binary
     --sambamba SAMBIN  path to sambamba binary
     --picard   PICARDBIN path to picard jar file (gatk)
@@ -38,6 +47,7 @@ sambamba_cmd=${sambamba_cmd:-/usr/local/bin/sambamba_v0.6.6}
 samtools_cmd=${samtools_cmd:-/usr/bin/samtools}
 picard_bin=${picard_bin:-/gatk/gatk.jar}
 max_heap_mb=""
+reference=""
 
 # all files merged so far
 #
@@ -54,8 +64,27 @@ tmp_bam_dir="scratch/tmp"
 
 DRY_RUN=0
 DELETE_OLD=0
+WRITE_MD5=1
 TARGET_SAMPLE=""
 
+function index_of ()
+{
+    # name of the index samtools writes for an alignment file
+    case "$1" in
+	*.cram) echo "$1.crai" ;;
+	*) echo "$1.bai" ;;
+    esac
+}
+
+function count_reads ()
+{
+    # sambamba doesn't read crams
+    case "$1" in
+	*.cram) ${samtools_cmd} view -c -@ "${num_threads}" --reference "${reference}" "$1" ;;
+	*) $sambamba_cmd view -t "${num_threads}" -c "$1" ;;
+    esac
+}
+
 function update_read_groups ()
 {
     # SAMPLENAME INPLACEBAM
@@ -69,11 +98,11 @@ function update_read_groups ()
 		     sed "s/\\bSM:[^\\t]*/SM:${sname}/g" | \
 		     ${samtools_cmd} reheader - "$inbam" > "$inbam".tmp )
 	mv "$inbam".tmp "$inbam" # overwrite
-	rm "$inbam".bai || :
+	rm "$(index_of "$inbam")" || :
 	time ${samtools_cmd} index "${inbam}"
     else
 	echo "Readgroups match $sname already."
-	if [[ ! -e "${inbam}.bai" ]]; then
+	if [[ ! -e "$(index_of "$inbam")" ]]; then
 	    time ${samtools_cmd} index "${inbam}"
 	fi
     fi
@@ -111,6 +140,9 @@ while [[ "$#" -gt 0 ]]; do
 	--delete-old)
 	    DELETE_OLD=1
 	    ;;
+	--no-md5)
+	    WRITE_MD5=0
+	    ;;
 	--tmpdir)
 	    tmp_bam_dir="$1"
 	    shift;
@@ -123,6 +155,10 @@ while [[ "$#" -gt 0 ]]; do
 	    max_heap_mb="$1"
 	    shift;
 	    ;;
+	--reference)
+	    reference="$1"
+	    shift;
+	    ;;
 	-*)
 	    echo "Invalid flag: $arg" >&2
 	    exit 1
@@ -152,10 +188,10 @@ target_bai=( )
 
 for posarg in "${POSARGS[@]}"; do
     case "$posarg" in
-	*.bai|*.bai.*)
+	*.bai|*.bai.*|*.crai|*.crai.*)
 	    target_bai+=("$posarg")
 	    ;;
-	*.bam|*.bam.*)
+	*.bam|*.bam.*|*.cram|*.cram.*)
 	    target_bam+=("$posarg")
 	    ;;
 	*)
@@ -165,6 +201,27 @@ for posarg in "${POSARGS[@]}"; do
     esac
 done
 
+case "$outputbam" in
+    *.cram) idx_ext=".crai" ;;
+    *) idx_ext=".bai" ;;
+esac
+
+uses_cram=0
+for bam in "${outputbam}" "${target_bam[@]}"; do
+    if [[ "$bam" == *.cram ]]; then
+	uses_cram=1
+    fi
+done
+
+ref_opts=( )
+if [[ "${uses_cram}" -eq 1 ]]; then
+    if [[ -z "${reference}" ]]; then
+	echo "--reference is required to read or write crams" >&2
+	exit 1
+    fi
+    ref_opts=( --reference "${reference}" )
+fi
+
 new_bam_dir="$(dirname "${outputbam}")"
 (
     echo "output file placed in directory ${new_bam_dir}"
@@ -207,7 +264,12 @@ fi
 
 mkdir -p "${tmp_bam_dir}"
 final_name="$(basename "${outputbam}")"
+stats_name="${final_name%.*}.bamstats.txt"
 work_dir=$(mktemp -d -p "${tmp_bam_dir}" "tmp.lane_merger.${final_name}.XXXXXXXX")
+final_files=( "${work_dir}/${final_name}" "${work_dir}/${final_name}${idx_ext}" "${work_dir}/${stats_name}" )
+if [[ "${WRITE_MD5}" -eq 1 ]]; then
+    final_files+=( "${work_dir}/${final_name}.md5" )
+fi
 
 # clean workdir on exit (success or not)
 trap 'rm --one-file-system -r "${work_dir}"' EXIT
@@ -218,21 +280,27 @@ function markdup ()
     local outfile="$2"
     local tmpdir="$3"
     local java_opts=( -DGATK_STACKTRACE_ON_USER_EXCEPTION=true )
+    local picard_ref=( )
 
     if [[ -n "${max_heap_mb}" ]]; then
 	java_opts+=("-Xmx${max_heap_mb}m")
     fi
 
+    if [[ -n "${reference}" ]]; then
+	picard_ref=( -R="${reference}" )
+    fi
+
     # sambamba markdup doesn't work on Ha412 because reference has too
     # many contigs.
 
     java "${java_opts[@]}" -jar "${picard_bin}" MarkDuplicates \
 	 -I="$infile" \
 	 -O="$outfile" \
-	 -M="${outfile%%.bam}.dupmetrics.txt" \
+	 -M="${outfile%.*}.dupmetrics.txt" \
 	 --TMP_DIR="$tmpdir" \
+	 ${picard_ref[@]+"${picard_ref[@]}"} \
 	 --VALIDATION_STRINGENCY=LENIENT \
-	 --CREATE_MD5_FILE=TRUE
+	 --CREATE_MD5_FILE="$( [[ "${WRITE_MD5}" -eq 1 ]] && echo TRUE || echo FALSE )"
 
     find "$(dirname "$outfile")"
 }
@@ -241,11 +309,15 @@ if [[ "${#target_bam[@]}" -gt 1 ]]; then
     (
 	set -x
 	ls -lh -- "${target_bam[@]}" || :
-	${sambamba_cmd} merge -t "${num_threads}" "${work_dir}/__merged__.bam" "${target_bam[@]}"
+	if [[ "${uses_cram}" -eq 1 ]]; then
+	    ${samtools_cmd} merge -@ "${num_threads}" "${ref_opts[@]}" "${work_dir}/__merged__.bam" "${target_bam[@]}"
+	else
+	    ${sambamba_cmd} merge -t "${num_threads}" "${work_dir}/__merged__.bam" "${target_bam[@]}"
+	fi
 	markdup "${work_dir}/__merged__.bam" "${work_dir}/${final_name}" "${work_dir}"
-	cat "${work_dir}/${final_name}".md5
+	cat "${work_dir}/${final_name}".md5 2>/dev/null || :
 	update_read_groups "${TARGET_SAMPLE}" "${work_dir}/${final_name}"
-	${samtools_cmd} stats -d "${work_dir}/${final_name}" > "${work_dir}/${final_name}"stats.txt
+	${samtools_cmd} stats -d ${ref_opts[@]+"${ref_opts[@]}"} "${work_dir}/${final_name}" > "${work_dir}/${stats_name}"
     )
 
     echo "Files created in temp folder:"
@@ -253,13 +325,13 @@ if [[ "${#target_bam[@]}" -gt 1 ]]; then
 
     echo "Checking new bam to see if read sums match"
     #Now count reads to make sure it matches up.
-    new_sum=$($sambamba_cmd view -t "${num_threads}" -c "${work_dir}/${final_name}")
+    new_sum=$(count_reads "${work_dir}/${final_name}")
     echo "New bam has $new_sum reads"
 
     (
 	old_sum=""
 	for i in "${target_bam[@]}"; do
-	    tmp_sum=$(set -x; $sambamba_cmd view -t "${num_threads}" -c "${i}")
+	    tmp_sum=$(set -x; count_reads "${i}")
 	    echo "$i has $tmp_sum reads"
 	    old_sum=$((tmp_sum + old_sum))
 	    echo "Running sum of old reads is $old_sum"
@@ -271,14 +343,14 @@ if [[ "${#target_bam[@]}" -gt 1 ]]; then
 		echo "Read sums match"
 		echo "Moving final file in place"
 		mv -v -- \
-		   "${work_dir}/${final_name}"{,.bai,.md5,stats.txt} \
-		   "${work_dir}/${final_name%%.bam}".dupmetrics.txt \
+		   "${final_files[@]}" \
+		   "${work_dir}/${final_name%.*}".dupmetrics.txt \
 		   "${new_bam_dir}"/
 
 		if [[ "${DELETE_OLD}" -eq 1 ]]; then
 		    echo "Read sums match. Deleting old files"
 		    for i in "${target_bam[@]}"; do
-			rm -f -v --one-file-system -- "$i"{,.bai}
+			rm -f -v --one-file-system -- "$i"{,.bai,.crai}
 		    done
 		fi
 	    else
@@ -293,15 +365,30 @@ else
 	echo "merging one file (trivial)..."
 	ABSBAM="$(readlink -f -- "${target_bam[0]}")"
 	ABSBAI="$(readlink -f -- "${target_bai[0]}")"
-	echo "using symlink."
-	ln -sfT "$ABSBAM" "${work_dir}/${final_name}"
-	ln -sfT "$ABSBAI" "${work_dir}/${final_name}".bai
+	if [[ "${ABSBAM##*.}" == "${final_name##*.}" ]]; then
+	    echo "using symlink."
+	    ln -sfT "$ABSBAM" "${work_dir}/${final_name}"
+	    ln -sfT "$ABSBAI" "${work_dir}/${final_name}${idx_ext}"
+	else
+	    echo "converting ${ABSBAM##*.} to ${final_name##*.}."
+	    fmt_opt="-b"
+	    if [[ "${final_name}" == *.cram ]]; then
+		fmt_opt="-C"
+	    fi
+	    time ${samtools_cmd} view "${fmt_opt}" -@ "${num_threads}" "${ref_opts[@]}" \
+		 -o "${work_dir}/${final_name}" "$ABSBAM"
+	    if [[ "${DELETE_OLD}" -eq 1 ]]; then
+		rm -f -v --one-file-system -- "$ABSBAM" "$ABSBAI"
+	    fi
+	fi
 
 	update_read_groups "${TARGET_SAMPLE}" "${work_dir}/${final_name}"
-	(cd "${work_dir}" && time md5sum "${final_name}" > "${final_name}".md5; )
-	time ${samtools_cmd} stats -d "${work_dir}/${final_name}" > "${work_dir}/${final_name}stats.txt"
+	if [[ "${WRITE_MD5}" -eq 1 ]]; then
+	    (cd "${work_dir}" && time md5sum "${final_name}" > "${final_name}".md5; )
+	fi
+	time ${samtools_cmd} stats -d ${ref_opts[@]+"${ref_opts[@]}"} "${work_dir}/${final_name}" > "${work_dir}/${stats_name}"
 
-	for final_file in "${work_dir}/${final_name}"{,.bai,.md5,stats.txt}; do
+	for final_file in "${final_files[@]}"; do
 	    if [[ -f "${final_file}" || "${DELETE_OLD}" -eq 1 ]]; then
 		real_file="$(readlink -f -- "${final_file}")"
 		mv -- "${real_file}" "${new_bam_dir}/$(basename "${final_file}")"
@@ -311,10 +398,10 @@ else
 	done
 
 	: show output files
-	for final_file in "${work_dir}/${final_name}"{,.bai,.md5,stats.txt}; do
+	for final_file in "${final_files[@]}"; do
 	    ls -lh -- "${new_bam_dir}/$(basename "${final_file}")" || :
 	done
     )
 fi
 
-echo "Completed merging ($outputbam $outputbam.bai)"
+echo "Completed merging ($outputbam $outputbam${idx_ext})"
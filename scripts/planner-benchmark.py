@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""
+Measure the time and peak memory of planning large cohorts. For each
+--runs count, a synthetic samples file is generated, and a fresh
+interpreter reads it, builds the pipeline graph against the selected
+references and (with --pipeline) hands the targets to bunnies. Nothing
+is submitted, and no remote file is looked up.
+
+Exits with status 1 if a size goes over --max-memory-gb.
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import random
+import resource
+import argparse
+import tempfile
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOPDIR = os.path.join(HERE, "..")
+
+DEFAULT_RUNS = (10000, 100000, 1000000)
+
+
+def write_samples(path, num_runs, runs_per_sample=3, sra_fraction=0.2, seed=0):
+    """synthetic samples file with num_runs runs"""
+    rng = random.Random(seed)
+    with open(path, "w") as outfd:
+        for runi in range(num_runs):
+            sample_name = "S%07d" % (runi // runs_per_sample,)
+            if rng.random() < sra_fraction:
+                runid = "SRR%08d" % (runi,)
+                r1 = ["s3://bench-fastq/sra/%s.sra" % (runid,), {"md5": "%032x" % rng.getrandbits(128)}]
+                r2 = None
+            else:
+                runid = "RUN%08d" % (runi,)
+                r1 = ["s3://bench-fastq/%s_R1.fastq.gz" % (runid,), {"md5": "%032x" % rng.getrandbits(128)}]
+                r2 = ["s3://bench-fastq/%s_R2.fastq.gz" % (runid,), {"md5": "%032x" % rng.getrandbits(128)}]
+            outfd.write(json.dumps({"r1": r1, "r2": r2, "runid": runid, "sample_name": sample_name}) + "\n")
+
+
+def _peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+def plan_samples(path, refnames, pipeline=False):
+    """runs in the child. returns [(phase, seconds, peak rss mb)]"""
+    sys.path.insert(0, TOPDIR)
+    from variants.graph import read_runs, build_graph
+    from variants.references import get_reference
+
+    phases = []
+    start = time.time()
+    with open(path, "r") as infd:
+        runs = read_runs(infd)
+    phases.append(("read", time.time() - start, _peak_rss_mb()))
+
+    start = time.time()
+    graph = build_graph(runs, {name: get_reference(name) for name in refnames})
+    phases.append(("graph", time.time() - start, _peak_rss_mb()))
+
+    if pipeline:
+        import bunnies
+        start = time.time()
+        bunnies.build_pipeline(graph.gvcfs)
+        phases.append(("pipeline", time.time() - start, _peak_rss_mb()))
+    return phases
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", metavar="N", type=int, action="append", default=[],
+                        help="number of runs of a synthetic cohort. repeat for several sizes"
+                             " (default: %s)" % (", ".join(str(n) for n in DEFAULT_RUNS),))
+    parser.add_argument("--reference", metavar="REFNAME", dest="references", action="append", default=[],
+                        help="reference to align against. repeat for several (default: ha412)")
+    parser.add_argument("--runs-per-sample", metavar="N", type=int, default=3, dest="runs_per_sample",
+                        help="runs of each synthetic sample (default: %(default)s)")
+    parser.add_argument("--pipeline", action="store_true", default=False,
+                        help="also time bunnies.build_pipeline over the genotype targets")
+    parser.add_argument("--max-memory-gb", metavar="GB", type=float, default=16.0, dest="max_memory_gb",
+                        help="fail if the peak memory of a size exceeds this (default: %(default)s)")
+    parser.add_argument("--child", metavar="SAMPLESJSON", default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    refnames = args.references or ["ha412"]
+    if args.child:
+        json.dump(plan_samples(args.child, refnames, pipeline=args.pipeline), sys.stdout)
+        return 0
+
+    failures = 0
+    print("\t".join(["RUNS", "REFS", "PHASE", "SECONDS", "PEAK_RSS_MB", "STATUS"]))
+    for num_runs in args.runs or DEFAULT_RUNS:
+        with tempfile.NamedTemporaryFile(suffix=".json") as samples_fd:
+            write_samples(samples_fd.name, num_runs, runs_per_sample=args.runs_per_sample)
+            cmd = [sys.executable, os.path.abspath(__file__), "--child", samples_fd.name,
+                   "--runs-per-sample", str(args.runs_per_sample)]
+            cmd += ["--pipeline"] if args.pipeline else []
+            for refname in refnames:
+                cmd += ["--reference", refname]
+            proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            if proc.returncode != 0:
+                raise Exception("planning %d runs failed with code %d:\n%s" % (
+                    num_runs, proc.returncode, proc.stderr.decode("utf-8")[-2000:]))
+        phases = json.loads(proc.stdout.decode("utf-8"))
+        for phase, seconds, peak_rss_mb in phases:
+            status = "ok"
+            if peak_rss_mb > args.max_memory_gb * 1024:
+                status = "over memory budget"
+                failures += 1
+            print("\t".join([str(num_runs), str(len(refnames)), phase, "%.2f" % seconds,
+                             "%.0f" % peak_rss_mb, status]))
+            sys.stdout.flush()
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+"""
+Measure the startup time of python -m variants commands which don't build
+anything, and check that they stay within a budget. Each command is run
+--repeat times in a fresh interpreter; the best wall time is compared to
+the budget. Commands must also not import any of the --forbid modules.
+
+Exits with status 1 if a command is over budget or imports a forbidden module.
+"""
+
+import os
+import os.path
+import sys
+import time
+import argparse
+import subprocess
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOPDIR = os.path.join(HERE, "..")
+
+COMMANDS = (
+    ["--help"],
+    ["report", "--help"],
+    ["qc", "--help"],
+    ["extract", "--help"],
+    ["simulate", "--help"],
+    ["vcf-compare", "--help"],
+    ["gvcf-stats", "--help"],
+    ["monitor", "--help"],
+)
+
+FORBIDDEN = ("bunnies", "boto3", "botocore")
+
+
+def imported_modules(importtime_log):
+    """top-level package names from the output of python -X importtime"""
+    names = set()
+    for line in importtime_log.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        name = line.rsplit("|", 1)[1].strip()
+        if name and not name.startswith("["):
+            names.add(name.split(".")[0])
+    return names
+
+
+def run_command(args, env):
+    cmd = [sys.executable, "-X", "importtime", "-m", "variants"] + args
+    start = time.time()
+    proc = subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env, cwd=TOPDIR)
+    elapsed = time.time() - start
+    if proc.returncode != 0:
+        raise Exception("%s failed with code %d:\n%s" % (
+            " ".join(cmd), proc.returncode, proc.stderr.decode("utf-8")[-2000:]))
+    return elapsed, imported_modules(proc.stderr.decode("utf-8"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--budget", metavar="SECONDS", type=float, default=0.5,
+                        help="maximum startup time of each command (default: %(default)s)")
+    parser.add_argument("--repeat", metavar="N", type=int, default=5,
+                        help="runs of each command (default: %(default)s)")
+    parser.add_argument("--forbid", metavar="MODULE", action="append", default=None,
+                        help="module which must not be imported (default: %s)" % (", ".join(FORBIDDEN),))
+    args = parser.parse_args()
+
+    forbidden = set(args.forbid or FORBIDDEN)
+    env = dict(os.environ)
+    env["PYTHONPATH"] = TOPDIR + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+
+    failures = 0
+    print("\t".join(["COMMAND", "BEST_S", "MEDIAN_S", "STATUS"]))
+    for command in COMMANDS:
+        timings = []
+        modules = set()
+        for _ in range(args.repeat):
+            elapsed, imported = run_command(command, env)
+            timings.append(elapsed)
+            modules |= imported
+        timings.sort()
+        status = []
+        if timings[0] > args.budget:
+            status.append("over budget")
+        if modules & forbidden:
+            status.append("imports " + ",".join(sorted(modules & forbidden)))
+        failures += bool(status)
+        print("\t".join(["variants " + " ".join(command), "%.3f" % timings[0],
+                         "%.3f" % timings[len(timings) // 2], "; ".join(status) or "ok"]))
+
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,15 +1,35 @@
 # -*- charset: utf-8; -*-
 
-import bunnies
 import sys
+import types
 import logging
-
-from .align import Align
-from .merge import Merge
-from .genotype import Genotype
+import importlib
 
 log = logging.getLogger(__package__)
 
+# transforms are imported on first use, so that commands which don't build
+# anything (reports, --help) don't pay for importing bunnies and boto3.
+TRANSFORMS = {
+    "Align": ".align",
+    "AlignChunk": ".alignchunk",
+    "SplitReads": ".splitreads",
+    "MultiAlign": ".multialign",
+    "Merge": ".merge",
+    "Genotype": ".genotype",
+    "Depth": ".depth",
+    "GenomicsDBImport": ".genomicsdb",
+    "GenomicsDBUpdate": ".genomicsdbupdate",
+    "JointGenotype": ".jointgenotype",
+    "GatherVcfs": ".gathervcfs",
+    "Pack": ".packing",
+}
+
+
+def register_kinds():
+    """import all transforms, which registers their kinds for unmarshalling"""
+    for name in TRANSFORMS:
+        getattr(sys.modules[__name__], name)
+
 
 def setup_logging(loglevel=logging.INFO):
     """configure custom logging for the platform"""
@@ -26,7 +46,24 @@ def InputFile(url, desc="", digests=None):
     """
     Factory method to wrap various file URL forms into a Bunnies file
     """
+    import bunnies
     if url.startswith("s3://"):
         return bunnies.S3Blob(url, desc=desc, digests=digests)
     else:
         return bunnies.ExternalFile(url, desc=desc, digests=digests)
+
+
+class _Package(types.ModuleType):
+    # module-level __getattr__ only exists from python 3.7
+    def __getattr__(self, name):
+        if name not in TRANSFORMS:
+            raise AttributeError("module %r has no attribute %r" % (__name__, name))
+        value = getattr(importlib.import_module(TRANSFORMS[name], __name__), name)
+        setattr(self, name, value)
+        return value
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(TRANSFORMS))
+
+
+sys.modules[__name__].__class__ = _Package
@@ -5,68 +5,44 @@
 Perform variant calling on input samples
 """
 
-# framework
-import bunnies
-import bunnies.runtime
+# the framework (bunnies, boto3) and the transforms are imported in main(),
+# once the arguments are parsed. subcommands and --help don't need them.
 import os
 import os.path
 import logging
 import sys
 import argparse
-import json
-from collections import namedtuple
+import importlib
 
-# experiment specific
-from . import InputFile, Align, Merge, Genotype, setup_logging
+from . import setup_logging
+from .references import SUPPORTED_REFERENCES
+from .constants import OUTPUT_FORMATS
 
 log = logging.getLogger(__package__)
 
-HERE = os.path.dirname(__file__)
-TOPDIR = os.path.join(HERE, "..")
-bunnies.runtime.add_user_deps(TOPDIR, "variants", excludes=("__pycache__"))
-bunnies.runtime.add_user_deps(TOPDIR, "scripts")
-bunnies.runtime.add_user_hook("import variants")
-bunnies.runtime.add_user_hook("variants.setup_logging()")
-
-Reference = namedtuple("Reference", ["name", "ref", "ref_idx"])
-
-
-def get_reference(shortname):
-    shortname = shortname.lower()
-    if shortname in get_reference.cache:
-        return get_reference.cache[shortname]
-
-    if shortname in ("ha412",):
-        ref     = InputFile("s3://ubc-sunflower-genome/references/HA412/genome/Ha412HOv2.0-20181130.fasta",
-                            desc="Ha412HO genome reference (.fasta)")
-        ref_idx = InputFile("s3://ubc-sunflower-genome/references/HA412/genome/Ha412HOv2.0-20181130.fasta.fai",
-                            desc="Ha412HO genome reference index")
-    elif shortname in ("xrqv2",):
-        ref = InputFile("s3://rieseberg-references/HanXRQ2.0-20180814/annotated/HanXRQr2.0-SUNRISE-2.1.genome.fasta",
-                        desc="HanXRQv2 genome reference (.fasta)")
-        ref_idx = InputFile("s3://rieseberg-references/HanXRQ2.0-20180814/annotated/HanXRQr2.0-SUNRISE-2.1.genome.fasta.fai",
-                        desc="HanXRQv2 genome reference index")
-
-    elif shortname in ("psc8",):
-        ref = InputFile("s3://rieseberg-references/HanPSC8r1.0-20181105/HanPSC8_genome.fasta",
-                        desc="HanPSC8v1 genome reference (.fasta)")
-        ref_idx = InputFile("s3://rieseberg-references/HanPSC8r1.0-20181105/HanPSC8_genome.fasta.fai",
-                        desc="HanPSC8v1 genome reference index")
-    else:
-        raise Exception("unrecognized reference name: " + shortname)
-
-    get_reference.cache[shortname] = Reference(shortname, ref, ref_idx)
-    return get_reference.cache[shortname]
-get_reference.cache = {}
+# python -m variants SUBCOMMAND [args...]
+# each module provides main(argv)
+SUBCOMMANDS = {
+    "report": "variants.report",
+    "qc": "variants.qc",
+    "simulate": "variants.schedule",
+    "extract": "variants.extract",
+    "vcf-compare": "variants.cohort",
+    "gvcf-stats": "variants.gvcfstats",
+    "monitor": "variants.monitor",
+}
 
 
 def main():
-    setup_logging(logging.INFO)
-    bunnies.setup_logging(logging.INFO)
+    if len(sys.argv) > 1 and sys.argv[1] in SUBCOMMANDS:
+        subcommand = importlib.import_module(SUBCOMMANDS[sys.argv[1]])
+        return subcommand.main(sys.argv[2:])
 
-    supported_references = ("xrqv2", "psc8", "ha412")
+    supported_references = SUPPORTED_REFERENCES
 
-    parser = argparse.ArgumentParser(description=__doc__)
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     epilog="other commands: %s. see python -m variants COMMAND --help" % (
+                                         ", ".join(sorted(SUBCOMMANDS)),))
 
     # bunnies argumens
     parser.add_argument("--computeenv", metavar="ENVNAME", type=str, default="variants4",
@@ -83,8 +59,9 @@ def main():
     parser.add_argument("samples", metavar="SAMPLESJSON", type=str, default="-",
                         help="input samples file in json format")
     parser.add_argument("--stage", metavar="STAGE", type=str, default="gvcf",
-                        help="the stage of the pipeline to compute (bam, gvcf)",
-                        choices=["bam", "gvcf"])
+                        help="the stage of the pipeline to compute (bam, gvcf, vcf, depth). depth is the"
+                             " windowed depth of coverage of the merged bams",
+                        choices=["bam", "gvcf", "vcf", "depth"])
     parser.add_argument("--reference", metavar="REFNAME", choices=supported_references,
                         dest="references", action="append", default=[],
                         help="specify name of reference to consider. default is to do all of %s" %
@@ -93,11 +70,84 @@ def main():
                         help="restrict pipeline to merges i>=starti (0based)")
     parser.add_argument("--endi",   metavar="ENDI",   type=int, default=9999999999,
                         help="restrict pipeline to merges i<=endi  (0based)")
+    parser.add_argument("--output-format", metavar="FMT", choices=OUTPUT_FORMATS, default="bam",
+                        dest="output_format",
+                        help="format of the merged reads: %s. crams are compressed against the"
+                             " reference (default: %%(default)s)" % (", ".join(OUTPUT_FORMATS),))
+    parser.add_argument("--scatter-gb", metavar="GB", type=float, default=0, dest="scatter_gb",
+                        help="split runs with more than GB gigabytes of (compressed) input into chunks of"
+                             " about that size, aligned as separate jobs. 0 disables (default: %(default)s)")
+    parser.add_argument("--cohort", metavar="NAME", type=str, default=None,
+                        help="with --stage vcf, name of the joint call. default is the name of the"
+                             " directory containing SAMPLESJSON")
+    parser.add_argument("--shard-mbp", metavar="MBP", type=float, default=100.0, dest="shard_mbp",
+                        help="with --stage vcf, the genome is split in shards of about this many"
+                             " megabases, each imported and genotyped in its own job (default: %(default)s)")
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="with --stage vcf, add the new samples to the cohort stores of earlier builds,"
+                             " instead of importing all the gvcfs again. shards whose store holds all the"
+                             " samples already are not genotyped again.")
+    parser.add_argument("--depth-window", metavar="BASES", type=int, default=1000, dest="depth_window",
+                        help="with --stage depth, size of the windows (default: %(default)s)")
     parser.add_argument("--dry-run", dest="dryrun", action="store_true", default=False,
                         help="don't build. just print the jobs that are ready.")
+    parser.add_argument("--qc-gate", dest="qc_gate", action="store_true", default=False,
+                        help="with --stage gvcf, don't genotype samples whose merged bam fails QC "
+                             "(see python -m variants qc --help). samples not merged yet are only merged.")
+    parser.add_argument("--order", choices=("critical", "input"), default="input",
+                        help="submit the targets in the order of the samples file (input), or with the longest"
+                             " estimated chain of jobs first (critical), which looks up the state and inputs"
+                             " of every node of the graph first. default: %(default)s")
+    parser.add_argument("--affinity-band", metavar="FRACTION", type=float, default=0.05, dest="affinity_band",
+                        help="with --order critical, targets whose critical paths are within FRACTION of the"
+                             " longest of each other are submitted grouped by reference, so that they land on"
+                             " hosts which have it cached. 0 disables (default: %(default)s)")
+    parser.add_argument("--no-prewarm", dest="prewarm", action="store_false", default=True,
+                        help="don't fetch the references of the whole build on each new host, in the first"
+                             " job which starts there")
+    parser.add_argument("--hold-back", metavar="FRACTION", type=float, default=0.0, dest="hold_back",
+                        help="build targets whose critical path is shorter than FRACTION of the longest in a"
+                             " second round, once the others are built. 0 disables (default: %(default)s)")
+    parser.add_argument("--plan-out", metavar="JSONL", type=str, default=None, dest="plan_out",
+                        help="write the estimated jobs to this file. see python -m variants simulate --help")
+    parser.add_argument("--estimate", action="store_true", default=False,
+                        help="don't build. print the vcpu-hours, memory-hours and bytes of the jobs left, by"
+                             " stage and by reference, and the makespan simulated with --maxvcpus.")
+    parser.add_argument("--history", action="store_true", default=False,
+                        help="with --estimate, measure the throughput of each stage from the timings of"
+                             " the jobs already built, where there are enough of them")
+    parser.add_argument("--local", action="store_true", default=False,
+                        help="build on this machine instead of the compute environment, in a process pool"
+                             " sized to its cores and memory. only align, merge and genotype nodes.")
+    parser.add_argument("--local-vcpus", metavar="VCPUS", type=int, default=None, dest="local_vcpus",
+                        help="with --local, vcpus to use (default: all of them)")
+    parser.add_argument("--local-memory-gb", metavar="GB", type=float, default=None, dest="local_memory_gb",
+                        help="with --local, memory to use (default: 90%% of the machine's)")
+    parser.add_argument("--local-workdir", metavar="DIR", type=str, default=None, dest="local_workdir",
+                        help="with --local, scratch directory of the jobs (default: a new temporary directory)")
+    parser.add_argument("--local-cas-dir", metavar="DIR", type=str, default=None, dest="local_cas_dir",
+                        help="with --local, cache of the references (default: /localscratch/cas, as in the images)")
+    parser.add_argument("--multi-ref", dest="multi_ref", action="store_true", default=False,
+                        help="before the build, align each run against all the selected references in one"
+                             " job, which fetches and decodes the reads once.")
+    parser.add_argument("--pack", action="store_true", default=False,
+                        help="before the build, run trivial merges and alignments of small runs"
+                             " several to a job. only nodes whose inputs are built are packed.")
+    parser.add_argument("--pack-align-gb", metavar="GB", type=float, default=1.0, dest="pack_align_gb",
+                        help="with --pack, alignments of runs with less input than this are packed"
+                             " (default: %(default)s)")
 
     args = parser.parse_args()
 
+    import bunnies
+    from . import GenomicsDBImport, JointGenotype, GatherVcfs
+    from . import SplitReads, MultiAlign
+    from .graph import read_runs, build_graph
+    from .references import get_reference
+
+    setup_logging(logging.INFO)
+    bunnies.setup_logging(logging.INFO)
+
     infile = args.samples
     if infile == "-":
         infd = sys.stdin
@@ -108,26 +158,8 @@ def main():
     if not args.references:
         args.references = set(supported_references)
 
-    runs = []
-    Run = namedtuple("Run", ["sample_name", "r1", "r2", "runid"])
-    for line in infd:
-        line = line.strip()
-        if not line or line.startswith("#"):
-            continue
-        obj = json.loads(line)
-        r1, r2 = obj['r1'], obj['r2']
-        digest_keys = ('md5', 'sha1', 'sha256')
-        r1_digests = {k:v for k,v in r1[1].items() if r1[1] and k in digest_keys} if r1 else None
-        r2_digests = {k:v for k,v in r2[1].items() if r2[1] and k in digest_keys} if r2 else None
-        runs.append(Run(
-            sample_name=obj['sample_name'],
-            r1=InputFile(obj['r1'][0], digests=r1_digests),
-            r2=(InputFile(obj['r2'][0], digests=r2_digests) if r2 else None),
-            runid=obj['runid']
-        ))
-    log.info("processing %d sequencing runs...", len(runs))
-
-    targets = []
+    runs = read_runs(infd)
+
     references = {
         name: get_reference(name)
         for name in args.references
@@ -135,35 +167,28 @@ def main():
 
     log.info("running on selected references: %s", sorted([name for name in args.references]))
 
-    all_merges = []
-    all_bams = []
-    all_gvcfs = []
-
-    for refname, ref in references.items():
-        by_name = {}
-        for run in runs:
-            bam = Align(sample_name=run.sample_name,
-                        r1=run.r1,
-                        r2=run.r2,
-                        ref=ref.ref,
-                        ref_idx=ref.ref_idx,
-                        lossy=False)
-            all_bams.append(bam)
-            by_name.setdefault(run.sample_name, []).append(bam)
-        for sample_name in by_name:
-            sample_bams = by_name[sample_name]
-
-            # merge all the runs of that sample name in a single bam
-            merged = Merge(sample_name, sample_bams)
-            all_merges.append(merged)
-
-            # call haplotypecaller
-            gvcf = Genotype(sample_name, merged, hc_options=[
-                "-G", "StandardAnnotation",
-                "-G", "AS_StandardAnnotation",
-                "-G", "StandardHCAnnotation"
-            ])
-            all_gvcfs.append(gvcf)
+    # large runs are split once, and the chunks aligned against each reference
+    splits = {}
+    if args.scatter_gb > 0:
+        from concurrent.futures import ThreadPoolExecutor
+        from .splitreads import num_chunks_for_size
+
+        def _run_size(run):
+            return run.r1.ls()['size'] + (run.r2.ls()['size'] if run.r2 else 0)
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            run_sizes = list(executor.map(_run_size, runs))
+        for runi, (run, run_size) in enumerate(zip(runs, run_sizes)):
+            num_chunks = num_chunks_for_size(run_size, int(args.scatter_gb * 1024 * 1024 * 1024))
+            if num_chunks > 1:
+                splits[runi] = SplitReads(run.sample_name, run.r1, run.r2, num_chunks=num_chunks)
+        log.info("scatter: %d runs split in %d chunks", len(splits),
+                 sum(split.params['num_chunks'] for split in splits.values()))
+
+    # alignments are only kept for the prebuild jobs which need them
+    graph = build_graph(runs, references, output_format=args.output_format, splits=splits,
+                        keep_aligns=args.multi_ref or args.pack)
+    all_merges, all_gvcfs = graph.merges, graph.gvcfs
 
     # - fixates software versions and parameters
     # - creates graph of dependencies
@@ -174,33 +199,169 @@ def main():
     start_index = _clamp(args.starti, 0, len(all_gvcfs) - 1)
     end_index = _clamp(args.endi, 0, len(all_gvcfs) - 1)
 
-    if args.stage == "gvcf":
-        pipeline = bunnies.build_pipeline(all_gvcfs[start_index:end_index+1])
+    def _shortname_of(s3_ref):
+        for shortname, known_ref in references.items():
+            if known_ref.ref is s3_ref:
+                return shortname
+        else:
+            raise Exception("cannot find reference name for %s" % (str(s3_ref),))
+
+    if args.stage == "gvcf" and args.qc_gate:
+        from .qc import gate_genotypes
+        from .remote import RemoteCache
+        gated, _ = gate_genotypes(all_gvcfs[start_index:end_index+1], _shortname_of, RemoteCache())
+        targets = gated
+    elif args.stage == "gvcf":
+        targets = all_gvcfs[start_index:end_index+1]
+    elif args.stage == "vcf":
+        # joint calling over the gvcfs of merges starti..endi
+        from .intervals import shard_contigs
+        from .references import fai_url, parse_fai
+        from .remote import RemoteCache
+
+        if not args.cohort and infile == "-":
+            raise ValueError("--cohort is required when samples are read from stdin")
+        cohort = args.cohort or os.path.basename(os.path.dirname(os.path.abspath(infile)))
+        cache = RemoteCache()
+        all_vcfs = []
+        all_stores = []
+        for refname, ref in sorted(references.items()):
+            ref_gvcfs = [gvcf for gvcf in all_gvcfs[start_index:end_index+1] if gvcf.ref is ref.ref]
+            if not ref_gvcfs:
+                continue
+            contigs = parse_fai(cache.read_text(fai_url(refname)))
+            shards = shard_contigs(contigs, int(args.shard_mbp * 1e6))
+            log.info("joint calling %d samples on %s in %d shards", len(ref_gvcfs), refname, len(shards))
+            ref_cohort = cohort + "." + refname
+            if args.incremental:
+                from .cohort import plan_stores
+                stores = plan_stores(ref_cohort, ref_gvcfs, shards)
+            else:
+                stores = [GenomicsDBImport(ref_cohort, ref_gvcfs, intervals=intervals, shard=shard_i)
+                          for shard_i, intervals in enumerate(shards)]
+            all_stores += stores
+            shard_vcfs = [JointGenotype(genomicsdb) for genomicsdb in stores]
+            all_vcfs.append(GatherVcfs(ref_cohort, shard_vcfs))
+        targets = all_vcfs
     elif args.stage == "bam":
-        pipeline = bunnies.build_pipeline(all_merges[start_index:end_index+1])
+        targets = all_merges[start_index:end_index+1]
+    elif args.stage == "depth":
+        from . import Depth
+        targets = [Depth(merged, window=args.depth_window) for merged in all_merges[start_index:end_index+1]]
     else:
         raise ValueError("unrecognized --stage value: %s" % (args.stage,))
 
+    # submit the targets with the longest chains of jobs first, and optionally
+    # keep the targets with short chains for a second round
+    rounds = [targets]
+    if args.order == "critical" or args.hold_back > 0 or args.plan_out or args.estimate:
+        from .schedule import plan, order_targets, hold_back, job_rounds, write_manifest
+        from .remote import RemoteCache
+
+        def _refname_of(s3_ref):
+            try:
+                return _shortname_of(s3_ref)
+            except Exception:
+                return ""
+        plan_jobs, target_ids = plan(targets, refname_of=_refname_of,
+                                     history=RemoteCache() if args.estimate and args.history else None)
+        if args.order == "critical":
+            targets = order_targets(targets, target_ids, plan_jobs, affinity_band=args.affinity_band)
+            rounds = [targets]
+        if args.hold_back > 0:
+            first, held = hold_back(targets, target_ids, plan_jobs, args.hold_back)
+            if first and held:
+                log.info("holding back %d targets with short critical paths", len(held))
+                rounds = [first, held]
+        if args.plan_out:
+            write_manifest(plan_jobs, args.plan_out, job_rounds(plan_jobs, [
+                [target_ids[id(target)] for target in round_targets if id(target) in target_ids]
+                for round_targets in rounds]))
+            log.info("plan of %d jobs written to %s", len(plan_jobs), args.plan_out)
+        if args.estimate:
+            from .schedule import estimate, format_estimate
+            rows, simulation = estimate(plan_jobs, args.max_vcpus, rounds=job_rounds(plan_jobs, [
+                [target_ids[id(target)] for target in round_targets if id(target) in target_ids]
+                for round_targets in rounds]))
+            print(format_estimate(rows, simulation, args.max_vcpus))
+            return 0
+
+    pipeline = bunnies.build_pipeline(targets)
     log.info("pipeline built...")
 
+    if args.local and (args.multi_ref or args.pack):
+        raise ValueError("--multi-ref and --pack don't apply to --local builds")
+
+    if not args.dryrun and not args.local:
+        # the jobs run a bundle of this code, uploaded once per version
+        from .bundle import register_user_deps
+        prewarm = None
+        if args.prewarm:
+            from .refcache import reference_bundles
+            prewarm = reference_bundles(targets)
+        register_user_deps(targets[0].repo_path(), prewarm=prewarm)
+
+    # jobs which build several nodes of the pipeline at once. their members are
+    # built once they are, and are skipped by the main build.
+    prebuild = []
+    # only the alignments of the selected samples (--starti, --endi)
+    selected_aligns = set(id(merge.inputs[str(i)].node) for merge in all_merges[start_index:end_index+1]
+                          for i in range(merge.params['num_bams']))
+    if args.multi_ref and len(references) > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        grouped = [[align for align in aligns if id(align) in selected_aligns] for aligns in graph.run_aligns.values()]
+        grouped = [aligns for aligns in grouped if len(aligns) > 1]
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            built = list(executor.map(lambda aligns: all(align.exists() for align in aligns), grouped))
+        multis = [MultiAlign(aligns) for aligns, is_built in zip(grouped, built) if not is_built]
+        log.info("multi-reference alignment of %d runs", len(multis))
+        prebuild += multis
+    if args.pack:
+        from .packing import plan_packs
+        multi_members = set(id(align) for multi in prebuild for align in multi.members)
+        packs = plan_packs([bam for bam in graph.bams
+                            if id(bam) in selected_aligns and id(bam) not in multi_members] +
+                           all_merges[start_index:end_index+1],
+                           small_align_bytes=int(args.pack_align_gb * 1024 * 1024 * 1024))
+        for pack in packs:
+            log.info("pack %s: %s", pack.output_prefix(),
+                     ", ".join(member.sample_name for member in pack.members))
+        prebuild += packs
+    if prebuild and not args.dryrun:
+        bunnies.build_pipeline(prebuild).build(args.computeenv,
+                                               min_attempt=args.min_attempt,
+                                               max_attempt=args.max_attempt,
+                                               max_vcpus=args.max_vcpus)
+
     #
     # Create compute resources, tag the compute environment
     # entities with the name of the package
     #
-    if not args.dryrun:
-        pipeline.build(args.computeenv,
-                       min_attempt=args.min_attempt,
-                       max_attempt=args.max_attempt,
-                       max_vcpus=args.max_vcpus)
+    if not args.dryrun and args.local:
+        from .local import build_local
+        capacity = {}
+        if args.local_vcpus:
+            capacity['vcpus'] = args.local_vcpus
+        if args.local_memory_gb:
+            capacity['memory'] = int(args.local_memory_gb * 1024)
+        for round_targets in rounds:
+            build_local(round_targets, capacity=capacity, workdir=args.local_workdir,
+                        min_attempt=args.min_attempt, max_attempt=args.max_attempt, casdir=args.local_cas_dir)
+    elif not args.dryrun:
+        for round_i, round_targets in enumerate(rounds):
+            round_pipeline = pipeline if len(rounds) == 1 else bunnies.build_pipeline(round_targets)
+            log.info("building round %d of %d (%d targets)", round_i + 1, len(rounds), len(round_targets))
+            round_pipeline.build(args.computeenv,
+                                 min_attempt=args.min_attempt,
+                                 max_attempt=args.max_attempt,
+                                 max_vcpus=args.max_vcpus)
     else:
         log.info("dry run mode, skipping build.")
 
-    def _shortname_of(s3_ref):
-        for shortname, known_ref in references.items():
-            if known_ref.ref is s3_ref:
-                return shortname
-        else:
-            raise Exception("cannot find reference name for %s" % (str(s3_ref),))
+    if args.stage == "vcf" and not args.dryrun:
+        # the next incremental build starts from these
+        from .cohort import register_stores
+        register_stores(all_stores)
 
     all_outputs = {}
     for target in pipeline.targets:
@@ -231,5 +392,4 @@ def main():
             print("\t".join(columns))
 
 if __name__ == "__main__":
-    main()
-    sys.exit(0)
+    sys.exit(main() or 0)
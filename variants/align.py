@@ -3,11 +3,12 @@ import bunnies.unmarshall
 import logging
 import bunnies.config as config
 from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+from .packing import Packable
 
 log = logging.getLogger(__name__)
 
 
-class Align(bunnies.Transform):
+class Align(Packable, bunnies.Transform):
     """
     Align a paired-end fastq or sra file against a reference genome
     """
@@ -95,34 +96,47 @@ class Align(bunnies.Transform):
             'cid': self.canonical_id
         }
 
+    def read_locations(self):
+        """
+        the [url, digest] pairs of the reads to align, in the align jobfile format.
+        the second pair is empty for sra inputs.
+        """
+        r1_target = self.r1.ls()
+        r2_target = self.r2.ls() if self.r2 else None
+        return [
+            [r1_target['url'], "md5:" + r1_target['digests']['md5']],
+            [r2_target['url'], "md5:" + r2_target['digests']['md5']] if r2_target else ["", ""]
+        ]
+
+    def input_bytes(self):
+        """size of the reads to align"""
+        return self.r1.ls()['size'] + (self.r2.ls()['size'] if self.r2 else 0)
+
     def run(self, resources=None, **params):
         """ this runs in the image """
         import os
         import sys
         import tempfile
         import json
-
-        def cache_remote_file(url, md5_digest, casdir):
-            return bunnies.run_cmd([
-                "cas", "-put", url, "-get", "md5:" + md5_digest, casdir
-            ]).stdout.decode('utf-8').strip()
+        from . import refcache
+        from .refcache import cache_reference
+        from .timing import Timings
 
         workdir = params['workdir']
         s3_output_prefix = self.output_prefix()
         local_output_dir = os.path.join(workdir, "output")
+        timings = Timings(self.name, self.params['sample_name'], vcpus=resources['vcpus'],
+                          memory=resources['memory'])
 
-        cas_dir = "/localscratch/cas"
-        os.makedirs(cas_dir, exist_ok=True)
+        cas_dir = refcache.CAS_DIR
         os.makedirs(local_output_dir, exist_ok=True)
 
         #
         # download reference in /scratch
         # /scratch is shared with other jobs in the same compute environment
         #
-        ref_target = self.ref.ls()
-        ref_idx_target = self.ref_idx.ls()
-        ref_path = cache_remote_file(ref_target['url'], ref_target['digests']['md5'], cas_dir)
-        _ = cache_remote_file(ref_idx_target['url'], ref_idx_target['digests']['md5'], cas_dir)
+        with timings.span("reference") as span:
+            ref_path, _ = cache_reference(self, cas_dir, span=span)
 
         align_args = [
             "align",
@@ -131,17 +145,11 @@ class Align(bunnies.Transform):
         if self.params['lossy']:
             align_args.append("-lossy")
 
-        r1_target = self.r1.ls()
-        r2_target = self.r2.ls() if self.r2 else None
-
         # write jobfile
         jobfile_doc = {
             self.params['sample_name']: {
                 "name": self.params['sample_name'],
-                "locations": [
-                    [r1_target['url'], "md5:" + r1_target['digests']['md5']],
-                    [r2_target['url'], "md5:" + r2_target['digests']['md5']] if r2_target else ["", ""]
-                ]
+                "locations": params.get('locations') or self.read_locations()
             }
         }
         log.info("align job: %s", repr(jobfile_doc))
@@ -161,7 +169,13 @@ class Align(bunnies.Transform):
             "-stats"
         ]
 
-        bunnies.run_cmd(align_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+        # the align tool fetches the reads, aligns, marks duplicates and uploads,
+        # all in one span. the bytes read and written are recorded apart.
+        with timings.span("align", threads=num_threads,
+                          fetches_reads=not params.get('locations')) as align_span:
+            bunnies.run_cmd(align_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+            align_span.attrs['input_bytes'] = self.input_bytes()
+            align_span.add_bytes(align_span.attrs['input_bytes'])
 
         def _check_output_file(field, url, is_optional=False):
             try:
@@ -178,15 +192,21 @@ class Align(bunnies.Transform):
         def od(x):
             return os.path.join(s3_output_prefix, x)
 
-        output = {
-            "bam": _check_output_file("bam", "%s.bam" % od(sn)),
-            "bamstats": _check_output_file("bamstats", "%s.bamstats.txt" % od(sn)),
-            "bai": _check_output_file("bai", "%s.bai" % od(sn)),
-            "illuminametrics": _check_output_file("illuminametrics", "%s.illuminametrics.txt" % od(sn)),
-            "dupmetrics": _check_output_file("dupmetrics", "%s.dupmetrics.txt" % od(sn)),
-            "bam_md5": _check_output_file("bam.md5", "%s.bam.md5" % od(sn))
-        }
+        with timings.span("verify") as span:
+            output = {
+                "bam": _check_output_file("bam", "%s.bam" % od(sn)),
+                "bamstats": _check_output_file("bamstats", "%s.bamstats.txt" % od(sn)),
+                "bai": _check_output_file("bai", "%s.bai" % od(sn)),
+                "illuminametrics": _check_output_file("illuminametrics", "%s.illuminametrics.txt" % od(sn)),
+                "dupmetrics": _check_output_file("dupmetrics", "%s.dupmetrics.txt" % od(sn)),
+                "bam_md5": _check_output_file("bam.md5", "%s.bam.md5" % od(sn))
+            }
+            span.add_bytes(output['bam']['size'])
+        align_span.attrs['output_bytes'] = sum(entry['size'] for entry in output.values() if entry)
 
+        timings_path = timings.write(os.path.join(local_output_dir, sn + ".timings.json"))
+        output["timings"] = {"size": os.stat(timings_path).st_size, "url": od(sn + ".timings.json")}
+        bunnies.transfers.s3_upload_file(timings_path, output["timings"]["url"])
         return output
 
 
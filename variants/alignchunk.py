@@ -0,0 +1,90 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+
+from .align import Align
+from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+
+log = logging.getLogger(__name__)
+
+
+class AlignChunk(Align):
+    """
+    Align one chunk of a run split with SplitReads. The sorted chunk bams of a
+    sample are combined, and duplicates marked, by Merge.
+    """
+    VERSION = "1"
+
+    __slots__ = ("split", "chunk")
+    kind = KIND_PREFIX + "AlignChunk"
+
+    def __init__(self, split=None, chunk=None, ref=None, ref_idx=None, lossy=False, manifest=None):
+        bunnies.Transform.__init__(self, "alignchunk", version=self.VERSION, image=self.ALIGN_IMAGE,
+                                   manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            split = inputs['split'].node
+            ref = inputs['ref'].node
+            ref_idx = inputs['ref_idx'].node
+            chunk = params['chunk']
+            lossy = params['lossy']
+
+        if None in (split, chunk, ref, ref_idx):
+            raise Exception("invalid parameters for chunk alignment")
+
+        if not 0 <= chunk < split.params['num_chunks']:
+            raise ValueError("chunk %d out of range for %d chunks" % (chunk, split.params['num_chunks']))
+
+        sample_name = split.sample_name
+        if not SAMPLE_NAME_RE.match(sample_name):
+            raise ValueError("sample name %r does not match %s" % (
+                sample_name, SAMPLE_NAME_RE.pattern))
+
+        self.sample_name = sample_name
+        self.split = split
+        self.chunk = chunk
+        self.r1 = None
+        self.r2 = None
+        self.ref = ref
+        self.ref_idx = ref_idx
+
+        self.add_input("split", split, desc="reads split in chunks")
+        self.add_input("ref", ref, desc="reference fasta")
+        self.add_input("ref_idx", ref_idx, desc="reference index")
+        self.params["lossy"] = bool(lossy)
+        self.params["sample_name"] = sample_name
+        self.params["chunk"] = int(chunk)
+
+    def task_resources(self, attempt=1, **kwargs):
+        # chunks are small enough that the first rung of the ladder is
+        # rarely outgrown. scale the time with the chunk instead.
+        resources = super().task_resources(attempt=attempt, **kwargs)
+        gbs = float(self.input_bytes()) / (1024*1024*1024)
+        resources['timeout'] = max(int(gbs * 3600), 4*3600) * attempt  # 1h per gb (min 4h)
+        return resources
+
+    def input_bytes(self):
+        chunk = self.split.ls()['chunks'][self.params['chunk']]
+        return chunk['r1']['size'] + (chunk['r2']['size'] if chunk['r2'] else 0)
+
+    def read_locations(self):
+        chunk = self.split.ls()['chunks'][self.params['chunk']]
+        r1, r2 = chunk['r1'], chunk['r2']
+        return [
+            [r1['url'], "md5:" + r1['digests']['md5']],
+            [r2['url'], "md5:" + r2['digests']['md5']] if r2 else ["", ""]
+        ]
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(sample_name)s-chunk%(chunk)04d-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'sample_name': self.params['sample_name'],
+            'chunk': self.params['chunk'],
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(AlignChunk)
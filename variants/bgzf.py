@@ -0,0 +1,315 @@
+"""
+BGZF blocks, BAM records and BAI indexes, for reading small parts of
+remote bams without htslib.
+
+A BGZF file is a series of independently compressed gzip blocks of at
+most 64KiB. Positions in the uncompressed stream are virtual offsets:
+the file offset of a block << 16 | the offset within the block. A BAI
+index maps genomic bins to chunks of virtual offsets.
+"""
+
+import zlib
+import struct
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+BGZF_MAGIC = b"\x1f\x8b\x08\x04"
+BGZF_HEADER_SIZE = 18
+MAX_BLOCK_SIZE = 65536
+
+# empty block at the end of every bgzf file
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+BAM_MAGIC = b"BAM\x01"
+BAI_MAGIC = b"BAI\x01"
+
+# bai pseudo-bin holding metadata, not chunks
+BAI_PSEUDO_BIN = 37450
+
+# linear index granularity
+LINEAR_SHIFT = 14
+
+# cigar operations which consume the reference: M D N = X
+_REF_OPS = frozenset((0, 2, 3, 7, 8))
+
+FLAG_UNMAPPED = 0x4
+
+_RECORD_FIXED = struct.Struct("<iiiBBHHHiiii")
+
+
+def split_voffset(voffset):
+    """(file offset of the block, offset in the uncompressed block)"""
+    return voffset >> 16, voffset & 0xffff
+
+
+def block_size(data, offset=0):
+    """total size of the bgzf block at data[offset:]"""
+    if data[offset:offset + 4] != BGZF_MAGIC:
+        raise ValueError("no bgzf block at offset %d" % (offset,))
+    xlen, = struct.unpack_from("<H", data, offset + 10)
+    pos = offset + 12
+    end = pos + xlen
+    while pos < end:
+        si1, si2, slen = struct.unpack_from("<BBH", data, pos)
+        if si1 == 66 and si2 == 67:
+            bsize, = struct.unpack_from("<H", data, pos + 4)
+            return bsize + 1
+        pos += 4 + slen
+    raise ValueError("bgzf block at offset %d has no BC subfield" % (offset,))
+
+
+def inflate_block(data, offset=0):
+    """(uncompressed bytes of the block at data[offset:], size of the block)"""
+    size = block_size(data, offset)
+    if offset + size > len(data):
+        raise EOFError("truncated bgzf block at offset %d" % (offset,))
+    xlen, = struct.unpack_from("<H", data, offset + 10)
+    cdata = data[offset + 12 + xlen:offset + size - 8]
+    crc, isize = struct.unpack_from("<II", data, offset + size - 8)
+    udata = zlib.decompress(cdata, -15)
+    if len(udata) != isize or zlib.crc32(udata) & 0xffffffff != crc:
+        raise ValueError("corrupt bgzf block at offset %d" % (offset,))
+    return udata, size
+
+
+def inflate_blocks(data, offset=0, end=None):
+    """
+    uncompressed bytes of the whole blocks in data[offset:end], and
+    [(file offset of each block relative to data, its uncompressed start)]
+    """
+    end = len(data) if end is None else end
+    chunks, starts, ustart = [], [], 0
+    while offset < end:
+        try:
+            udata, size = inflate_block(data, offset)
+        except EOFError:
+            break
+        starts.append((offset, ustart))
+        chunks.append(udata)
+        ustart += len(udata)
+        offset += size
+    return b"".join(chunks), starts
+
+
+def whole_blocks(data, offset=0):
+    """end of the last whole block in data[offset:], following the chain of block headers"""
+    pos = offset
+    while pos + BGZF_HEADER_SIZE <= len(data):
+        size = block_size(data, pos)
+        if pos + size > len(data):
+            break
+        pos += size
+    return pos
+
+
+def iter_parts(read_range, size, func, part_size=4*1024*1024, jobs=4):
+    """
+    func(uncompressed bytes) of consecutive runs of whole blocks of a bgzf
+    file, in file order. read_range(start, end) returns the bytes [start, end)
+    of the file.
+
+    parts of part_size compressed bytes are fetched, and their blocks are
+    inflated and passed to func, in two pools of jobs threads. the boundaries
+    between blocks are found from the block headers, so no index is needed.
+    at most jobs parts are in flight in each pool.
+    """
+    with ThreadPoolExecutor(max_workers=jobs) as io_pool, ThreadPoolExecutor(max_workers=jobs) as cpu_pool:
+        fetches, work = deque(), deque()
+        next_offset = 0
+        carry = b""
+        while fetches or next_offset < size:
+            while len(fetches) < jobs and next_offset < size:
+                end = min(next_offset + part_size, size)
+                fetches.append(io_pool.submit(read_range, next_offset, end))
+                next_offset = end
+            data = carry + fetches.popleft().result()
+            pos = whole_blocks(data)
+            carry = data[pos:]
+            work.append(cpu_pool.submit(lambda blocks: func(inflate_blocks(blocks)[0]), data[:pos]))
+            while len(work) > jobs:
+                yield work.popleft().result()
+        if carry:
+            raise EOFError("truncated bgzf block at offset %d" % (size - len(carry),))
+        while work:
+            yield work.popleft().result()
+
+
+def deflate_block(udata, level=6):
+    """one bgzf block holding udata (at most 65280 bytes)"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = compressor.compress(udata) + compressor.flush()
+    header = struct.pack("<4sIBBHBBHH", BGZF_MAGIC, 0, 0, 0xff, 6, 66, 67, 2, len(cdata) + 25)
+    return header + cdata + struct.pack("<II", zlib.crc32(udata) & 0xffffffff, len(udata))
+
+
+class BgzfWriter(object):
+    """write a bgzf stream to a binary file object"""
+    BLOCK_DATA = 65280
+
+    def __init__(self, fileobj, level=6):
+        self.fileobj = fileobj
+        self.level = level
+        self._buf = bytearray()
+
+    def write(self, data):
+        self._buf += data
+        while len(self._buf) >= self.BLOCK_DATA:
+            self.fileobj.write(deflate_block(bytes(self._buf[:self.BLOCK_DATA]), self.level))
+            del self._buf[:self.BLOCK_DATA]
+
+    def close(self):
+        if self._buf:
+            self.fileobj.write(deflate_block(bytes(self._buf), self.level))
+            self._buf = bytearray()
+        self.fileobj.write(BGZF_EOF)
+
+
+#
+# bam
+#
+
+class BamHeader(object):
+    __slots__ = ("text", "references")
+
+    def __init__(self, text, references):
+        """references=[(name, length)] in refid order"""
+        self.text = text
+        self.references = references
+
+    def refid(self, name):
+        for i, (ref_name, _) in enumerate(self.references):
+            if ref_name == name:
+                return i
+        return None
+
+    def encode(self):
+        text = self.text.encode("utf-8")
+        out = [BAM_MAGIC, struct.pack("<i", len(text)), text, struct.pack("<i", len(self.references))]
+        for name, length in self.references:
+            name_bytes = name.encode("utf-8") + b"\0"
+            out += [struct.pack("<i", len(name_bytes)), name_bytes, struct.pack("<i", length)]
+        return b"".join(out)
+
+
+def parse_bam_header(udata):
+    """
+    (BamHeader, size) from the start of the uncompressed bam stream.
+    raises EOFError if udata is too short to hold the header.
+    """
+    if len(udata) < 12:
+        raise EOFError("bam header is truncated")
+    if udata[0:4] != BAM_MAGIC:
+        raise ValueError("not a bam file")
+    l_text, = struct.unpack_from("<i", udata, 4)
+    pos = 8 + l_text
+    if len(udata) < pos + 4:
+        raise EOFError("bam header is truncated")
+    text = udata[8:pos].rstrip(b"\0").decode("utf-8")
+    n_ref, = struct.unpack_from("<i", udata, pos)
+    pos += 4
+    references = []
+    for _ in range(n_ref):
+        if len(udata) < pos + 4:
+            raise EOFError("bam header is truncated")
+        l_name, = struct.unpack_from("<i", udata, pos)
+        if len(udata) < pos + 8 + l_name:
+            raise EOFError("bam header is truncated")
+        name = udata[pos + 4:pos + 4 + l_name - 1].decode("utf-8")
+        l_ref, = struct.unpack_from("<i", udata, pos + 4 + l_name)
+        references.append((name, l_ref))
+        pos += 8 + l_name
+    return BamHeader(text, references), pos
+
+
+def record_span(record):
+    """(refid, 0-based start, end) of a bam record (bytes including its block_size)"""
+    (_, refid, pos, l_read_name, _, _, n_cigar, flag, _, _, _, _) = _RECORD_FIXED.unpack_from(record, 0)
+    if flag & FLAG_UNMAPPED or not n_cigar:
+        return refid, pos, pos + 1
+    cigar = struct.unpack_from("<%dI" % (n_cigar,), record, 36 + l_read_name)
+    ref_len = sum(op >> 4 for op in cigar if op & 0xf in _REF_OPS)
+    return refid, pos, pos + max(ref_len, 1)
+
+
+def iter_records(udata, start=0, end=None):
+    """(offset, record bytes) of the records in udata[start:end]"""
+    end = len(udata) if end is None else end
+    pos = start
+    while pos + 4 <= end:
+        size, = struct.unpack_from("<i", udata, pos)
+        if pos + 4 + size > len(udata):
+            break
+        yield pos, udata[pos:pos + 4 + size]
+        pos += 4 + size
+
+
+#
+# bai
+#
+
+class BaiIndex(object):
+    """bins and linear index of each reference of a bai"""
+    __slots__ = ("references",)
+
+    def __init__(self, references):
+        """references=[({bin: [(beg, end)]}, [ioffset])] in refid order"""
+        self.references = references
+
+    def chunks(self, refid, start, end):
+        """
+        merged [(beg, end)] virtual offset ranges holding the records which
+        may overlap start-end (0-based, half-open) on refid
+        """
+        if refid >= len(self.references):
+            return []
+        bins, linear = self.references[refid]
+        min_offset = 0
+        if linear:
+            min_offset = linear[min(start >> LINEAR_SHIFT, len(linear) - 1)]
+        found = []
+        for bin_id in reg2bins(start, end):
+            for beg, chunk_end in bins.get(bin_id, ()):
+                if chunk_end > min_offset:
+                    found.append((max(beg, min_offset), chunk_end))
+        found.sort()
+        merged = []
+        for beg, chunk_end in found:
+            if merged and beg <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], chunk_end))
+            else:
+                merged.append((beg, chunk_end))
+        return merged
+
+
+def parse_bai(data):
+    if data[0:4] != BAI_MAGIC:
+        raise ValueError("not a bai index")
+    n_ref, = struct.unpack_from("<i", data, 4)
+    pos = 8
+    references = []
+    for _ in range(n_ref):
+        n_bin, = struct.unpack_from("<i", data, pos)
+        pos += 4
+        bins = {}
+        for _ in range(n_bin):
+            bin_id, n_chunk = struct.unpack_from("<Ii", data, pos)
+            pos += 8
+            chunks = struct.unpack_from("<%dQ" % (2 * n_chunk,), data, pos)
+            pos += 16 * n_chunk
+            if bin_id != BAI_PSEUDO_BIN:
+                bins[bin_id] = list(zip(chunks[0::2], chunks[1::2]))
+        n_intv, = struct.unpack_from("<i", data, pos)
+        pos += 4
+        linear = list(struct.unpack_from("<%dQ" % (n_intv,), data, pos))
+        pos += 8 * n_intv
+        references.append((bins, linear))
+    return BaiIndex(references)
+
+
+def reg2bins(start, end):
+    """the bins which may hold records overlapping start-end (0-based, half-open)"""
+    end -= 1
+    bins = [0]
+    for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585), (14, 4681)):
+        bins.extend(range(offset + (start >> shift), offset + (end >> shift) + 1))
+    return bins
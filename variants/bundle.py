@@ -0,0 +1,170 @@
+"""
+Content-addressed bundles of the code shipped to the jobs.
+
+The jobs run the variants package and scripts from this tree. The driver
+packs them in a tarball named after a digest of their contents, and
+uploads it under bundles/ in the repository, unless a bundle with that
+digest is already there: unchanged code is neither packed nor uploaded
+again. File digests are memoized by (size, mtime), so an unchanged tree
+is only stat'ed.
+
+A hook of the jobs fetches and unpacks the bundle once per host, and
+imports variants from it, so edits made while a build runs don't leak
+into its jobs.
+"""
+
+import os
+import os.path
+import json
+import shutil
+import hashlib
+import logging
+import tarfile
+import tempfile
+
+from .remote import DEFAULT_CACHE_DIR
+
+log = logging.getLogger(__name__)
+
+TOPDIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+# trees of TOPDIR shipped to the jobs
+BUNDLED_DIRS = ("variants", "scripts")
+
+EXCLUDED_NAMES = ("__pycache__",)
+EXCLUDED_SUFFIXES = (".pyc", ".pyo", "~")
+
+
+def bundled_files(topdir, dirnames=BUNDLED_DIRS):
+    """sorted relative paths of the files under the bundled dirs"""
+    paths = []
+    for dirname in dirnames:
+        for root, dirs, files in os.walk(os.path.join(topdir, dirname)):
+            dirs[:] = sorted(d for d in dirs if d not in EXCLUDED_NAMES)
+            for fname in files:
+                if fname.endswith(EXCLUDED_SUFFIXES):
+                    continue
+                paths.append(os.path.relpath(os.path.join(root, fname), topdir))
+    return sorted(paths)
+
+
+def _file_digest(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as infd:
+        for block in iter(lambda: infd.read(1024*1024), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def tree_digest(topdir, dirnames=BUNDLED_DIRS, cachedir=DEFAULT_CACHE_DIR):
+    """
+    digest of the names, modes and contents of the bundled files
+    """
+    memo_path = os.path.join(cachedir, "bundle", "digests.json")
+    try:
+        with open(memo_path, "r") as memo_fd:
+            memo = json.load(memo_fd)
+    except (OSError, ValueError):
+        memo = {}
+
+    tree = hashlib.sha1()
+    fresh = {}
+    for relpath in bundled_files(topdir, dirnames):
+        path = os.path.join(topdir, relpath)
+        st = os.stat(path)
+        stamp = [st.st_size, st.st_mtime_ns]
+        known = memo.get(path)
+        digest = known[1] if known and known[0] == stamp else _file_digest(path)
+        fresh[path] = [stamp, digest]
+        tree.update(("%s\0%o\0%s\n" % (relpath, st.st_mode & 0o777, digest)).encode("utf-8"))
+
+    if fresh != memo:
+        os.makedirs(os.path.dirname(memo_path), exist_ok=True)
+        with open(memo_path + ".tmp", "w") as memo_fd:
+            json.dump(fresh, memo_fd)
+        os.replace(memo_path + ".tmp", memo_path)
+    return tree.hexdigest()
+
+
+def bundle_url(repo, digest):
+    """url of the bundle of the code with that digest, under the repository url repo"""
+    return "%sbundles/%s.tar.gz" % (repo, digest)
+
+
+def pack(dest, topdir=TOPDIR, dirnames=BUNDLED_DIRS):
+    """write the bundled trees of topdir to the gzipped tarball dest"""
+    def _reset(info):
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        info.mtime = 0
+        return info
+
+    with tarfile.open(dest, "w:gz") as tar:
+        for relpath in bundled_files(topdir, dirnames):
+            tar.add(os.path.join(topdir, relpath), arcname=relpath, recursive=False, filter=_reset)
+    return dest
+
+
+def publish(repo, topdir=TOPDIR, dirnames=BUNDLED_DIRS, cachedir=DEFAULT_CACHE_DIR):
+    """
+    (url, digest) of the bundle of the code under repo. the code is packed
+    and uploaded only when no bundle with its digest is there yet.
+    """
+    from .remote import object_exists, upload_file
+    digest = tree_digest(topdir, dirnames, cachedir)
+    url = bundle_url(repo, digest)
+    if object_exists(url):
+        log.debug("reusing code bundle %s", url)
+        return url, digest
+
+    tmpdir = tempfile.mkdtemp(prefix="variants-bundle-")
+    try:
+        upload_file(pack(os.path.join(tmpdir, "bundle.tar.gz"), topdir, dirnames), url)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    log.info("new code bundle %s", url)
+    return url, digest
+
+
+# run in the jobs, before variants is imported: fetch and unpack the bundle
+# once per host, and import the code from there.
+LOADER = """
+import os, sys, shutil, tarfile, tempfile
+url, digest = %r, %r
+dest = os.path.join(tempfile.gettempdir(), "variants-bundle-" + digest[0:16])
+if not os.path.isdir(dest):
+    tmpdir = tempfile.mkdtemp(prefix=".tmp.variants-bundle-", dir=os.path.dirname(dest))
+    archive = os.path.join(tmpdir, "bundle.tar.gz")
+    if url.startswith("s3://"):
+        import boto3
+        bucket, key = url[len("s3://"):].split("/", 1)
+        boto3.client("s3").download_file(bucket, key, archive)
+    else:
+        shutil.copyfile(url, archive)
+    with tarfile.open(archive, "r:gz") as tar:
+        tar.extractall(tmpdir)
+    os.unlink(archive)
+    try:
+        os.rename(tmpdir, dest)
+    except OSError:
+        # another job on the host unpacked it first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+sys.path.insert(0, dest)
+"""
+
+
+def register_user_deps(repo, prewarm=None):
+    """
+    ship the bundle of the code to the jobs, and load it there.
+    repo is the url of the repository the bundles are kept in.
+    prewarm=[[url, md5] ...] reference files fetched on each host before its first job
+    """
+    import bunnies.runtime
+    url, digest = publish(repo)
+    bunnies.runtime.add_user_hook("exec(%r)" % (LOADER % (url, digest),))
+    bunnies.runtime.add_user_hook("import variants")
+    bunnies.runtime.add_user_hook("variants.register_kinds()")
+    bunnies.runtime.add_user_hook("variants.setup_logging()")
+    if prewarm:
+        bunnies.runtime.add_user_hook("import variants.refcache")
+        bunnies.runtime.add_user_hook("variants.refcache.prewarm_host(%r)" % (prewarm,))
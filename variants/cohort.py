@@ -0,0 +1,211 @@
+"""
+Cohort stores: the GenomicsDB workspaces of a joint call, kept between builds.
+
+Each shard of a cohort has a registry listing the workspaces built for it,
+and the gvcfs (sample name and canonical id) they hold, in the order they
+were added. When samples are added to the cohort, the store of each shard
+holding the most of the current gvcfs, and none that are gone, is updated
+with the new gvcfs instead of importing all of them again. Stores which
+hold exactly the current gvcfs are reused as they are, so their shards are
+not genotyped again.
+
+The vcf-compare command checks that two joint calls agree:
+
+  python -m variants vcf-compare scratch.vcf.gz incremental.vcf.gz
+"""
+
+import os
+import sys
+import gzip
+import json
+import argparse
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+def registry_url(node, cohort, shard):
+    return "%scohorts/%s/shard%04d.json" % (node.repo_path(), cohort, shard)
+
+
+def read_registry(url):
+    """records of a registry, or [] if there is none yet"""
+    import tempfile
+    import bunnies
+    try:
+        bunnies.utils.get_blob_meta(url)
+    except bunnies.exc.NoSuchFile:
+        return []
+    with tempfile.NamedTemporaryFile(suffix=".json") as tmp_fd:
+        bunnies.transfers.s3_download_file(url, tmp_fd.name)
+        with open(tmp_fd.name, "r") as registry_fd:
+            return json.load(registry_fd)['stores']
+
+
+def write_registry(url, records):
+    import tempfile
+    import bunnies
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as registry_fd:
+        json.dump({'stores': records}, registry_fd, sort_keys=True, indent=1)
+    bunnies.transfers.s3_upload_file(registry_fd.name, url)
+    os.unlink(registry_fd.name)
+
+
+def store_chain(node):
+    """[[[sample, gvcf cid] ...] per import or update step] of a store, oldest first"""
+    from .genomicsdbupdate import GenomicsDBUpdate
+    steps = []
+    while isinstance(node, GenomicsDBUpdate):
+        steps.append(node.gvcfs)
+        node = node.base
+    steps.append(node.gvcfs)
+    return [[[gvcf.sample_name, gvcf.canonical_id] for gvcf in step] for step in reversed(steps)]
+
+
+def _replay(record, cohort, shard, by_sample):
+    """the store node of a registry record, from the current gvcfs"""
+    from .genomicsdb import GenomicsDBImport
+    from .genomicsdbupdate import GenomicsDBUpdate
+    steps = [[by_sample[sample] for sample, _ in step] for step in record['chain']]
+    node = GenomicsDBImport(cohort, steps[0], intervals=record['intervals'], shard=shard)
+    for step in steps[1:]:
+        node = GenomicsDBUpdate(node, step)
+    return node
+
+
+def plan_stores(cohort, gvcfs, shards, jobs=16):
+    """
+    store node of each shard of the cohort, holding the gvcfs.
+    shards=[intervals of each shard]
+    """
+    from .genomicsdb import GenomicsDBImport
+    from .genomicsdbupdate import GenomicsDBUpdate
+
+    if not gvcfs:
+        raise ValueError("a cohort requires 1 or more gvcfs")
+    current = set((gvcf.sample_name, gvcf.canonical_id) for gvcf in gvcfs)
+    by_sample = {gvcf.sample_name: gvcf for gvcf in gvcfs}
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        registries = list(executor.map(lambda shard_i: read_registry(registry_url(gvcfs[0], cohort, shard_i)),
+                                       range(len(shards))))
+
+    stores = []
+    for shard_i, (intervals, records) in enumerate(zip(shards, registries)):
+        intervals = [[name, int(start), int(end)] for name, start, end in intervals]
+        candidates = []
+        for record in records:
+            members = set(tuple(member) for step in record['chain'] for member in step)
+            if record['intervals'] != intervals or not members <= current:
+                continue
+            candidates.append((len(members), -len(record['chain']), record))
+        store = None
+        for _, _, record in sorted(candidates, key=lambda c: c[:2], reverse=True):
+            node = _replay(record, cohort, shard_i, by_sample)
+            if node.canonical_id == record['cid']:
+                store = node
+                break
+            log.warning("%s shard %d: store %s can't be rebuilt from its gvcfs. ignored.", cohort, shard_i,
+                        record['prefix'])
+        if store is None:
+            stores.append(GenomicsDBImport(cohort, gvcfs, intervals=intervals, shard=shard_i))
+            continue
+        existing = set(store.sample_names)
+        added = [gvcf for gvcf in gvcfs if gvcf.sample_name not in existing]
+        log.info("%s shard %d: %d samples in store, %d added", cohort, shard_i, len(existing), len(added))
+        stores.append(GenomicsDBUpdate(store, added) if added else store)
+    return stores
+
+
+def register_stores(stores, jobs=16):
+    """add the stores which are built to the registries of their shards"""
+    def _register(store):
+        if not store.exists():
+            return False
+        url = registry_url(store, store.cohort, store.shard)
+        records = read_registry(url)
+        if any(record['cid'] == store.canonical_id for record in records):
+            return False
+        records.append({
+            'cid': store.canonical_id,
+            'prefix': store.output_prefix(),
+            'intervals': store.params['intervals'],
+            'chain': store_chain(store)
+        })
+        write_registry(url, records)
+        return True
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        registered = sum(executor.map(_register, stores))
+    log.info("registered %d new cohort stores", registered)
+    return registered
+
+
+#
+# consistency of joint calls
+#
+
+def read_genotypes(path):
+    """(sample names, {(chrom, pos, ref, alt): {sample: gt}}) of a vcf"""
+    opener = gzip.open if path.endswith(".gz") else open
+    samples, records = [], {}
+    with opener(path, "rt") as infd:
+        for line in infd:
+            if line.startswith("##"):
+                continue
+            toks = line.rstrip("\n").split("\t")
+            if line.startswith("#"):
+                samples = toks[9:]
+                continue
+            fmt = toks[8].split(":") if len(toks) > 8 else []
+            gt_i = fmt.index("GT") if "GT" in fmt else None
+            gts = {}
+            for sample, value in zip(samples, toks[9:]):
+                gts[sample] = value.split(":")[gt_i] if gt_i is not None else "."
+            records[(toks[0], int(toks[1]), toks[3], toks[4])] = gts
+    return samples, records
+
+
+def compare_vcfs(path_a, path_b):
+    """differences between the sites and genotypes of two vcfs, regardless of sample order"""
+    samples_a, records_a = read_genotypes(path_a)
+    samples_b, records_b = read_genotypes(path_b)
+    diffs = []
+    if set(samples_a) != set(samples_b):
+        diffs.append("samples differ: %s" % (", ".join(sorted(set(samples_a) ^ set(samples_b))),))
+    for key in sorted(set(records_a) | set(records_b)):
+        site = "%s:%d %s>%s" % key
+        if key not in records_b:
+            diffs.append("%s: only in %s" % (site, path_a))
+        elif key not in records_a:
+            diffs.append("%s: only in %s" % (site, path_b))
+        else:
+            gts_a, gts_b = records_a[key], records_b[key]
+            for sample in sorted(set(gts_a) & set(gts_b)):
+                if gts_a[sample] != gts_b[sample]:
+                    diffs.append("%s: %s is %s and %s" % (site, sample, gts_a[sample], gts_b[sample]))
+    return diffs, len(records_a)
+
+
+def main(argv=None):
+    from . import setup_logging
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="python -m variants vcf-compare", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("vcfs", metavar="VCF", nargs=2, help="joint calls to compare")
+    parser.add_argument("--max-diffs", metavar="N", type=int, default=20, dest="max_diffs",
+                        help="differences to print (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    diffs, num_sites = compare_vcfs(args.vcfs[0], args.vcfs[1])
+    for diff in diffs[:args.max_diffs]:
+        print(diff)
+    if len(diffs) > args.max_diffs:
+        print("... %d more" % (len(diffs) - args.max_diffs,))
+    print("# %d sites, %d differences" % (num_sites, len(diffs)))
+    return 1 if diffs else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
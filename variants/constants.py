@@ -5,3 +5,12 @@ KIND_PREFIX = "variants."
 
 # Valid sample name
 SAMPLE_NAME_RE = re.compile("^[a-zA-Z0-9._-]+$")
+
+# formats of aligned reads. cram is compressed against the reference.
+OUTPUT_FORMATS = ("bam", "cram")
+
+# name of the result document a pack writes in each member's output prefix
+PACKED_RESULT = "packed-result.json"
+
+# suffixes of the files the jobs write last. an output prefix which holds one is complete.
+COMPLETION_MARKERS = (PACKED_RESULT, ".timings.json")
@@ -0,0 +1,185 @@
+"""
+Windowed depth of coverage arrays.
+
+The depth of a sample is stored as two files:
+
+  SAMPLE.depth.npy   -- mean depth of each window, all contigs end to end
+  SAMPLE.depth.json  -- the index: window size, and the length and offset
+                        of each contig in the array
+
+Windows are fixed-size and start at 0 on each contig. The last window of
+a contig is shorter. All samples aligned against the same reference with
+the same window size share the same layout, so their arrays line up and
+can be sliced together:
+
+    matrix = DepthMatrix.load(urls, cache=RemoteCache())
+    depths = matrix.region("Ha412HOChr01", 1000000, 2000000)  # samples x windows
+    means = matrix.region_means("Ha412HOChr01", 1000000, 2000000)
+"""
+
+import json
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+DEPTH_VERSION = 1
+# float16 tops out at 65504, below the depth of repeats and organelles
+DEPTH_DTYPE = "float32"
+DEFAULT_WINDOW = 1000
+
+INDEX_SUFFIX = ".json"
+
+
+class DepthIndex(object):
+    """layout of the windows of a depth array"""
+    __slots__ = ("window", "contigs", "attrs")
+
+    def __init__(self, window, contigs, attrs=None):
+        """contigs=[(name, length), ...] in array order"""
+        self.window = int(window)
+        self.contigs = OrderedDict()
+        offset = 0
+        for name, length in contigs:
+            num_windows = (length + self.window - 1) // self.window
+            self.contigs[name] = (length, offset, num_windows)
+            offset += num_windows
+        self.attrs = dict(attrs or {})
+
+    @property
+    def num_windows(self):
+        if not self.contigs:
+            return 0
+        length, offset, num_windows = next(reversed(self.contigs.values()))
+        return offset + num_windows
+
+    def intervals(self):
+        """the (contig, start, end) of every window, in array order"""
+        for name, (length, offset, num_windows) in self.contigs.items():
+            for i in range(num_windows):
+                yield (name, i * self.window, min((i + 1) * self.window, length))
+
+    def window_lengths(self):
+        lengths = np.full(self.num_windows, self.window, dtype=np.int64)
+        for name, (length, offset, num_windows) in self.contigs.items():
+            lengths[offset + num_windows - 1] = length - (num_windows - 1) * self.window
+        return lengths
+
+    def slice(self, contig, start=0, end=None):
+        """the slice of the array covering the windows which overlap contig:start-end"""
+        length, offset, num_windows = self.contigs[contig]
+        end = length if end is None else min(end, length)
+        if start >= end:
+            return slice(offset, offset)
+        return slice(offset + start // self.window, offset + (end + self.window - 1) // self.window)
+
+    def same_layout(self, other):
+        return self.window == other.window and list(self.contigs.items()) == list(other.contigs.items())
+
+    def to_dict(self):
+        return {
+            "version": DEPTH_VERSION,
+            "window": self.window,
+            "dtype": DEPTH_DTYPE,
+            "contigs": [[name, length, offset] for name, (length, offset, _) in self.contigs.items()],
+            "attrs": self.attrs,
+        }
+
+    @classmethod
+    def from_dict(cls, doc):
+        if doc.get("version") != DEPTH_VERSION:
+            raise ValueError("unsupported depth index version: %r" % (doc.get("version"),))
+        return cls(doc["window"], [(name, length) for name, length, _ in doc["contigs"]], doc.get("attrs"))
+
+
+def index_url(depth_url):
+    """the index of the depth array at depth_url"""
+    if not depth_url.endswith(".npy"):
+        raise ValueError("not a depth array: %s" % (depth_url,))
+    return depth_url[:-len(".npy")] + INDEX_SUFFIX
+
+
+def write_depth(path, index, depths):
+    """write the array at path (.npy), and its index next to it"""
+    depths = np.asarray(depths)
+    if depths.shape != (index.num_windows,):
+        raise ValueError("expected %d windows, got %s" % (index.num_windows, depths.shape))
+    np.save(path, depths.astype(DEPTH_DTYPE))
+    with open(index_url(path), "w") as index_fd:
+        json.dump(index.to_dict(), index_fd, sort_keys=True)
+    return path, index_url(path)
+
+
+def load_depth(url, cache=None, mmap=True):
+    """
+    (DepthIndex, array) of the depth array at url. remote arrays are
+    fetched through cache, a RemoteCache, and mapped from the local copy.
+    """
+    if cache is not None:
+        index = DepthIndex.from_dict(json.loads(cache.read_text(index_url(url))))
+        path = cache.local_path(url)
+    else:
+        with open(index_url(url), "r") as index_fd:
+            index = DepthIndex.from_dict(json.load(index_fd))
+        path = url
+    depths = np.load(path, mmap_mode="r" if mmap else None)
+    if depths.shape != (index.num_windows,):
+        raise ValueError("%s has %s windows, its index %d" % (url, depths.shape, index.num_windows))
+    return index, depths
+
+
+class DepthMatrix(object):
+    """
+    depth arrays of many samples with the same layout. the arrays stay
+    memory-mapped. slices are gathered into samples x windows arrays.
+    """
+    def __init__(self, index, arrays, names=None):
+        self.index = index
+        self.arrays = list(arrays)
+        self.names = list(names) if names is not None else list(range(len(self.arrays)))
+
+    @classmethod
+    def load(cls, urls, names=None, cache=None):
+        loaded = cache.map(lambda url: load_depth(url, cache), urls) if cache is not None else \
+            [load_depth(url) for url in urls]
+        if not loaded:
+            raise ValueError("no depth arrays to load")
+        index = loaded[0][0]
+        for url, (other, _) in zip(urls, loaded):
+            if not index.same_layout(other):
+                raise ValueError("%s does not have the layout of %s" % (url, urls[0]))
+        return cls(index, [depths for _, depths in loaded], names if names is not None else urls)
+
+    def region(self, contig, start=0, end=None, dtype=np.float32):
+        """samples x windows array of the windows overlapping contig:start-end"""
+        window_slice = self.index.slice(contig, start, end)
+        out = np.empty((len(self.arrays), window_slice.stop - window_slice.start), dtype=dtype)
+        for i, depths in enumerate(self.arrays):
+            out[i] = depths[window_slice]
+        return out
+
+    def region_means(self, contig, start=0, end=None):
+        """mean depth of each sample over contig:start-end, weighted by window length"""
+        window_slice = self.index.slice(contig, start, end)
+        weights = self.index.window_lengths()[window_slice]
+        if not weights.sum():
+            return np.zeros(len(self.arrays))
+        return self.region(contig, start, end, dtype=np.float64).dot(weights) / weights.sum()
+
+    def sample_means(self, chunk_windows=1 << 20):
+        """genome-wide mean depth of each sample, weighted by window length"""
+        weights = self.index.window_lengths()
+        totals = np.zeros(len(self.arrays))
+        for start in range(0, self.index.num_windows, chunk_windows):
+            chunk_weights = weights[start:start + chunk_windows]
+            for i, depths in enumerate(self.arrays):
+                totals[i] += np.dot(depths[start:start + chunk_windows].astype(np.float64), chunk_weights)
+        return totals / weights.sum()
+
+    def normalized(self, contig, start=0, end=None):
+        """depths of the region divided by each sample's genome-wide mean"""
+        means = self.sample_means()
+        means[means == 0] = np.nan
+        return self.region(contig, start, end) / means[:, np.newaxis].astype(np.float32)
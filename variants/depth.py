@@ -0,0 +1,195 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+
+from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+from .coverage import DEFAULT_WINDOW
+
+log = logging.getLogger(__name__)
+
+
+class Depth(bunnies.Transform):
+    """
+    Windowed depth of coverage of a merged sample.
+    """
+    DEPTH_IMAGE = "rieseberglab/analytics:7-2.5.8"
+    VERSION = "2"
+
+    __slots__ = ("sample_name", "sample_bam")
+    kind = KIND_PREFIX + "Depth"
+
+    def __init__(self, sample_bam=None, window=DEFAULT_WINDOW, min_mapq=20, manifest=None):
+        """
+        window=size of the windows, in bases
+        min_mapq=reads with a lower mapping quality are not counted
+        """
+        super().__init__("depth", version=self.VERSION, image=self.DEPTH_IMAGE)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            sample_bam = inputs['sample_bam'].node
+            window = params['window']
+            min_mapq = params['min_mapq']
+
+        if not sample_bam:
+            raise ValueError("depth requires 1 merged bam input")
+        if window < 1:
+            raise ValueError("window must be 1 or more bases")
+
+        sample_name = sample_bam.sample_name
+        if not SAMPLE_NAME_RE.match(sample_name):
+            raise ValueError("sample name %r does not match %s" % (
+                sample_name, SAMPLE_NAME_RE.pattern))
+
+        self.sample_name = self.params["sample_name"] = sample_name
+        self.params["window"] = int(window)
+        self.params["min_mapq"] = int(min_mapq)
+        self.sample_bam = sample_bam
+        self.add_input("sample_bam", sample_bam, desc="merged reads for sample %s" % (sample_name,))
+
+    @property
+    def ref(self):
+        return self.sample_bam.ref
+
+    @property
+    def ref_idx(self):
+        return self.sample_bam.ref_idx
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("Depth tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.DEPTH_IMAGE
+        }
+
+    def task_resources(self, attempt=1, **kwargs):
+        bam_target = self.sample_bam.ls()
+        gbs = bam_target['bam']['size'] / (1024 * 1024 * 1024)
+        if bam_target.get('format') == "cram":
+            gbs *= 2
+
+        log.info("depth of %s: %5.3f gbs of input data", self.params['sample_name'], gbs)
+        return {
+            'vcpus': 8,
+            'memory': 8000 * attempt,
+            'timeout': max(int(gbs*(5*60)), 3600)  # 5m per gb (min 1h)
+        }
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import os
+        import os.path
+        import sys
+        import numpy as np
+        from concurrent.futures import ThreadPoolExecutor
+        from .coverage import DepthIndex, write_depth, index_url
+        from .intervals import write_bed
+        from .references import parse_fai
+        from .refcache import cache_reference
+        from .timing import Timings
+
+        workdir = params['workdir']
+        timings = Timings(self.name, self.sample_name, vcpus=resources['vcpus'], memory=resources['memory'],
+                          window=self.params['window'])
+
+        s3_output_prefix = self.output_prefix()
+        local_input_dir = os.path.join(workdir, "input")
+        local_output_dir = os.path.join(workdir, "output")
+        os.makedirs(local_output_dir, exist_ok=True)
+        os.makedirs(local_input_dir, exist_ok=True)
+
+        bam_target = self.sample_bam.ls()
+        is_cram = bam_target.get('format') == "cram"
+        with timings.span("reference") as span:
+            # crams decode against the reference
+            ref_path, ref_idx_path = cache_reference(self, span=span, with_fasta=is_cram)
+
+        bam_path = os.path.join(local_input_dir, os.path.basename(bam_target['bam']['url']))
+        bai_path = os.path.join(local_input_dir, os.path.basename(bam_target['bai']['url']))
+        with timings.span("download") as span:
+            bunnies.transfers.s3_download_file(bam_target['bam']['url'], bam_path)
+            bunnies.transfers.s3_download_file(bam_target['bai']['url'], bai_path)
+            span.add_file(bam_path)
+
+        with open(ref_idx_path, "r") as fai_fd:
+            index = DepthIndex(self.params['window'], parse_fai(fai_fd.read()),
+                               attrs={'sample_name': self.sample_name, 'min_mapq': self.params['min_mapq'],
+                                      'bam': bam_target['bam']['url']})
+        windows = list(index.intervals())
+
+        # consecutive runs of windows, covered by one bedcov each. bedcov visits
+        # the windows of its bed in order, so each piece is a sequential read
+        # of its part of the bam.
+        num_pieces = min(len(windows), resources['vcpus'] * 4)
+        bounds = [len(windows) * i // num_pieces for i in range(num_pieces + 1)]
+        sums = np.zeros(len(windows), dtype=np.int64)
+
+        def _bedcov(piece):
+            start, end = bounds[piece], bounds[piece + 1]
+            bed_path = os.path.join(workdir, "windows.%04d.bed" % (piece,))
+            write_bed(bed_path, windows[start:end])
+            bedcov_args = ["samtools", "bedcov", "-j", "-Q", str(self.params['min_mapq'])]
+            if ref_path:
+                bedcov_args += ["--reference", ref_path]
+            out = bunnies.run_cmd(bedcov_args + [bed_path, bam_path], stderr=sys.stderr).stdout
+            # chrom, start, end, sum of depths
+            piece_sums = [int(line.rsplit(b"\t", 1)[1]) for line in out.splitlines() if line]
+            if len(piece_sums) != end - start:
+                raise Exception("bedcov returned %d windows out of %d" % (len(piece_sums), end - start))
+            sums[start:end] = piece_sums
+            os.unlink(bed_path)
+
+        with timings.span("bedcov", pieces=num_pieces) as span:
+            with ThreadPoolExecutor(max_workers=resources['vcpus']) as executor:
+                list(executor.map(_bedcov, range(num_pieces)))
+            span.add_file(bam_path)
+
+        pfx = self.sample_name
+        depth_path = os.path.join(local_output_dir, pfx + ".depth.npy")
+        write_depth(depth_path, index, sums / index.window_lengths())
+
+        with timings.span("upload") as span:
+            for path in (depth_path, index_url(depth_path)):
+                bunnies.transfers.s3_upload_file(path, os.path.join(s3_output_prefix, os.path.basename(path)))
+                span.add_file(path)
+        timings.write(os.path.join(local_output_dir, pfx + ".timings.json"))
+        bunnies.transfers.s3_upload_file(os.path.join(local_output_dir, pfx + ".timings.json"),
+                                         os.path.join(s3_output_prefix, pfx + ".timings.json"))
+
+        def _check_output_file(fname, is_optional=False):
+            try:
+                output_url = os.path.join(s3_output_prefix, fname)
+                meta = bunnies.get_blob_meta(output_url)
+                return {
+                    "size": meta['ContentLength'],
+                    "url": output_url,
+                    "etag": meta['ETag']
+                }
+            except FileNotFoundError:
+                if is_optional:
+                    return None
+                raise Exception("missing file: " + output_url)
+
+        return {
+            "depth":       _check_output_file(pfx + ".depth.npy"),
+            "depth_index": _check_output_file(pfx + ".depth.json"),
+            "timings":     _check_output_file(pfx + ".timings.json", True),
+            "window":      self.params['window'],
+        }
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(sample_name)s-W%(window)d-%(cid)s/" % {
+            'name': self.name,
+            'repo': self.repo_path(write_url=write_url),
+            'version': self.version,
+            'sample_name': self.sample_name,
+            'window': self.params['window'],
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(Depth)
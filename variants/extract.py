@@ -0,0 +1,260 @@
+"""
+Extraction of small regions from the merged bams of a cohort.
+
+For each bam listed in the output tables, the index and header are read,
+and only the BGZF blocks holding records which overlap the regions are
+fetched, with ranged reads. Reads are made in fixed-size pages, which are
+cached locally: extracting the same or nearby regions again doesn't
+touch the network. All the requests of all the samples share one pool
+of --connections.
+
+Each region gets one bam holding the overlapping records of all the
+samples, with their read groups:
+
+  python -m variants extract greg59/greg59.merged.tsv \\
+      --regions marco-ann-regions/HaMYB111_region_HA412v2.bed --output-dir HaMYB111/
+
+Outputs are named REGION.REFERENCE.bam, where REGION is the name column
+of the bed, or contig_start_end. Crams are skipped.
+"""
+
+import os
+import os.path
+import sys
+import time
+import shutil
+import argparse
+import logging
+import subprocess
+
+from .bgzf import (BgzfWriter, MAX_BLOCK_SIZE, inflate_blocks, iter_records, parse_bai, parse_bam_header,
+                   record_span, split_voffset, BamHeader)
+from .remote import RemoteCache, DEFAULT_CACHE_DIR
+from .report import load_table, named_path, output_kind
+
+log = logging.getLogger(__name__)
+
+DEFAULT_PAGE_SIZE = 1024 * 1024
+
+
+def read_bed(path):
+    """[(name, contig, start, end)] of a bed file. unnamed regions are named contig_start_end"""
+    regions = []
+    with open(path, "r") as infd:
+        for line in infd:
+            line = line.strip()
+            if not line or line.startswith(("#", "track", "browser")):
+                continue
+            toks = line.split()
+            contig, start, end = toks[0], int(toks[1]), int(toks[2])
+            name = toks[3] if len(toks) > 3 else "%s_%d_%d" % (contig, start, end)
+            regions.append((name, contig, start, end))
+    return regions
+
+
+class RemoteBam(object):
+    """a bam and its index, read in cached pages"""
+    def __init__(self, cache, sample, reference, url, index_url, size, page_size=DEFAULT_PAGE_SIZE):
+        self.cache = cache
+        self.sample = sample
+        self.reference = reference
+        self.url = url
+        self.index_url = index_url
+        self.size = size
+        self.page_size = page_size
+        self.header = None
+        self.index = None
+
+    def pages(self, start, end):
+        """the (start, end) of the pages covering the bytes start-end"""
+        end = min(end, self.size)
+        first = start // self.page_size * self.page_size
+        return [(page, min(page + self.page_size, self.size)) for page in range(first, end, self.page_size)]
+
+    def read(self, start, end):
+        end = min(end, self.size)
+        data = b"".join(self.cache.read_bytes(self.url, page_start, page_end)
+                        for page_start, page_end in self.pages(start, end))
+        first = start // self.page_size * self.page_size
+        return data[start - first:end - first]
+
+    def open(self):
+        """read the index, and the header from the first pages"""
+        self.index = parse_bai(self.cache.read_bytes(self.index_url))
+        length = self.page_size
+        while True:
+            udata, _ = inflate_blocks(self.read(0, length))
+            try:
+                self.header, _ = parse_bam_header(udata)
+                return self
+            except EOFError:
+                if length >= self.size:
+                    raise
+                length *= 2
+
+    def byte_ranges(self, chunks):
+        """compressed byte ranges holding the chunks"""
+        return [(split_voffset(beg)[0], split_voffset(end)[0] + MAX_BLOCK_SIZE) for beg, end in chunks]
+
+    def records(self, chunks, refid, start, end):
+        """records of the chunks which overlap start-end on refid, as (pos, bytes)"""
+        found = []
+        for vbeg, vend in chunks:
+            cbeg, ubeg = split_voffset(vbeg)
+            cend, uend = split_voffset(vend)
+            udata, blocks = inflate_blocks(self.read(cbeg, cend + MAX_BLOCK_SIZE))
+            stop = len(udata)
+            for block_offset, block_ustart in blocks:
+                if cbeg + block_offset == cend:
+                    stop = block_ustart + uend
+                    break
+            for _, record in iter_records(udata, ubeg, stop):
+                rec_refid, rec_start, rec_end = record_span(record)
+                if rec_refid == refid and rec_start < end and rec_end > start:
+                    found.append((rec_start, record))
+        return found
+
+
+def open_bams(rows, cache, page_size=DEFAULT_PAGE_SIZE):
+    """RemoteBam of each merge output in rows. outputs without a bam are skipped."""
+    def _open(row):
+        if output_kind(row['url']) != "merge":
+            return None
+        bam_name = row['sample'] + ".bam"
+        listing = cache.list_prefix(row['url'], [bam_name + ".bai", row['sample'] + ".cram"])
+        if bam_name not in listing or bam_name + ".bai" not in listing:
+            if row['sample'] + ".cram" in listing:
+                log.warning("%s: crams are not supported. skipped.", row['url'])
+            else:
+                log.warning("%s: no indexed bam. skipped.", row['url'])
+            return None
+        return RemoteBam(cache, row['sample'], row['reference'], row['url'] + bam_name,
+                         row['url'] + bam_name + ".bai", listing[bam_name], page_size).open()
+    return [bam for bam in cache.map(_open, rows) if bam is not None]
+
+
+def merged_header(bams):
+    """header of a multi-sample slice: the sequences of the first, the read groups of all"""
+    lines = ["@HD\tVN:1.6\tSO:coordinate"]
+    lines += [line for line in bams[0].header.text.splitlines() if line.startswith("@SQ")]
+    seen = set()
+    for bam in bams:
+        for line in bam.header.text.splitlines():
+            if line.startswith("@RG") and line not in seen:
+                seen.add(line)
+                lines.append(line)
+    return BamHeader("\n".join(lines) + "\n", bams[0].header.references)
+
+
+def write_slice(path, header, records):
+    """write records [(pos, sample index, bytes)] sorted by position"""
+    records.sort(key=lambda rec: (rec[0], rec[1]))
+    with open(path + ".tmp", "wb") as outfd:
+        writer = BgzfWriter(outfd)
+        writer.write(header.encode())
+        for _, _, record in records:
+            writer.write(record)
+        writer.close()
+    os.rename(path + ".tmp", path)
+    if shutil.which("samtools"):
+        subprocess.check_call(["samtools", "index", path])
+
+
+def extract(bams, regions, cache, output_dir):
+    """
+    write the slices of regions [(name, contig, start, end)] of all bams.
+    returns per-slice stats, and the number of bytes of the pages read.
+    """
+    # what each bam needs, per region
+    plans = []
+    for bam in bams:
+        for regioni, (name, contig, start, end) in enumerate(regions):
+            refid = bam.header.refid(contig)
+            if refid is None:
+                continue
+            chunks = bam.index.chunks(refid, start, end)
+            plans.append((bam, regioni, refid, chunks))
+
+    # all the pages, fetched concurrently
+    pages = set()
+    for bam, _, _, chunks in plans:
+        for byte_start, byte_end in bam.byte_ranges(chunks):
+            pages.update((bam, page) for page in bam.pages(byte_start, byte_end))
+    pages = sorted(pages, key=lambda item: (item[0].url, item[1]))
+    cache.map(lambda item: cache.read_bytes(item[0].url, item[1][0], item[1][1]), pages)
+    page_bytes = sum(page_end - page_start for _, (page_start, page_end) in pages)
+
+    # decode, and group the records of each region by reference
+    decoded = cache.map(lambda plan: plan[0].records(plan[3], plan[2], regions[plan[1]][2], regions[plan[1]][3]),
+                        plans)
+    slices = {}
+    for (bam, regioni, _, _), records in zip(plans, decoded):
+        slices.setdefault((regioni, bam.reference), []).append((bam, records))
+
+    stats = []
+    for (regioni, reference), members in sorted(slices.items()):
+        name = regions[regioni][0]
+        layout = members[0][0].header.references
+        kept = [(bam, records) for bam, records in members if bam.header.references == layout]
+        for bam, _ in members:
+            if bam.header.references != layout:
+                log.warning("%s: sequences differ from the other %s bams. skipped.", bam.url, reference)
+        all_records = [(pos, samplei, record)
+                       for samplei, (_, records) in enumerate(kept) for pos, record in records]
+        path = os.path.join(output_dir, "%s.%s.bam" % (name, reference))
+        write_slice(path, merged_header([bam for bam, _ in kept]), all_records)
+        stats.append({"region": name, "reference": reference, "path": path, "samples": len(kept),
+                      "records": len(all_records), "bytes": os.stat(path).st_size})
+    return stats, page_bytes
+
+
+def main(argv=None):
+    from . import setup_logging
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="python -m variants extract", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tables", metavar="[SET=]TABLE", nargs="+", type=named_path,
+                        help="output table listing the merged bams")
+    parser.add_argument("--regions", metavar="BED", type=str, required=True,
+                        help="regions to extract")
+    parser.add_argument("--reference", metavar="REFNAME", dest="references", action="append", default=[],
+                        help="only the bams aligned against this reference. may be repeated (default: all)")
+    parser.add_argument("--output-dir", metavar="DIR", type=str, default=".", dest="output_dir",
+                        help="where to write the slices (default: %(default)s)")
+    parser.add_argument("--connections", metavar="N", type=int, default=32,
+                        help="concurrent requests (default: %(default)s)")
+    parser.add_argument("--page-kb", metavar="KB", type=int, default=DEFAULT_PAGE_SIZE // 1024, dest="page_kb",
+                        help="size of the cached reads (default: %(default)s)")
+    parser.add_argument("--cache", metavar="DIR", type=str, default=DEFAULT_CACHE_DIR,
+                        help="local cache of listings, indexes and pages (default: %(default)s)")
+    parser.add_argument("--refresh", action="store_true", default=False,
+                        help="ignore cached entries")
+    args = parser.parse_args(argv)
+
+    regions = read_bed(args.regions)
+    rows = []
+    for set_name, path in args.tables:
+        rows += [row for row in load_table(path, set_name)
+                 if not args.references or row['reference'] in args.references]
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    cache = RemoteCache(args.cache, refresh=args.refresh, jobs=args.connections)
+    start = time.time()
+    bams = open_bams(rows, cache, page_size=args.page_kb * 1024)
+    log.info("extracting %d regions from %d bams", len(regions), len(bams))
+    stats, page_bytes = extract(bams, regions, cache, args.output_dir)
+    elapsed = time.time() - start
+
+    print("\t".join(["REGION", "REFERENCE", "SAMPLES", "RECORDS", "BYTES", "PATH"]))
+    for stat in stats:
+        print("\t".join([stat['region'], stat['reference'], str(stat['samples']), str(stat['records']),
+                         str(stat['bytes']), stat['path']]))
+    print("# %d bams, %.1f MB of pages in %.1fs (%.1f MB/s). cache: %d hits, %d misses" % (
+        len(bams), page_bytes / 1048576.0, elapsed, page_bytes / 1048576.0 / elapsed if elapsed else 0.0,
+        cache.hits, cache.misses))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
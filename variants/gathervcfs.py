@@ -0,0 +1,134 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+
+from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+
+log = logging.getLogger(__name__)
+
+
+class GatherVcfs(bunnies.Transform):
+    """
+    Concatenate the per-shard vcfs of a cohort into a single indexed vcf.
+    Shards are gathered in the order provided, which must be genome order.
+    """
+    GATHER_IMAGE = "rieseberglab/analytics:9-3.0.0"
+    VERSION = "1"
+
+    __slots__ = ("cohort",)
+    kind = KIND_PREFIX + "GatherVcfs"
+
+    def __init__(self, cohort=None, shard_vcfs=None, manifest=None):
+        super().__init__("gathervcfs", version=self.VERSION, image=self.GATHER_IMAGE, manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            cohort = params['cohort']
+            shard_vcfs = []
+            for i in range(0, params['num_shards']):
+                shard_vcfs.append(inputs[str(i)].node)
+
+        if not cohort or not SAMPLE_NAME_RE.match(cohort):
+            raise ValueError("cohort name %r does not match %s" % (cohort, SAMPLE_NAME_RE.pattern))
+        if not shard_vcfs:
+            raise ValueError("gathering requires 1 or more shard vcfs")
+
+        for i, shard_vcf in enumerate(shard_vcfs):
+            if shard_vcf.ref != shard_vcfs[0].ref:
+                raise ValueError("shard %d has a different reference than shard 0" % (i,))
+            self.add_input(str(i), shard_vcf, desc="shard #%d" % (i,))
+
+        self.cohort = self.params['cohort'] = cohort
+        self.params['num_shards'] = len(shard_vcfs)
+
+    @property
+    def sample_name(self):
+        return self.cohort
+
+    @property
+    def ref(self):
+        return self.inputs["0"].node.ref
+
+    @property
+    def ref_idx(self):
+        return self.inputs["0"].node.ref_idx
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("GatherVcfs tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.GATHER_IMAGE
+        }
+
+    def task_resources(self, attempt=1, **kwargs):
+        input_size = 0
+        for inputi, inputval in self.inputs.items():
+            input_size += inputval.ls()['vcf']['size']
+        gbs = float(input_size) / (1024*1024*1024)
+
+        log.info("gathering %d shards of %s: %5.3f gbs of input", self.params['num_shards'], self.cohort, gbs)
+
+        # mostly i/o. 5 min per gb (min 1h)
+        return {
+            'vcpus': 4,
+            'memory': 8 * 1024 * attempt,
+            'timeout': max(int(gbs*(5*60)), 3600) * attempt
+        }
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import os
+        import os.path
+        import sys
+
+        workdir = params['workdir']
+        s3_output_prefix = self.output_prefix()
+
+        local_input_dir = os.path.join(workdir, "input")
+        local_output_dir = os.path.join(workdir, "output")
+        os.makedirs(local_input_dir, exist_ok=True)
+        os.makedirs(local_output_dir, exist_ok=True)
+
+        shard_paths = []
+        for i in range(0, self.params['num_shards']):
+            vcf_url = self.inputs[str(i)].ls()['vcf']['url']
+            vcf_path = os.path.join(local_input_dir, os.path.basename(vcf_url))
+            bunnies.transfers.s3_download_file(vcf_url, vcf_path)
+            shard_paths.append(vcf_path)
+
+        pfx = self.cohort
+        output_vcf = os.path.join(local_output_dir, pfx + ".vcf.gz")
+        gather_args = ["gatk", "GatherVcfs", "-O", output_vcf]
+        for shard_path in shard_paths:
+            gather_args += ["-I", shard_path]
+        bunnies.run_cmd(gather_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+        bunnies.run_cmd(["tabix", "-p", "vcf", output_vcf], stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+
+        def _upload_output_file(fname):
+            inpath = os.path.join(local_output_dir, fname)
+            output_url = os.path.join(s3_output_prefix, fname)
+            st_size = os.stat(inpath).st_size
+            bunnies.transfers.s3_upload_file(inpath, output_url)
+            return {"size": st_size, "url": output_url}
+
+        output = {
+            "vcf": _upload_output_file(pfx + ".vcf.gz"),
+            "vcf_idx": _upload_output_file(pfx + ".vcf.gz.tbi")
+        }
+        return output
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(cohort)s-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'cohort': self.params['cohort'],
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(GatherVcfs)
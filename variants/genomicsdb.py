@@ -0,0 +1,211 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+
+from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+
+log = logging.getLogger(__name__)
+
+
+def slice_gvcfs(gvcfs, regions, input_dir, workdir, jobs):
+    """
+    only the records of the shard are needed. slice them out of each gvcf
+    with ranged reads, instead of downloading whole files.
+    returns [(sample name, path of the slice)]
+    """
+    import os.path
+    import shlex
+    from concurrent.futures import ThreadPoolExecutor
+    from .remote import htslib_url
+
+    def _slice(gvcf):
+        target = gvcf.ls()
+        if not target.get('gvcf') or not target.get('gvcf_idx'):
+            raise Exception("%s has no indexed gvcf" % (gvcf.sample_name,))
+        src = htslib_url(target['gvcf']['url'], target['gvcf_idx']['url'])
+        dest = os.path.join(input_dir, "%s.g.vcf.gz" % (gvcf.sample_name,))
+        cmd = "tabix -h %s %s | bgzip -c > %s && tabix -p vcf %s" % (
+            shlex.quote(src), " ".join(shlex.quote(r) for r in regions), shlex.quote(dest), shlex.quote(dest))
+        bunnies.run_cmd(["bash", "-o", "pipefail", "-c", cmd], cwd=workdir)
+        return gvcf.sample_name, dest
+
+    log.info("slicing %d gvcfs over %d intervals...", len(gvcfs), len(regions))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        return list(executor.map(_slice, gvcfs))
+
+
+class GenomicsDBImport(bunnies.Transform):
+    """
+    Import the gvcfs of a cohort into a GenomicsDB workspace, over one
+    shard of the genome. The workspace is published as a tarball.
+    """
+    GENOMICSDB_IMAGE = "rieseberglab/analytics:9-3.0.0"
+    VERSION = "1"
+
+    __slots__ = ("cohort", "shard")
+    kind = KIND_PREFIX + "GenomicsDBImport"
+
+    def __init__(self, cohort=None, gvcfs=None, intervals=None, shard=None, manifest=None):
+        """
+        cohort=name of the cohort (appears in the output prefix)
+        gvcfs=[ list of Genotype nodes, one per sample ]
+        intervals=[ (contig, start, end) ... ] bed intervals covered by this shard
+        shard=index of the shard in the genome
+        """
+        super().__init__("genomicsdb", version=self.VERSION, image=self.GENOMICSDB_IMAGE, manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            cohort = params['cohort']
+            shard = params['shard']
+            intervals = params['intervals']
+            gvcfs = []
+            for i in range(0, params['num_gvcfs']):
+                gvcfs.append(inputs[str(i)].node)
+
+        if not cohort or not SAMPLE_NAME_RE.match(cohort):
+            raise ValueError("cohort name %r does not match %s" % (cohort, SAMPLE_NAME_RE.pattern))
+        if not gvcfs:
+            raise ValueError("import requires 1 or more gvcf inputs")
+        if not intervals:
+            raise ValueError("import requires a list of intervals")
+        if shard is None:
+            raise ValueError("you must specify the shard index")
+
+        ref = None
+        sample_names = {}
+        for i, gvcf in enumerate(gvcfs):
+            if ref is None:
+                ref = gvcf.ref
+            elif gvcf.ref != ref:
+                raise ValueError("input %d has a different reference than input 0" % (i,))
+            if gvcf.sample_name in sample_names:
+                raise ValueError("inputs %d and %d have the same sample name %s" % (
+                    sample_names[gvcf.sample_name], i, gvcf.sample_name))
+            sample_names[gvcf.sample_name] = i
+            self.add_input(str(i), gvcf, desc="gvcf of sample %s" % (gvcf.sample_name,))
+
+        self.cohort = self.params['cohort'] = cohort
+        self.shard = self.params['shard'] = int(shard)
+        self.params['intervals'] = [[name, int(start), int(end)] for name, start, end in intervals]
+        self.params['num_gvcfs'] = len(gvcfs)
+
+    @property
+    def sample_name(self):
+        return self.cohort
+
+    @property
+    def gvcfs(self):
+        return [self.inputs[str(i)].node for i in range(self.params['num_gvcfs'])]
+
+    @property
+    def sample_names(self):
+        """the samples of the workspace, in import order"""
+        return [gvcf.sample_name for gvcf in self.gvcfs]
+
+    @property
+    def ref(self):
+        return self.inputs["0"].node.ref
+
+    @property
+    def ref_idx(self):
+        return self.inputs["0"].node.ref_idx
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("GenomicsDBImport tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.GENOMICSDB_IMAGE
+        }
+
+    def task_resources(self, attempt=1, **kwargs):
+        num_gvcfs = self.params['num_gvcfs']
+        mbp = sum(end - start for _, start, end in self.params['intervals']) / 1.0e6
+
+        # GenomicsDB memory is mostly native, outside the java heap.
+        # roughly 1m per sample per 10Mbp of shard.
+        return {
+            'vcpus': 8,
+            'memory': (32 * 1024) * attempt,
+            'timeout': max(int(num_gvcfs * mbp * 0.1 * 60), 3600) * attempt
+        }
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import os
+        import os.path
+        import sys
+        from .intervals import write_bed, region_strings
+
+        workdir = params['workdir']
+        s3_output_prefix = self.output_prefix()
+
+        local_input_dir = os.path.join(workdir, "input")
+        local_output_dir = os.path.join(workdir, "output")
+        os.makedirs(local_input_dir, exist_ok=True)
+        os.makedirs(local_output_dir, exist_ok=True)
+
+        pfx = "%s.shard%04d" % (self.cohort, self.shard)
+        bed_path = os.path.join(local_output_dir, pfx + ".bed")
+        write_bed(bed_path, self.params['intervals'])
+        regions = region_strings(self.params['intervals'])
+
+        num_threads = resources['vcpus']
+        memory_mb = resources['memory']
+        slices = slice_gvcfs(self.gvcfs, regions, local_input_dir, workdir, num_threads * 2)
+
+        sample_map = os.path.join(local_output_dir, pfx + ".sample_map")
+        with open(sample_map, "w") as map_fd:
+            for sample_name, path in slices:
+                map_fd.write("%s\t%s\n" % (sample_name, path))
+
+        # leave half the memory to the native GenomicsDB library
+        java_heap = "-Xmx%dm" % ((memory_mb - 200) // 2,)
+        workspace = os.path.join(workdir, pfx + ".genomicsdb")
+        import_args = [
+            "gatk", "--java-options", java_heap,
+            "GenomicsDBImport",
+            "--genomicsdb-workspace-path", workspace,
+            "--sample-name-map", sample_map,
+            "-L", bed_path,
+            "--merge-input-intervals",
+            "--batch-size", "50",
+            "--reader-threads", str(num_threads),
+            "--tmp-dir", workdir
+        ]
+        bunnies.run_cmd(import_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+
+        tarball = os.path.join(local_output_dir, pfx + ".genomicsdb.tar")
+        bunnies.run_cmd(["tar", "-cf", tarball, "-C", workdir, os.path.basename(workspace)],
+                        stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+
+        def _upload_output_file(fname):
+            inpath = os.path.join(local_output_dir, fname)
+            output_url = os.path.join(s3_output_prefix, fname)
+            st_size = os.stat(inpath).st_size
+            bunnies.transfers.s3_upload_file(inpath, output_url)
+            return {"size": st_size, "url": output_url}
+
+        output = {
+            "workspace": _upload_output_file(pfx + ".genomicsdb.tar"),
+            "intervals": _upload_output_file(pfx + ".bed"),
+            "sample_map": _upload_output_file(pfx + ".sample_map")
+        }
+        return output
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(cohort)s-shard%(shard)04d-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'cohort': self.params['cohort'],
+            'shard': self.params['shard'],
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(GenomicsDBImport)
@@ -0,0 +1,192 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+
+from .constants import KIND_PREFIX
+
+log = logging.getLogger(__name__)
+
+
+class GenomicsDBUpdate(bunnies.Transform):
+    """
+    Add the gvcfs of new samples to the GenomicsDB workspace of a shard
+    built earlier (by a GenomicsDBImport, or another update). The result
+    is published like the workspace of an import.
+    """
+    GENOMICSDB_IMAGE = "rieseberglab/analytics:9-3.0.0"
+    VERSION = "1"
+
+    __slots__ = ("base", "cohort", "shard")
+    kind = KIND_PREFIX + "GenomicsDBUpdate"
+
+    def __init__(self, base=None, gvcfs=None, manifest=None):
+        """
+        base=GenomicsDBImport or GenomicsDBUpdate node of the shard
+        gvcfs=[ list of Genotype nodes of the samples to add ]
+        """
+        super().__init__("genomicsdbupdate", version=self.VERSION, image=self.GENOMICSDB_IMAGE, manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            base = inputs['base'].node
+            gvcfs = []
+            for i in range(0, params['num_gvcfs']):
+                gvcfs.append(inputs[str(i)].node)
+
+        if not base:
+            raise ValueError("an update requires the workspace it updates")
+        if not gvcfs:
+            raise ValueError("an update requires 1 or more gvcf inputs")
+
+        existing = set(base.sample_names)
+        self.base = base
+        self.add_input("base", base, desc="workspace of shard %d" % (base.shard,))
+        for i, gvcf in enumerate(gvcfs):
+            if gvcf.ref != base.ref:
+                raise ValueError("input %d has a different reference than the workspace" % (i,))
+            if gvcf.sample_name in existing:
+                raise ValueError("sample %s is already in the workspace" % (gvcf.sample_name,))
+            existing.add(gvcf.sample_name)
+            self.add_input(str(i), gvcf, desc="gvcf of sample %s" % (gvcf.sample_name,))
+
+        self.cohort = self.params['cohort'] = base.cohort
+        self.shard = self.params['shard'] = base.shard
+        self.params['intervals'] = base.params['intervals']
+        self.params['num_gvcfs'] = len(gvcfs)
+
+    @property
+    def sample_name(self):
+        return self.cohort
+
+    @property
+    def intervals(self):
+        return self.params['intervals']
+
+    @property
+    def gvcfs(self):
+        return [self.inputs[str(i)].node for i in range(self.params['num_gvcfs'])]
+
+    @property
+    def sample_names(self):
+        """the samples of the workspace, in import order"""
+        return self.base.sample_names + [gvcf.sample_name for gvcf in self.gvcfs]
+
+    @property
+    def ref(self):
+        return self.base.ref
+
+    @property
+    def ref_idx(self):
+        return self.base.ref_idx
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("GenomicsDBUpdate tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.GENOMICSDB_IMAGE
+        }
+
+    def task_resources(self, attempt=1, **kwargs):
+        num_gvcfs = self.params['num_gvcfs']
+        mbp = sum(end - start for _, start, end in self.intervals) / 1.0e6
+        workspace_gbs = self.base.ls()['workspace']['size'] / (1024 * 1024 * 1024)
+
+        # same rate as an import for the new samples, plus moving the workspace
+        # in and out. 10m per gb of workspace.
+        return {
+            'vcpus': 8,
+            'memory': (32 * 1024) * attempt,
+            'timeout': max(int(num_gvcfs * mbp * 0.1 * 60 + workspace_gbs * 600), 3600) * attempt
+        }
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import os
+        import os.path
+        import sys
+        from .genomicsdb import slice_gvcfs
+        from .intervals import region_strings
+
+        workdir = params['workdir']
+        s3_output_prefix = self.output_prefix()
+
+        local_input_dir = os.path.join(workdir, "input")
+        local_output_dir = os.path.join(workdir, "output")
+        os.makedirs(local_input_dir, exist_ok=True)
+        os.makedirs(local_output_dir, exist_ok=True)
+
+        pfx = "%s.shard%04d" % (self.cohort, self.shard)
+        base_target = self.base.ls()
+        tarball = os.path.join(local_input_dir, os.path.basename(base_target['workspace']['url']))
+        bed_path = os.path.join(local_output_dir, pfx + ".bed")
+        base_map = os.path.join(local_input_dir, pfx + ".base.sample_map")
+        bunnies.transfers.s3_download_file(base_target['workspace']['url'], tarball)
+        bunnies.transfers.s3_download_file(base_target['intervals']['url'], bed_path)
+        bunnies.transfers.s3_download_file(base_target['sample_map']['url'], base_map)
+        bunnies.run_cmd(["tar", "-xf", tarball, "-C", workdir], stdout=sys.stdout, stderr=sys.stderr)
+        os.unlink(tarball)
+        workspace = os.path.join(workdir, pfx + ".genomicsdb")
+
+        num_threads = resources['vcpus']
+        memory_mb = resources['memory']
+        slices = slice_gvcfs(self.gvcfs, region_strings(self.intervals), local_input_dir, workdir,
+                             num_threads * 2)
+        new_map = os.path.join(local_input_dir, pfx + ".new.sample_map")
+        with open(new_map, "w") as map_fd:
+            for sample_name, path in slices:
+                map_fd.write("%s\t%s\n" % (sample_name, path))
+
+        # the intervals are those of the workspace
+        update_args = [
+            "gatk", "--java-options", "-Xmx%dm" % ((memory_mb - 200) // 2,),
+            "GenomicsDBImport",
+            "--genomicsdb-update-workspace-path", workspace,
+            "--sample-name-map", new_map,
+            "--batch-size", "50",
+            "--reader-threads", str(num_threads),
+            "--tmp-dir", workdir
+        ]
+        log.info("adding %d samples to the %d of %s", len(slices), len(self.base.sample_names), pfx)
+        bunnies.run_cmd(update_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+
+        sample_map = os.path.join(local_output_dir, pfx + ".sample_map")
+        with open(sample_map, "w") as map_fd:
+            with open(base_map, "r") as base_fd:
+                map_fd.write(base_fd.read())
+            with open(new_map, "r") as new_fd:
+                map_fd.write(new_fd.read())
+
+        tarball = os.path.join(local_output_dir, pfx + ".genomicsdb.tar")
+        bunnies.run_cmd(["tar", "-cf", tarball, "-C", workdir, os.path.basename(workspace)],
+                        stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+
+        def _upload_output_file(fname):
+            inpath = os.path.join(local_output_dir, fname)
+            output_url = os.path.join(s3_output_prefix, fname)
+            st_size = os.stat(inpath).st_size
+            bunnies.transfers.s3_upload_file(inpath, output_url)
+            return {"size": st_size, "url": output_url}
+
+        output = {
+            "workspace": _upload_output_file(pfx + ".genomicsdb.tar"),
+            "intervals": _upload_output_file(pfx + ".bed"),
+            "sample_map": _upload_output_file(pfx + ".sample_map")
+        }
+        return output
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(cohort)s-shard%(shard)04d-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'cohort': self.cohort,
+            'shard': self.shard,
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(GenomicsDBUpdate)
@@ -4,11 +4,12 @@ import logging
 import bunnies.config as config
 
 from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+from .packing import Packable
 
 log = logging.getLogger(__name__)
 
 
-class Genotype(bunnies.Transform):
+class Genotype(Packable, bunnies.Transform):
     """
     Call HaplotypeCaller on the input.
     """
@@ -86,6 +87,9 @@ class Genotype(bunnies.Transform):
 
         ref_size = ref_target['size']
         bam_size = bam_target['bam']['size']
+        if bam_target.get('format') == "cram":
+            # the work is in the reads. crams are about half the size of the same bam.
+            bam_size *= 2
         gbs = (ref_size + bam_size) / (1024 * 1024 * 1024)
 
         log.info("genotyping %s: %5.3f gbs of input data", self.params['sample_name'], gbs)
@@ -125,13 +129,17 @@ class Genotype(bunnies.Transform):
         import os
         import os.path
         import sys
-
-        def cache_remote_file(url, md5_digest, casdir):
-            return bunnies.run_cmd([
-                "cas", "-put", url, "-get", "md5:" + md5_digest, casdir
-            ]).stdout.decode('utf-8').strip()
+        import json
+        import time
+        import threading
+        from concurrent.futures import ThreadPoolExecutor
+        from .intervals import genome_intervals, split_intervals, write_bed
+        from .references import parse_fai
+        from .refcache import cache_reference
+        from .timing import Timings
 
         workdir = params['workdir']
+        timings = Timings(self.name, self.sample_name, vcpus=resources['vcpus'], memory=resources['memory'])
 
         s3_output_prefix = self.output_prefix()
 
@@ -141,17 +149,12 @@ class Genotype(bunnies.Transform):
         os.makedirs(local_output_dir, exist_ok=True)
         os.makedirs(local_input_dir, exist_ok=True)
 
-        cas_dir = "/localscratch/cas"
-        os.makedirs(cas_dir, exist_ok=True)
-
         #
         # download reference in scratch space shared with other jobs
         # in the same compute environment
         #
-        ref_target = self.ref.ls()
-        ref_idx_target = self.ref_idx.ls()
-        ref_path = cache_remote_file(ref_target['url'], ref_target['digests']['md5'], cas_dir)
-        _ = cache_remote_file(ref_idx_target['url'], ref_idx_target['digests']['md5'], cas_dir)
+        with timings.span("reference") as span:
+            ref_path, ref_idx_path = cache_reference(self, span=span)
         bam_target = self.sample_bam.ls()
 
         log.info("genotyping BAM sample %s: bam=%s (size=%5.3fGiB)...",
@@ -160,31 +163,168 @@ class Genotype(bunnies.Transform):
         # download the bai too
         bam_path = os.path.join(local_input_dir, os.path.basename(bam_target['bam']['url']))
         bai_path = os.path.join(local_input_dir, os.path.basename(bam_target['bai']['url']))
-        bunnies.transfers.s3_download_file(bam_target['bam']['url'], bam_path)
-        bunnies.transfers.s3_download_file(bam_target['bai']['url'], bai_path)
+        with timings.span("download") as span:
+            bunnies.transfers.s3_download_file(bam_target['bam']['url'], bam_path)
+            bunnies.transfers.s3_download_file(bam_target['bai']['url'], bai_path)
+            span.add_file(bam_path)
+            span.add_file(bai_path)
 
         num_threads = resources['vcpus']
         memory_mb = resources['memory']
 
         mb_per_worker = (memory_mb - 200) // num_threads
         java_heap = "-Xmx%dm" % (mb_per_worker,)
-        vc_args = [
-            "vc",
-            "-o", s3_output_prefix,
-            "-i", bam_path,
-            "-w", workdir,
-            "-r", ref_path,
-            "-n", str(num_threads),
-            "-minbp", "0",
-            "-nsegments", str(num_threads*5),
-            "-bgzip",
-            "-gatk4",
-            "-javaoptions", java_heap
-        ]
-        if self.params['hc_options']:
-            vc_args += ["-vcoptions", " ".join(self.params['hc_options'])]
-
-        bunnies.run_cmd(vc_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+        pfx = self.sample_name
+
+        #
+        # HaplotypeCaller runs over independent segments of the genome. Each
+        # finished segment is uploaded under segments/ and recorded in the
+        # segment manifest, so that a retry only runs the missing ones. The
+        # segmentation is fixed by the first attempt: later attempts may have
+        # a different number of vcpus.
+        #
+        # this is the scatter of the vc driver, which can't resume, with the
+        # same settings: -nsegments num_threads*5, -minbp 0 (every contig is
+        # genotyped, however short), -gatk4, -bgzip (bgzipped and indexed
+        # segments and output), hc_options passed to HaplotypeCaller and
+        # merge_options to the gather. the outputs are those of vc, so the
+        # version, and the gvcfs it made, are unchanged.
+        #
+        segments_dir = os.path.join(workdir, "segments")
+        os.makedirs(segments_dir, exist_ok=True)
+        segments_url = os.path.join(s3_output_prefix, "segments") + "/"
+        manifest_url = segments_url + pfx + ".segments.json"
+        manifest_path = os.path.join(segments_dir, pfx + ".segments.json")
+
+        manifest = None
+        try:
+            bunnies.utils.get_blob_meta(manifest_url)
+            bunnies.transfers.s3_download_file(manifest_url, manifest_path)
+            with open(manifest_path, "r") as manifest_fd:
+                manifest = json.load(manifest_fd)
+            if manifest.get('bam') != bam_target['bam']['url'] or \
+               manifest.get('hc_options') != self.params['hc_options']:
+                log.warning("segment manifest %s is for different inputs. ignoring it.", manifest_url)
+                manifest = None
+        except bunnies.exc.NoSuchFile:
+            pass
+
+        if manifest is None:
+            with open(ref_idx_path, "r") as fai_fd:
+                contigs = parse_fai(fai_fd.read())
+            pieces = split_intervals(genome_intervals(contigs), num_threads * 5)
+            manifest = {
+                'bam': bam_target['bam']['url'],
+                'hc_options': self.params['hc_options'],
+                'segments': [{
+                    'index': i,
+                    'intervals': [[name, start, end] for name, start, end in piece],
+                    'gvcf': segments_url + "%s.%04d.g.vcf.gz" % (pfx, i),
+                    'done': False
+                } for i, piece in enumerate(pieces)]
+            }
+
+        manifest_lock = threading.Lock()
+
+        def _save_manifest():
+            with manifest_lock:
+                with open(manifest_path + ".tmp", "w") as manifest_fd:
+                    json.dump(manifest, manifest_fd, indent=1, sort_keys=True)
+                os.rename(manifest_path + ".tmp", manifest_path)
+                bunnies.transfers.s3_upload_file(manifest_path, manifest_url)
+
+        def _segment_path(segment):
+            return os.path.join(segments_dir, os.path.basename(segment['gvcf']))
+
+        def _is_reusable(segment):
+            if not segment['done']:
+                return False
+            try:
+                bunnies.utils.get_blob_meta(segment['gvcf'])
+                bunnies.utils.get_blob_meta(segment['gvcf'] + ".tbi")
+                return True
+            except bunnies.exc.NoSuchFile:
+                return False
+
+        segments = manifest['segments']
+        reused = [segment for segment in segments if _is_reusable(segment)]
+        missing = [segment for segment in segments if segment not in reused]
+        log.info("genotyping %s: reusing %d of %d segments from previous attempts, running %d",
+                 pfx, len(reused), len(segments), len(missing))
+        _save_manifest()
+
+        scatter_log = []
+
+        def _run_segment(segment):
+            seg_path = _segment_path(segment)
+            bed_path = seg_path[:-len(".g.vcf.gz")] + ".bed"
+            write_bed(bed_path, segment['intervals'])
+            hc_args = [
+                "gatk", "--java-options", java_heap,
+                "HaplotypeCaller",
+                "-R", ref_path,
+                "-I", bam_path,
+                "-L", bed_path,
+                "-O", seg_path,
+                "-ERC", "GVCF",
+                "--native-pair-hmm-threads", "1"
+            ] + self.params['hc_options']
+            start = time.time()
+            with timings.span("haplotypecaller", segment=segment['index']):
+                bunnies.run_cmd(hc_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+            elapsed = time.time() - start
+            with timings.span("segment_upload", segment=segment['index']) as span:
+                bunnies.transfers.s3_upload_file(seg_path, segment['gvcf'])
+                bunnies.transfers.s3_upload_file(seg_path + ".tbi", segment['gvcf'] + ".tbi")
+                span.add_file(seg_path)
+            segment['done'] = True
+            _save_manifest()
+            scatter_log.append("segment %d done in %.1fs" % (segment['index'], elapsed))
+
+        def _fetch_segment(segment):
+            seg_path = _segment_path(segment)
+            with timings.span("segment_fetch", segment=segment['index']) as span:
+                bunnies.transfers.s3_download_file(segment['gvcf'], seg_path)
+                span.add_file(seg_path)
+            scatter_log.append("segment %d reused" % (segment['index'],))
+
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            fetches = [executor.submit(_fetch_segment, segment) for segment in reused]
+            for future in fetches:
+                future.result()
+            runs = [executor.submit(_run_segment, segment) for segment in missing]
+            for future in runs:
+                future.result()
+
+        # gather, in genome order
+        output_gvcf = os.path.join(local_output_dir, pfx + ".g.vcf.gz")
+        gather_args = ["gatk", "GatherVcfs", "-O", output_gvcf]
+        for segment in segments:
+            gather_args += ["-I", _segment_path(segment)]
+        gather_args += self.params['merge_options']
+        with timings.span("gather") as span:
+            bunnies.run_cmd(gather_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+            bunnies.run_cmd(["tabix", "-p", "vcf", output_gvcf], stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+            span.add_file(output_gvcf)
+
+        all_intervals = [interval for segment in segments for interval in segment['intervals']]
+        write_bed(os.path.join(local_output_dir, pfx + ".input.bed"), all_intervals)
+        with open(os.path.join(local_output_dir, pfx + ".scatter.bed"), "w") as scatter_fd:
+            for segment in segments:
+                for name, start, end in segment['intervals']:
+                    scatter_fd.write("%s\t%d\t%d\t%d\n" % (name, start, end, segment['index']))
+        with open(os.path.join(local_output_dir, pfx + ".scatter.log"), "w") as log_fd:
+            log_fd.write("reused %d of %d segments\n" % (len(reused), len(segments)))
+            log_fd.write("\n".join(scatter_log) + "\n")
+
+        with timings.span("upload") as span:
+            for fname in (".g.vcf.gz", ".g.vcf.gz.tbi", ".input.bed", ".scatter.bed", ".scatter.log"):
+                bunnies.transfers.s3_upload_file(os.path.join(local_output_dir, pfx + fname),
+                                                 os.path.join(s3_output_prefix, pfx + fname))
+                span.add_file(os.path.join(local_output_dir, pfx + fname))
+        timings.write(os.path.join(local_output_dir, pfx + ".timings.json"))
+        bunnies.transfers.s3_upload_file(os.path.join(local_output_dir, pfx + ".timings.json"),
+                                         os.path.join(s3_output_prefix, pfx + ".timings.json"))
         bunnies.run_cmd(["ls", "-lh",  local_output_dir], stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
 
         def _check_output_file(fname, is_optional=False):
@@ -201,13 +341,13 @@ class Genotype(bunnies.Transform):
                     return None
                 raise Exception("missing file: " + output_url)
 
-        pfx = self.sample_name
         output = {
             "gvcf":          _check_output_file(pfx + ".g.vcf.gz", True),
             "gvcf_idx":      _check_output_file(pfx + ".g.vcf.gz.tbi", True),
             "input_bed":     _check_output_file(pfx + ".input.bed", False),
             "output_bed":    _check_output_file(pfx + ".scatter.bed", True),
-            "scatter_log":   _check_output_file(pfx + ".scatter.log", True)
+            "scatter_log":   _check_output_file(pfx + ".scatter.log", True),
+            "timings":       _check_output_file(pfx + ".timings.json", True)
         }
         return output
 
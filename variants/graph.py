@@ -0,0 +1,158 @@
+"""
+Construction of the pipeline graph from a samples file.
+
+Each line of the samples file is one sequencing run:
+
+  {"sample_name": ..., "runid": ..., "r1": [url, {digests}], "r2": [url, {digests}] or null}
+
+Input files are shared: one InputFile per unique url and digests, however
+many runs or references use it. Runs are grouped by sample once, and the
+per-reference nodes are created from that grouping.
+"""
+
+import gc
+import json
+import logging
+import contextlib
+from collections import namedtuple, OrderedDict
+
+log = logging.getLogger(__name__)
+
+DIGEST_KEYS = ('md5', 'sha1', 'sha256')
+
+Run = namedtuple("Run", ["sample_name", "r1", "r2", "runid"])
+
+HC_OPTIONS = [
+    "-G", "StandardAnnotation",
+    "-G", "AS_StandardAnnotation",
+    "-G", "StandardHCAnnotation"
+]
+
+
+@contextlib.contextmanager
+def _gc_paused():
+    # the graph is millions of long-lived objects and no cycles worth
+    # collecting. collections triggered by the allocations only rescan them.
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+
+class InputFiles(object):
+    """one InputFile per (url, digests)"""
+    __slots__ = ("files",)
+
+    def __init__(self):
+        self.files = {}
+
+    def get(self, url, digests=None):
+        key = (url, tuple(sorted(digests.items())) if digests else ())
+        infile = self.files.get(key)
+        if infile is None:
+            from . import InputFile
+            infile = self.files[key] = InputFile(url, digests=digests)
+        return infile
+
+    def __len__(self):
+        return len(self.files)
+
+
+def _digests(entry):
+    return {k: v for k, v in (entry[1] or {}).items() if k in DIGEST_KEYS}
+
+
+def read_runs(infd, input_files=None):
+    """list of Run from the lines of a samples file"""
+    input_files = input_files if input_files is not None else InputFiles()
+    runs = []
+    with _gc_paused():
+        for line in infd:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            obj = json.loads(line)
+            r1, r2 = obj['r1'], obj['r2']
+            runs.append(Run(
+                sample_name=obj['sample_name'],
+                r1=input_files.get(r1[0], _digests(r1)),
+                r2=(input_files.get(r2[0], _digests(r2)) if r2 else None),
+                runid=obj['runid']
+            ))
+    log.info("read %d sequencing runs (%d unique input files)", len(runs), len(input_files))
+    return runs
+
+
+def runs_by_sample(runs):
+    """OrderedDict {sample name: [run index]}, in order of first appearance"""
+    by_sample = OrderedDict()
+    for runi, run in enumerate(runs):
+        by_sample.setdefault(run.sample_name, []).append(runi)
+    return by_sample
+
+
+class Graph(object):
+    """
+    nodes of the pipeline, by stage. merges and gvcfs are in the same
+    order: by reference, then by sample. bams and run_aligns are only
+    kept on request.
+    """
+    __slots__ = ("merges", "gvcfs", "bams", "run_aligns")
+
+    def __init__(self):
+        self.merges = []
+        self.gvcfs = []
+        self.bams = []
+        self.run_aligns = {}
+
+
+def build_graph(runs, references, output_format="bam", splits=None, keep_aligns=False):
+    """
+    the align, merge and genotype nodes of runs against each reference.
+    references={shortname: Reference}. splits={run index: SplitReads} are
+    aligned in chunks. keep_aligns keeps the alignment nodes in bams, and
+    the alignments of each unsplit run in run_aligns. output_format is the
+    format of the merges. the alignments are bams, encoded by the aligner.
+    """
+    splits = splits or {}
+    by_sample = runs_by_sample(runs)
+    graph = Graph()
+    with _gc_paused():
+        _add_nodes(graph, runs, by_sample, references, output_format, splits, keep_aligns)
+    return graph
+
+
+def _add_nodes(graph, runs, by_sample, references, output_format, splits, keep_aligns):
+    from . import Align, AlignChunk, Merge, Genotype
+
+    for refname, ref in references.items():
+        for sample_name, runis in by_sample.items():
+            sample_bams = []
+            for runi in runis:
+                if runi in splits:
+                    split = splits[runi]
+                    sample_bams += [AlignChunk(split, chunk, ref=ref.ref, ref_idx=ref.ref_idx, lossy=False)
+                                    for chunk in range(split.params['num_chunks'])]
+                    continue
+                run = runs[runi]
+                bam = Align(sample_name=run.sample_name,
+                            r1=run.r1,
+                            r2=run.r2,
+                            ref=ref.ref,
+                            ref_idx=ref.ref_idx,
+                            lossy=False)
+                sample_bams.append(bam)
+                if keep_aligns:
+                    graph.run_aligns.setdefault(runi, []).append(bam)
+            if keep_aligns:
+                graph.bams += sample_bams
+
+            # merge all the runs of that sample name in a single bam
+            merged = Merge(sample_name, sample_bams, output_format=output_format)
+            graph.merges.append(merged)
+
+            # call haplotypecaller
+            graph.gvcfs.append(Genotype(sample_name, merged, hc_options=HC_OPTIONS))
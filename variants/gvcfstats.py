@@ -0,0 +1,371 @@
+"""
+Summary statistics of the gvcfs of Genotype outputs.
+
+Each gvcf is read in parallel parts (see bgzf.iter_parts): compressed
+ranges are fetched concurrently, and their BGZF blocks inflated and
+parsed in a pool of threads. Records are parsed into column arrays, and
+summarised with numpy, per part:
+
+  records, ref_blocks      -- all records, and reference (<NON_REF> only) blocks
+  variants, snps, indels   -- records with an allele other than <NON_REF>
+  bed_bases, covered_bases -- bases of the input.bed intervals of the output,
+                              and how many are covered by a record
+  gq_median                -- median GQ of the records
+  gq20_frac                -- fraction of the covered bases with GQ >= 20
+  missing_contigs          -- contigs of input.bed without records
+
+Many gvcfs are summarised concurrently, each in its own process:
+
+  python -m variants gvcf-stats greg59/greg59.gvcf.tsv --output greg59/gvcf-stats.tsv
+  python -m variants gvcf-stats local/SAMPLE.g.vcf.gz
+"""
+
+import os.path
+import sys
+import time
+import argparse
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from .bgzf import iter_parts
+from .report import Frame, load_table, output_kind
+
+log = logging.getLogger(__name__)
+
+NON_REF = np.frombuffer(b"<NON_REF>", dtype=np.uint8)
+MAX_GQ = 99
+
+_TAB, _NL, _HASH, _COMMA, _COLON, _SEMI = 9, 10, 35, 44, 58, 59
+
+
+def _separators(buf, sep, starts):
+    """(positions of sep in buf, index in them of the first one at or after each of starts)"""
+    positions = np.flatnonzero(buf == sep)
+    return positions, np.searchsorted(positions, starts)
+
+
+def _nth(positions, first, n, limit):
+    """position of the n-th separator after first (per record), or limit if there is none before limit"""
+    idx = first + n
+    found = positions[np.minimum(idx, len(positions) - 1)] if len(positions) else limit
+    return np.where((idx < len(positions)) & (found < limit), found, limit)
+
+
+def _gather(buf, starts, ends, width=None):
+    """bytes [start, end) of each record, as rows of a zero-padded 2d array"""
+    lengths = ends - starts
+    width = int(lengths.max()) if width is None and len(lengths) else (width or 0)
+    cols = np.arange(max(width, 1))
+    idx = np.minimum(starts[:, None] + cols, len(buf) - 1)
+    return np.where(cols < lengths[:, None], buf[idx], 0).astype(np.uint8)
+
+
+def parse_ints(buf, starts, ends, missing=-1):
+    """decimal integers in [start, end) of buf. fields which aren't all digits get missing."""
+    lengths = ends - starts
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    width = min(int(lengths.max()), 18)
+    cols = np.arange(max(width, 1))
+    inside = cols < lengths[:, None]
+    digits = buf[np.minimum(starts[:, None] + cols, len(buf) - 1)].astype(np.int64) - 48
+    is_digit = (digits >= 0) & (digits <= 9)
+    powers = np.where(inside, 10 ** np.maximum(lengths[:, None] - 1 - cols, 0), 0)
+    values = (np.where(inside, digits, 0) * powers).sum(axis=1)
+    bad = (inside & ~is_digit).any(axis=1) | (lengths <= 0) | (lengths > width)
+    values[bad] = missing
+    return values
+
+
+def _unique_strings(buf, starts, ends):
+    """(distinct strings, index of each record's string in them)"""
+    if not len(starts):
+        return [], np.zeros(0, dtype=np.int64)
+    rows = np.ascontiguousarray(_gather(buf, starts, ends))
+    keys = rows.view(np.dtype((np.void, rows.shape[1]))).ravel()
+    uniq, inverse = np.unique(keys, return_inverse=True)
+    return [bytes(key).rstrip(b"\0").decode("ascii") for key in uniq], inverse.ravel()
+
+
+def parse_records(data):
+    """
+    column arrays of the vcf records in data (whole lines). header lines are
+    skipped. returns OrderedDict of contig (index into 'contigs'), start
+    (0-based), end, is_variant, is_snp, gq (-1 if missing), and 'contigs'.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    ends = np.flatnonzero(buf == _NL)
+    if len(buf) and (not len(ends) or ends[-1] != len(buf) - 1):
+        ends = np.append(ends, len(buf))
+    starts = np.concatenate(([0], ends[:-1] + 1)) if len(ends) else np.zeros(0, dtype=np.int64)
+    keep = ends > starts
+    keep[keep] = buf[starts[keep]] != _HASH
+    starts, ends = starts[keep], ends[keep]
+
+    tabs, first_tab = _separators(buf, _TAB, starts)
+    col = [starts] + [_nth(tabs, first_tab, i, ends) + 1 for i in range(9)]
+    col_end = [_nth(tabs, first_tab, i, ends) for i in range(10)]
+    valid = col_end[8] < ends
+    if not valid.all():
+        log.warning("skipping %d records with less than 10 columns", int((~valid).sum()))
+        col = [c[valid] for c in col]
+        col_end = [c[valid] for c in col_end]
+        ends = ends[valid]
+
+    contigs, contig = _unique_strings(buf, col[0], col_end[0])
+    pos = parse_ints(buf, col[1], col_end[1])
+    ref_len = col_end[3] - col[3]
+
+    # ALT: <NON_REF> alone marks a reference block
+    alt_len = col_end[4] - col[4]
+    is_variant = ~((alt_len == len(NON_REF)) &
+                   (_gather(buf, col[4], col_end[4], len(NON_REF)) == NON_REF).all(axis=1))
+    commas, first_comma = _separators(buf, _COMMA, col[4])
+    alt1_len = _nth(commas, first_comma, 0, col_end[4]) - col[4]
+    is_snp = is_variant & (ref_len == 1) & (alt1_len == 1)
+
+    # INFO: END=n of reference blocks
+    end = pos + ref_len - 1
+    has_end = (col_end[7] - col[7] > 4) & \
+        (_gather(buf, col[7], col[7] + 4, 4) == np.frombuffer(b"END=", dtype=np.uint8)).all(axis=1)
+    semis, first_semi = _separators(buf, _SEMI, col[7])
+    info_end = parse_ints(buf, col[7] + 4, _nth(semis, first_semi, 0, col_end[7]))
+    end = np.where(has_end & (info_end > 0), info_end, end)
+
+    # GQ: its position in the sample column depends on the FORMAT of the record
+    formats, format_idx = _unique_strings(buf, col[8], col_end[8])
+    colons, first_colon = _separators(buf, _COLON, col[9])
+    gq = np.full(len(pos), -1, dtype=np.int64)
+    sample_end = col_end[9]
+    for fi, fmt in enumerate(formats):
+        keys = fmt.split(":")
+        if "GQ" not in keys:
+            continue
+        k = keys.index("GQ")
+        sel = np.flatnonzero(format_idx == fi)
+        fstart = col[9][sel] if k == 0 else _nth(colons, first_colon[sel], k - 1, sample_end[sel]) + 1
+        fend = _nth(colons, first_colon[sel], k, sample_end[sel])
+        gq[sel] = parse_ints(buf, np.minimum(fstart, fend), fend)
+
+    columns = OrderedDict()
+    columns['contig'] = contig
+    columns['start'] = pos - 1
+    columns['end'] = end
+    columns['is_variant'] = is_variant
+    columns['is_snp'] = is_snp
+    columns['gq'] = gq
+    columns['contigs'] = contigs
+    return columns
+
+
+def merge_segments(starts, ends):
+    """union of sorted-by-start intervals, as (starts, ends)"""
+    if not len(starts):
+        return starts, ends
+    reach = np.maximum.accumulate(ends)
+    new = np.concatenate(([True], starts[1:] > reach[:-1]))
+    heads = np.flatnonzero(new)
+    return starts[heads], np.maximum.reduceat(ends, heads)
+
+
+class GvcfStats(object):
+    """statistics of the records of a gvcf, accumulated part by part"""
+    def __init__(self):
+        self.records = 0
+        self.variants = 0
+        self.snps = 0
+        self.gq_records = np.zeros(MAX_GQ + 1, dtype=np.int64)
+        self.gq_bases = np.zeros(MAX_GQ + 1, dtype=np.int64)
+        self.segments = {}
+
+    def add(self, columns):
+        n = len(columns['start'])
+        if not n:
+            return self
+        self.records += n
+        self.variants += int(columns['is_variant'].sum())
+        self.snps += int(columns['is_snp'].sum())
+        start, end = columns['start'], np.maximum(columns['end'], columns['start'] + 1)
+        gq = columns['gq']
+        known = gq >= 0
+        clipped = np.minimum(gq[known], MAX_GQ)
+        self.gq_records += np.bincount(clipped, minlength=MAX_GQ + 1)
+        self.gq_bases += np.bincount(clipped, weights=(end - start)[known], minlength=MAX_GQ + 1).astype(np.int64)
+        for ci, name in enumerate(columns['contigs']):
+            sel = columns['contig'] == ci
+            order = np.argsort(start[sel], kind="mergesort")
+            seg = merge_segments(start[sel][order], end[sel][order])
+            self.segments.setdefault(name, []).append(seg)
+        return self
+
+    def merge(self, other):
+        self.records += other.records
+        self.variants += other.variants
+        self.snps += other.snps
+        self.gq_records += other.gq_records
+        self.gq_bases += other.gq_bases
+        for name, segs in other.segments.items():
+            self.segments.setdefault(name, []).extend(segs)
+        return self
+
+    def covered(self, name):
+        """merged (starts, ends) of the records on contig name"""
+        segs = self.segments.get(name, [])
+        if not segs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        starts = np.concatenate([seg[0] for seg in segs])
+        ends = np.concatenate([seg[1] for seg in segs])
+        order = np.argsort(starts, kind="mergesort")
+        return merge_segments(starts[order], ends[order])
+
+    def summary(self, intervals=None):
+        """
+        summary row. intervals=[(contig, start, end)] the records should cover
+        (e.g. the input.bed of the output)
+        """
+        row = OrderedDict()
+        row['records'] = self.records
+        row['ref_blocks'] = self.records - self.variants
+        row['variants'] = self.variants
+        row['snps'] = self.snps
+        row['indels'] = self.variants - self.snps
+        bed_bases, covered_bases, missing = 0, 0, []
+        by_contig = OrderedDict()
+        for name, start, end in intervals or ():
+            by_contig.setdefault(name, []).append((start, end))
+        for name, spans in by_contig.items():
+            seg_starts, seg_ends = self.covered(name)
+            if not len(seg_starts):
+                missing.append(name)
+            for start, end in spans:
+                bed_bases += end - start
+                lo = np.searchsorted(seg_ends, start, side="right")
+                hi = np.searchsorted(seg_starts, end, side="left")
+                overlap = np.minimum(seg_ends[lo:hi], end) - np.maximum(seg_starts[lo:hi], start)
+                covered_bases += int(np.clip(overlap, 0, None).sum())
+        row['bed_bases'] = bed_bases
+        row['covered_bases'] = covered_bases
+        row['coverage'] = covered_bases / float(bed_bases) if bed_bases else np.nan
+        cumulative = np.cumsum(self.gq_records)
+        row['gq_median'] = int(np.searchsorted(cumulative, cumulative[-1] / 2.0)) if cumulative[-1] else -1
+        gq_bases = self.gq_bases.sum()
+        row['gq20_frac'] = self.gq_bases[20:].sum() / float(gq_bases) if gq_bases else np.nan
+        row['missing_contigs'] = len(missing)
+        row['missing'] = ",".join(missing[:5]) + (",..." if len(missing) > 5 else "")
+        return row
+
+
+def _summarise_part(udata):
+    """(first line, stats of the whole lines after it, trailing partial line, has newline)"""
+    first_nl = udata.find(b"\n")
+    if first_nl < 0:
+        return udata, None, b"", False
+    last_nl = udata.rfind(b"\n")
+    stats = GvcfStats().add(parse_records(udata[first_nl + 1:last_nl + 1]))
+    return udata[:first_nl + 1], stats, udata[last_nl + 1:], True
+
+
+def gvcf_stats(read_range, size, part_size=4*1024*1024, threads=4):
+    """GvcfStats of a bgzf-compressed gvcf"""
+    total = GvcfStats()
+    pending = b""
+    for head, stats, tail, has_newline in iter_parts(read_range, size, _summarise_part,
+                                                     part_size=part_size, jobs=threads):
+        if not has_newline:
+            pending += head
+            continue
+        # the line split between the previous part and this one
+        total.add(parse_records(pending + head))
+        total.merge(stats)
+        pending = tail
+    if pending:
+        total.add(parse_records(pending))
+    return total
+
+
+def summarise_gvcf(job):
+    """
+    summary row of one gvcf. job is a dict with 'gvcf' and optionally 'bed' (urls
+    or paths), and columns copied to the row. runs in a pool process.
+    """
+    from .intervals import read_bed
+    from .remote import read_bytes, object_size, RemoteCache
+    start = time.time()
+    size = object_size(job['gvcf'])
+    stats = gvcf_stats(lambda begin, end: read_bytes(job['gvcf'], begin, end), size,
+                       part_size=job.get('part_size', 4*1024*1024), threads=job.get('threads', 4))
+    intervals = None
+    if job.get('bed'):
+        intervals = read_bed(RemoteCache(job['cache']).local_path(job['bed']))
+    row = OrderedDict((key, job[key]) for key in ("set", "sample", "reference", "url") if key in job)
+    row.update(stats.summary(intervals))
+    elapsed = time.time() - start
+    row['seconds'] = elapsed
+    row['mb_per_s'] = size / 1048576.0 / elapsed if elapsed else np.nan
+    return row
+
+
+def _table_jobs(tables):
+    jobs = []
+    for set_name, path in tables:
+        if path.endswith(".g.vcf.gz"):
+            sample = os.path.basename(path)[:-len(".g.vcf.gz")]
+            bed = path[:-len(".g.vcf.gz")] + ".input.bed"
+            jobs.append({"set": set_name or "", "sample": sample, "reference": "", "url": path, "gvcf": path,
+                         "bed": bed if os.path.exists(bed) else None})
+            continue
+        for row in load_table(path, set_name):
+            if output_kind(row['url']) != "genotype":
+                continue
+            pfx = row['url'] + row['sample']
+            jobs.append({"set": row['set'], "sample": row['sample'], "reference": row['reference'],
+                         "url": row['url'], "gvcf": pfx + ".g.vcf.gz", "bed": pfx + ".input.bed"})
+    return jobs
+
+
+def main(argv=None):
+    from concurrent.futures import ProcessPoolExecutor
+    from . import setup_logging
+    from .remote import DEFAULT_CACHE_DIR
+    from .report import named_path
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="python -m variants gvcf-stats", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tables", metavar="[SET=]TABLE", nargs="+", type=named_path,
+                        help="table of genotype outputs, or a .g.vcf.gz (its .input.bed is used if present)")
+    parser.add_argument("--jobs", metavar="N", type=int, default=8,
+                        help="gvcfs summarised at once, each in a process (default: %(default)s)")
+    parser.add_argument("--threads", metavar="N", type=int, default=4,
+                        help="threads fetching and decoding each gvcf (default: %(default)s)")
+    parser.add_argument("--part-mb", metavar="MB", type=float, default=4.0, dest="part_mb",
+                        help="compressed bytes per part (default: %(default)s)")
+    parser.add_argument("--output", metavar="TSV", type=str, default=None,
+                        help="write to this file instead of stdout")
+    parser.add_argument("--cache", metavar="DIR", type=str, default=DEFAULT_CACHE_DIR,
+                        help="local cache of the input.bed files (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    jobs = _table_jobs(args.tables)
+    for job in jobs:
+        job.update(threads=args.threads, part_size=int(args.part_mb * 1024 * 1024), cache=args.cache)
+    log.info("summarising %d gvcfs...", len(jobs))
+    start = time.time()
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        rows = list(executor.map(summarise_gvcf, jobs))
+    log.info("%d gvcfs in %.1fs", len(rows), time.time() - start)
+
+    frame = Frame.from_records(rows, [(name, object if isinstance(value, str) else type(value))
+                                      for name, value in (rows[0].items() if rows else [])])
+    if args.output:
+        with open(args.output, "w") as outfd:
+            frame.write_tsv(outfd)
+    else:
+        frame.write_tsv(sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
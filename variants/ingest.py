@@ -0,0 +1,474 @@
+# -*- charset: utf-8; -*-
+
+"""
+Ingest SRA runs into the sequence bucket.
+
+Reads a list of runs on stdin (the output of scripts/sra-list.py):
+
+  PRJ SAMPLE SRR
+
+and moves each run through three bounded stages:
+
+  fetch     -- download the .sra into the local work directory
+  validate  -- check the archive and compute its md5
+  upload    -- copy the archive to the bucket and verify the remote size
+
+Each stage has its own worker count, and fetches are held back when
+the files already on local disk would exceed the disk budget. Completed
+runs are journaled in a state file, so an interrupted ingest picks up
+where it left off.
+"""
+
+import os
+import os.path
+import sys
+import json
+import time
+import shutil
+import hashlib
+import logging
+import argparse
+import threading
+import queue
+
+log = logging.getLogger(__package__)
+
+DST_PREFIX = "s3://rieseberg-fastq/sra/%(project)s/"
+
+# size assumed for a run before it is downloaded
+DEFAULT_ESTIMATE = 8 * 1024 * 1024 * 1024
+
+_STOP = object()
+
+
+class IngestItem(object):
+    """
+    One SRA run going through the ingestion stages
+    """
+    __slots__ = ("project", "sample", "run", "path", "size", "reserved", "digests", "url", "error")
+
+    def __init__(self, project, sample, run):
+        self.project = project
+        self.sample = sample
+        self.run = run
+        self.path = None
+        self.size = 0
+        self.reserved = 0
+        self.digests = {}
+        self.url = None
+        self.error = None
+
+
+class DiskBudget(object):
+    """
+    Blocks callers until the requested number of bytes fits on local disk.
+
+    A request larger than the whole budget is granted when nothing else
+    is reserved, so that a single large run cannot stall the ingest.
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.used = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, nbytes):
+        with self._cond:
+            while self.used > 0 and self.used + nbytes > self.max_bytes:
+                self._cond.wait()
+            self.used += nbytes
+            return nbytes
+
+    def adjust(self, old_bytes, new_bytes):
+        """replace a reservation with the actual size. never blocks."""
+        with self._cond:
+            self.used += new_bytes - old_bytes
+            self._cond.notify_all()
+            return new_bytes
+
+    def release(self, nbytes):
+        with self._cond:
+            self.used -= nbytes
+            self._cond.notify_all()
+
+
+class IngestState(object):
+    """
+    Append-only journal of completed runs. One json document per line:
+
+      {"run": SRR, "project": PRJ, "url": URL, "digests": {"md5": ...}, "size": N}
+    """
+    def __init__(self, path):
+        self.path = path
+        self.completed = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as infd:
+                for line in infd:
+                    line = line.strip()
+                    if not line or line.startswith("#"):
+                        continue
+                    record = json.loads(line)
+                    self.completed[record['run']] = record
+
+    def is_done(self, run):
+        return run in self.completed
+
+    def record(self, item):
+        record = {
+            "run": item.run,
+            "project": item.project,
+            "url": item.url,
+            "digests": item.digests,
+            "size": item.size
+        }
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self._lock:
+            with open(self.path, "a") as outfd:
+                outfd.write(line)
+                outfd.flush()
+                os.fsync(outfd.fileno())
+            self.completed[item.run] = record
+
+    def import_legacy_sums(self, sumsdir):
+        """
+        import the SRR.md5 marker files written by the former srr-upload.sh.
+        each contains a single line: URL md5:DIGEST
+        """
+        imported = 0
+        if not os.path.isdir(sumsdir):
+            return imported
+        for fname in sorted(os.listdir(sumsdir)):
+            if not fname.endswith(".md5"):
+                continue
+            run = fname[:-len(".md5")]
+            if self.is_done(run):
+                continue
+            with open(os.path.join(sumsdir, fname), "r") as infd:
+                toks = infd.read().split()
+            if len(toks) < 2 or ":" not in toks[1]:
+                log.warning("ignoring malformed marker file %s", fname)
+                continue
+            algo, digest = toks[1].split(":", maxsplit=1)
+            item = IngestItem(os.path.basename(os.path.dirname(toks[0])), None, run)
+            item.url = toks[0]
+            item.digests = {algo: digest}
+            self.record(item)
+            imported += 1
+        return imported
+
+
+def file_md5(path, blocksize=4*1024*1024):
+    md5 = hashlib.md5()
+    with open(path, "rb") as infd:
+        while True:
+            block = infd.read(blocksize)
+            if not block:
+                break
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class SRASource(object):
+    """
+    Fetches runs from NCBI with sra-tools
+    """
+    def __init__(self, estimate=DEFAULT_ESTIMATE):
+        self.estimate = estimate
+
+    def estimate_size(self, item):
+        return self.estimate
+
+    def fetch(self, item, destdir):
+        import bunnies
+        dest = os.path.join(destdir, item.run + ".sra")
+        bunnies.run_cmd(["prefetch", "--max-size", "500G", "--output-file", dest, item.run],
+                        stdout=sys.stderr, stderr=sys.stderr)
+        return dest
+
+    def validate(self, item):
+        import bunnies
+        bunnies.run_cmd(["vdb-validate", item.path], stdout=sys.stderr, stderr=sys.stderr)
+
+
+class LocalSource(object):
+    """
+    Stand-in for SRA. Serves RUN.sra files out of a local directory.
+    """
+    def __init__(self, srcdir):
+        self.srcdir = srcdir
+
+    def _path(self, item):
+        return os.path.join(self.srcdir, item.run + ".sra")
+
+    def estimate_size(self, item):
+        return os.stat(self._path(item)).st_size
+
+    def fetch(self, item, destdir):
+        dest = os.path.join(destdir, item.run + ".sra")
+        shutil.copyfile(self._path(item), dest)
+        return dest
+
+    def validate(self, item):
+        pass
+
+
+class S3Sink(object):
+    """
+    Uploads runs under DST_PREFIX and checks the size of the remote object
+    """
+    def __init__(self, dst_prefix=DST_PREFIX):
+        self.dst_prefix = dst_prefix
+
+    def upload(self, item):
+        import bunnies
+        url = (self.dst_prefix % {'project': item.project}) + os.path.basename(item.path)
+        bunnies.transfers.s3_upload_file(item.path, url)
+        meta = bunnies.utils.get_blob_meta(url)
+        if meta['ContentLength'] != item.size:
+            raise Exception("size mismatch after upload of %s: local=%d remote=%d" % (
+                url, item.size, meta['ContentLength']))
+        return url
+
+
+class LocalSink(object):
+    """
+    Stand-in for S3. Copies runs into DSTDIR/PRJ/RUN.sra
+    """
+    def __init__(self, dstdir):
+        self.dstdir = dstdir
+
+    def upload(self, item):
+        destdir = os.path.join(self.dstdir, item.project)
+        os.makedirs(destdir, exist_ok=True)
+        dest = os.path.join(destdir, os.path.basename(item.path))
+        shutil.copyfile(item.path, dest + ".tmp")
+        os.rename(dest + ".tmp", dest)
+        if os.stat(dest).st_size != item.size:
+            raise Exception("size mismatch after copy of %s" % (dest,))
+        return dest
+
+
+class StageStats(object):
+    """counters for one stage. busy is the sum of per-item processing times."""
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.items = 0
+        self.failed = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, nbytes, elapsed, failed=False):
+        with self._lock:
+            self.items += 1
+            self.bytes += nbytes
+            self.busy += elapsed
+            if failed:
+                self.failed += 1
+
+    def as_dict(self, wall):
+        return {
+            "stage": self.name,
+            "workers": self.workers,
+            "items": self.items,
+            "failed": self.failed,
+            "bytes": self.bytes,
+            "busy_seconds": round(self.busy, 3),
+            "utilization": round(self.busy / (wall * self.workers), 3) if wall > 0 else 0.0,
+            "mb_per_second": round(self.bytes / wall / (1024*1024), 3) if wall > 0 else 0.0
+        }
+
+
+class Ingest(object):
+    """
+    Runs items through the fetch, validate and upload stages
+    """
+    STAGES = ("fetch", "validate", "upload")
+
+    def __init__(self, source, sink, state, workdir, disk_budget,
+                 fetch_jobs=4, validate_jobs=2, upload_jobs=4):
+        self.source = source
+        self.sink = sink
+        self.state = state
+        self.workdir = workdir
+        self.budget = DiskBudget(disk_budget)
+        self.jobs = dict(zip(self.STAGES, (fetch_jobs, validate_jobs, upload_jobs)))
+        self.stats = {name: StageStats(name, self.jobs[name]) for name in self.STAGES}
+        self.failures = []
+        self._lock = threading.Lock()
+
+    def _fetch(self, item):
+        item.reserved = self.budget.acquire(self.source.estimate_size(item))
+        item.path = self.source.fetch(item, self.workdir)
+        item.size = os.stat(item.path).st_size
+        item.reserved = self.budget.adjust(item.reserved, item.size)
+        return item.size
+
+    def _validate(self, item):
+        self.source.validate(item)
+        item.digests = {"md5": file_md5(item.path)}
+        return item.size
+
+    def _upload(self, item):
+        item.url = self.sink.upload(item)
+        self.state.record(item)
+        self._cleanup(item)
+        log.info("ingested %s -> %s md5:%s", item.run, item.url, item.digests['md5'])
+        return item.size
+
+    def _cleanup(self, item):
+        if item.path and os.path.exists(item.path):
+            os.unlink(item.path)
+        if item.reserved:
+            self.budget.release(item.reserved)
+            item.reserved = 0
+
+    def _worker(self, name, func, inq, outq):
+        stats = self.stats[name]
+        while True:
+            item = inq.get()
+            if item is _STOP:
+                inq.put(_STOP)  # wake the other workers of this stage
+                return
+            start = time.time()
+            try:
+                nbytes = func(item)
+            except Exception as exc:
+                log.error("%s of %s failed: %s", name, item.run, exc)
+                item.error = "%s: %s" % (name, exc)
+                self._cleanup(item)
+                with self._lock:
+                    self.failures.append(item)
+                stats.add(0, time.time() - start, failed=True)
+                continue
+            stats.add(nbytes, time.time() - start)
+            if outq is not None:
+                outq.put(item)
+
+    def run(self, items):
+        """
+        process all items. returns the throughput report.
+        """
+        os.makedirs(self.workdir, exist_ok=True)
+        start = time.time()
+        todo = [item for item in items if not self.state.is_done(item.run)]
+        log.info("%d runs to ingest (%d already done)", len(todo), len(items) - len(todo))
+
+        funcs = (self._fetch, self._validate, self._upload)
+        # bounded queues between stages provide backpressure
+        queues = [queue.Queue(maxsize=max(1, self.jobs[name]) * 2) for name in self.STAGES] + [None]
+        stages = []
+        for i, name in enumerate(self.STAGES):
+            threads = [threading.Thread(target=self._worker, args=(name, funcs[i], queues[i], queues[i+1]),
+                                        name="%s-%d" % (name, j), daemon=True)
+                       for j in range(self.jobs[name])]
+            for thread in threads:
+                thread.start()
+            stages.append(threads)
+
+        for item in todo:
+            queues[0].put(item)
+
+        for i, threads in enumerate(stages):
+            queues[i].put(_STOP)
+            for thread in threads:
+                thread.join()
+
+        wall = time.time() - start
+        return {
+            "wall_seconds": round(wall, 3),
+            "runs": len(todo),
+            "failed": [{"run": item.run, "error": item.error} for item in self.failures],
+            "stages": [self.stats[name].as_dict(wall) for name in self.STAGES]
+        }
+
+
+def format_report(report):
+    lines = ["%-10s %7s %6s %6s %12s %8s %9s" % ("STAGE", "WORKERS", "ITEMS", "FAILED", "MB", "UTIL", "MB/S")]
+    for stage in report['stages']:
+        lines.append("%-10s %7d %6d %6d %12.1f %8.2f %9.2f" % (
+            stage['stage'], stage['workers'], stage['items'], stage['failed'],
+            stage['bytes'] / (1024*1024), stage['utilization'], stage['mb_per_second']))
+    lines.append("%d runs in %.1fs, %d failed" % (report['runs'], report['wall_seconds'], len(report['failed'])))
+    return "\n".join(lines)
+
+
+def read_runs(infd):
+    items = []
+    for line in infd:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        project, sample, run = line.split()[0:3]
+        items.append(IngestItem(project, sample, run))
+    return items
+
+
+def main():
+    from . import setup_logging
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("source", metavar="RUNLIST", type=str, default="-", nargs="?",
+                        help="list of PRJ SAMPLE SRR lines, or - for stdin")
+    parser.add_argument("--state", metavar="JSONL", type=str, default="ingest-state.jsonl",
+                        help="journal of completed runs (default: %(default)s)")
+    parser.add_argument("--legacy-sums", metavar="DIR", type=str, default="sums",
+                        help="import SRR.md5 marker files from this directory into the state (default: %(default)s)")
+    parser.add_argument("--workdir", metavar="DIR", type=str, default="ingest-work",
+                        help="local directory for downloaded runs (default: %(default)s)")
+    parser.add_argument("--disk-budget", metavar="GB", type=float, default=200.0,
+                        help="maximum size of runs held in the work directory (default: %(default)s)")
+    parser.add_argument("--fetch-jobs", metavar="N", type=int, default=4)
+    parser.add_argument("--validate-jobs", metavar="N", type=int, default=2)
+    parser.add_argument("--upload-jobs", metavar="N", type=int, default=4)
+    parser.add_argument("--dst-prefix", metavar="URL", type=str, default=DST_PREFIX,
+                        help="destination prefix. %%(project)s is replaced by the project (default: %(default)s)")
+    parser.add_argument("--local-source", metavar="DIR", type=str, default=None,
+                        help="read RUN.sra files from DIR instead of NCBI")
+    parser.add_argument("--local-sink", metavar="DIR", type=str, default=None,
+                        help="copy runs into DIR instead of uploading them")
+    parser.add_argument("--report", metavar="JSON", type=str, default=None,
+                        help="write the throughput report to this file")
+    parser.add_argument("--export-hashes", metavar="TXT", type=str, default=None,
+                        help="write all completed runs as URL md5:DIGEST lines (format of checksums/sra-hashes.txt)")
+
+    args = parser.parse_args()
+
+    if args.source == "-":
+        items = read_runs(sys.stdin)
+    else:
+        with open(args.source, "r") as infd:
+            items = read_runs(infd)
+
+    state = IngestState(args.state)
+    imported = state.import_legacy_sums(args.legacy_sums)
+    if imported:
+        log.info("imported %d legacy marker files from %s", imported, args.legacy_sums)
+
+    source = LocalSource(args.local_source) if args.local_source else SRASource()
+    sink = LocalSink(args.local_sink) if args.local_sink else S3Sink(args.dst_prefix)
+
+    ingest = Ingest(source, sink, state, args.workdir,
+                    disk_budget=int(args.disk_budget * 1024 * 1024 * 1024),
+                    fetch_jobs=args.fetch_jobs,
+                    validate_jobs=args.validate_jobs,
+                    upload_jobs=args.upload_jobs)
+    report = ingest.run(items)
+
+    sys.stderr.write(format_report(report) + "\n")
+    if args.report:
+        with open(args.report, "w") as outfd:
+            json.dump(report, outfd, indent=2, sort_keys=True)
+    if args.export_hashes:
+        with open(args.export_hashes, "w") as outfd:
+            for run in sorted(state.completed):
+                record = state.completed[run]
+                outfd.write("%s md5:%s\n" % (record['url'], record['digests']['md5']))
+
+    return 1 if report['failed'] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
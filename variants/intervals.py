@@ -0,0 +1,97 @@
+"""
+Splitting a genome into intervals for scatter-gather.
+
+Intervals are (contig, start, end) tuples, 0-based and half-open as in
+BED files.
+"""
+
+import math
+
+
+def genome_intervals(contigs):
+    """one interval per contig. contigs is [(contig, length), ...] as from parse_fai()"""
+    return [(name, 0, length) for name, length in contigs]
+
+
+def shard_contigs(contigs, shard_size):
+    """
+    split the genome into shards of about shard_size bases, in the order of the
+    contig table. contigs longer than shard_size are cut in equal pieces, and runs
+    of short contigs are packed together into a single shard.
+
+    returns a list of shards, each a list of intervals
+    """
+    if shard_size <= 0:
+        raise ValueError("shard size must be positive")
+
+    shards = []
+    pack, pack_size = [], 0
+    for name, length in contigs:
+        if length > shard_size:
+            if pack:
+                shards.append(pack)
+                pack, pack_size = [], 0
+            num_pieces = int(math.ceil(float(length) / shard_size))
+            piece = int(math.ceil(float(length) / num_pieces))
+            for start in range(0, length, piece):
+                shards.append([(name, start, min(start + piece, length))])
+            continue
+        pack.append((name, 0, length))
+        pack_size += length
+        if pack_size >= shard_size:
+            shards.append(pack)
+            pack, pack_size = [], 0
+    if pack:
+        shards.append(pack)
+    return shards
+
+
+def split_intervals(intervals, num_pieces):
+    """
+    cut a list of intervals into num_pieces lists covering about the same number
+    of bases. pieces follow the order of intervals, and intervals are cut at the
+    piece boundaries.
+    """
+    total = interval_size(intervals)
+    num_pieces = max(1, min(num_pieces, total))
+    target = float(total) / num_pieces
+    pieces = [[]]
+    filled = 0
+    for name, start, end in intervals:
+        while start < end:
+            room = int(round(target * len(pieces))) - filled
+            if room <= 0 and len(pieces) < num_pieces:
+                pieces.append([])
+                continue
+            take = end - start if len(pieces) == num_pieces else min(room, end - start)
+            pieces[-1].append((name, start, start + take))
+            filled += take
+            start += take
+    return [piece for piece in pieces if piece]
+
+
+def interval_size(intervals):
+    return sum(end - start for _, start, end in intervals)
+
+
+def region_strings(intervals):
+    """samtools/tabix style regions (1-based, inclusive)"""
+    return ["%s:%d-%d" % (name, start + 1, end) for name, start, end in intervals]
+
+
+def write_bed(path, intervals):
+    with open(path, "w") as outfd:
+        for name, start, end in intervals:
+            outfd.write("%s\t%d\t%d\n" % (name, start, end))
+
+
+def read_bed(path):
+    intervals = []
+    with open(path, "r") as infd:
+        for line in infd:
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("track"):
+                continue
+            toks = line.split()
+            intervals.append((toks[0], int(toks[1]), int(toks[2])))
+    return intervals
@@ -0,0 +1,143 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+
+from .constants import KIND_PREFIX
+
+log = logging.getLogger(__name__)
+
+
+class JointGenotype(bunnies.Transform):
+    """
+    Call GenotypeGVCFs on one shard of a cohort GenomicsDB workspace.
+    """
+    GENOTYPE_IMAGE = "rieseberglab/analytics:9-3.0.0"
+    VERSION = "2"
+
+    __slots__ = ("genomicsdb",)
+    kind = KIND_PREFIX + "JointGenotype"
+
+    def __init__(self, genomicsdb=None, gt_options=None, manifest=None):
+        """
+        genomicsdb=GenomicsDBImport (or GenomicsDBUpdate) node of the shard
+        gt_options=[ list of extra arguments to pass to GenotypeGVCFs ]
+        """
+        super().__init__("jointgenotype", version=self.VERSION, image=self.GENOTYPE_IMAGE, manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            genomicsdb = inputs['genomicsdb'].node
+            gt_options = params['gt_options']
+
+        if not genomicsdb:
+            raise ValueError("joint genotyping requires a genomicsdb input")
+
+        self.genomicsdb = genomicsdb
+        self.add_input("genomicsdb", genomicsdb, desc="genomicsdb workspace of shard %d" % (genomicsdb.shard,))
+        self.params['gt_options'] = list(gt_options) if gt_options else []
+
+    @property
+    def sample_name(self):
+        return self.genomicsdb.cohort
+
+    @property
+    def shard(self):
+        return self.genomicsdb.shard
+
+    @property
+    def ref(self):
+        return self.genomicsdb.ref
+
+    @property
+    def ref_idx(self):
+        return self.genomicsdb.ref_idx
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("JointGenotype tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.GENOTYPE_IMAGE
+        }
+
+    def task_resources(self, attempt=1, **kwargs):
+        workspace_gbs = self.genomicsdb.ls()['workspace']['size'] / (1024 * 1024 * 1024)
+
+        log.info("joint genotyping %s shard %d: %5.3f gbs of workspace", self.sample_name, self.shard, workspace_gbs)
+
+        # GenotypeGVCFs is single threaded. 1h per gb of workspace (min 2h)
+        return {
+            'vcpus': 2,
+            'memory': 16 * 1024 + (16 * 1024 * (attempt - 1)),
+            'timeout': max(int(workspace_gbs * 3600), 2 * 3600) * attempt
+        }
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import os
+        import os.path
+        import sys
+        from .refcache import cache_reference
+
+        workdir = params['workdir']
+        s3_output_prefix = self.output_prefix()
+
+        local_input_dir = os.path.join(workdir, "input")
+        local_output_dir = os.path.join(workdir, "output")
+        os.makedirs(local_input_dir, exist_ok=True)
+        os.makedirs(local_output_dir, exist_ok=True)
+
+        ref_path, _ = cache_reference(self)
+
+        db_target = self.genomicsdb.ls()
+        tarball = os.path.join(local_input_dir, os.path.basename(db_target['workspace']['url']))
+        bed_path = os.path.join(local_input_dir, os.path.basename(db_target['intervals']['url']))
+        bunnies.transfers.s3_download_file(db_target['workspace']['url'], tarball)
+        bunnies.transfers.s3_download_file(db_target['intervals']['url'], bed_path)
+        bunnies.run_cmd(["tar", "-xf", tarball, "-C", local_input_dir], stdout=sys.stdout, stderr=sys.stderr)
+        os.unlink(tarball)
+        workspace = os.path.join(local_input_dir, os.path.basename(tarball)[:-len(".tar")])
+
+        memory_mb = resources['memory']
+        pfx = "%s.shard%04d" % (self.sample_name, self.shard)
+        gt_args = [
+            "gatk", "--java-options", "-Xmx%dm" % ((memory_mb - 200) * 3 // 4,),
+            "GenotypeGVCFs",
+            "-R", ref_path,
+            "-V", "gendb://" + workspace,
+            "-L", bed_path,
+            # a variant spanning two shards is only called in the shard of its start
+            "--only-output-calls-starting-in-intervals",
+            "-O", os.path.join(local_output_dir, pfx + ".vcf.gz"),
+            "--tmp-dir", workdir
+        ] + self.params['gt_options']
+        bunnies.run_cmd(gt_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+
+        def _upload_output_file(fname):
+            inpath = os.path.join(local_output_dir, fname)
+            output_url = os.path.join(s3_output_prefix, fname)
+            st_size = os.stat(inpath).st_size
+            bunnies.transfers.s3_upload_file(inpath, output_url)
+            return {"size": st_size, "url": output_url}
+
+        output = {
+            "vcf": _upload_output_file(pfx + ".vcf.gz"),
+            "vcf_idx": _upload_output_file(pfx + ".vcf.gz.tbi")
+        }
+        return output
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(cohort)s-shard%(shard)04d-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'cohort': self.sample_name,
+            'shard': self.shard,
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(JointGenotype)
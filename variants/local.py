@@ -0,0 +1,237 @@
+"""
+Local builds, without the batch compute environment.
+
+For a handful of samples, or small inputs, the container start and queue
+latency of a batch job is longer than the work itself. A local build runs
+the run() method of each node in a process pool on this machine, in
+dependency order, admitting nodes as long as their task_resources fit in
+the cores and memory of the machine. Nodes which ask for more than the
+machine has run alone, with what the machine has.
+
+Outputs are written to the same output prefixes as the batch jobs, and
+the result of each node is published where Packable looks for it, so a
+node built locally is built for every later run, local or not.
+
+The nodes run on the host, not in their images, so the machine needs
+the tools of the images (REQUIRED_TOOLS), which are checked before the
+build starts, and a reference cache it can write to (refcache.CAS_DIR,
+/localscratch/cas unless casdir is given).
+
+The changes of state of the nodes are written to jobs.jsonl in the
+workdir, which python -m variants monitor reads in place of a job queue.
+"""
+
+import os
+import os.path
+import socket
+import shutil
+import logging
+import tempfile
+
+log = logging.getLogger(__name__)
+
+# fraction of the physical memory handed out to the nodes
+MEMORY_FRACTION = 0.9
+
+# programs the run() of each kind calls, as named in the images
+REQUIRED_TOOLS = {
+    "align": ("align", "cas"),
+    "merge": ("cas", "/usr/bin/samtools", "/usr/local/bin/sambamba_v0.6.6"),
+    "genotype": ("cas", "gatk", "tabix"),
+}
+
+
+def machine_resources():
+    """{'vcpus', 'memory'} of this machine. memory in MB."""
+    try:
+        vcpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        vcpus = os.cpu_count() or 1
+    memory = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // (1024 * 1024)
+    return {'vcpus': vcpus, 'memory': int(memory * MEMORY_FRACTION)}
+
+
+def fit_resources(requested, capacity):
+    """the resources a node gets: what it asks for, within what the machine has"""
+    resources = dict(requested)
+    resources['vcpus'] = max(1, min(int(requested.get('vcpus') or 1), capacity['vcpus']))
+    resources['memory'] = max(1, min(int(requested.get('memory') or 1024), capacity['memory']))
+    return resources
+
+
+def check_host(nodes, casdir):
+    """
+    raise if this machine lacks a tool the nodes need, or can't write to
+    the reference cache casdir
+    """
+    import shutil
+    missing = {}
+    for node in nodes:
+        for tool in REQUIRED_TOOLS.get(node.name, ()):
+            if not shutil.which(tool):
+                missing.setdefault(tool, set()).add(node.name)
+    if missing:
+        lacking = ["%s (for %s)" % (tool, ", ".join(sorted(kinds))) for tool, kinds in sorted(missing.items())]
+        raise ValueError("local builds run the nodes on this machine, which lacks %s. build them in the"
+                         " compute environment instead." % (", ".join(lacking),))
+    try:
+        os.makedirs(casdir, exist_ok=True)
+    except OSError as exc:
+        raise ValueError("can't create the reference cache %s (see --local-cas-dir): %s" % (casdir, exc))
+    if not os.access(casdir, os.W_OK):
+        raise ValueError("the reference cache %s isn't writable (see --local-cas-dir)" % (casdir,))
+
+
+_local_nodes = None
+
+
+def _run_node(nodei, resources, workdir, scriptdir):
+    """entry point of the pool workers. the nodes are inherited through fork."""
+    node = _local_nodes[nodei]
+    os.makedirs(workdir, exist_ok=True)
+    return node.run(resources=resources, workdir=workdir, scriptdir=scriptdir)
+
+
+def _walk(targets):
+    """nodes needed by targets, dependencies first"""
+    from .schedule import _dependencies
+    nodes, seen = [], set()
+
+    def _visit(node):
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        for dep in _dependencies(node):
+            _visit(dep)
+        nodes.append(node)
+
+    for target in targets:
+        _visit(target)
+    return nodes
+
+
+def build_local(targets, capacity=None, workdir=None, min_attempt=1, max_attempt=1, jobs=32, casdir=None):
+    """
+    build targets on this machine. capacity={'vcpus', 'memory'} defaults to
+    the machine's. each node is tried with the resources of attempts
+    min_attempt..max_attempt. workdirs of the nodes which fail are kept.
+    casdir replaces the reference cache of the images.
+    returns the nodes built.
+    """
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
+    from . import refcache
+    from .bundle import TOPDIR
+    from .monitor import JobStateLog
+    from .packing import Packable, publish_result
+    from .schedule import _dependencies
+
+    global _local_nodes
+
+    capacity = dict(machine_resources(), **(capacity or {}))
+    nodes = _walk(targets)
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        built = set(id(node) for node, is_built in zip(nodes, executor.map(lambda node: node.exists(), nodes))
+                    if is_built)
+    todo = [node for node in nodes if id(node) not in built]
+    unsupported = sorted(set(node.name for node in todo if not isinstance(node, Packable)))
+    if unsupported:
+        raise ValueError("local builds can't run %s nodes. build them in the compute environment first."
+                         % (", ".join(unsupported),))
+    if not todo:
+        log.info("local build: all %d nodes built", len(nodes))
+        return []
+    if casdir:
+        # inherited by the pool workers
+        refcache.CAS_DIR = casdir
+    check_host(todo, refcache.CAS_DIR)
+
+    workdir = workdir or tempfile.mkdtemp(prefix="variants-local-")
+    built_by = "local:%s" % (socket.gethostname(),)
+    states = JobStateLog(os.path.join(workdir, "jobs.jsonl"))
+    log.info("local build of %d nodes (%d built) with %d vcpus, %d MB in %s (job states in %s)",
+             len(todo), len(nodes) - len(todo), capacity['vcpus'], capacity['memory'], workdir, states.path)
+
+    def _job_name(i):
+        return "%s-%s" % (todo[i].name, todo[i].canonical_id)
+
+    _local_nodes = todo
+    index = {id(node): i for i, node in enumerate(todo)}
+    waiting = {i: sum(1 for dep in _dependencies(node) if id(dep) not in built) for i, node in enumerate(todo)}
+    dependents = {}
+    for i, node in enumerate(todo):
+        for dep in _dependencies(node):
+            if id(dep) in index:
+                dependents.setdefault(index[id(dep)], []).append(i)
+
+    ready = [i for i, count in waiting.items() if not count]
+    for i in ready:
+        states.record(_job_name(i), "RUNNABLE")
+    attempts = {i: min_attempt for i in range(len(todo))}
+    running = {}  # future: (node index, resources, workdir)
+    free = dict(capacity)
+    failed, skipped = {}, []
+
+    def _submit(executor, i):
+        node = todo[i]
+        resources = fit_resources(node.task_resources(attempt=attempts[i]), capacity)
+        if running and (resources['vcpus'] > free['vcpus'] or resources['memory'] > free['memory']):
+            return False
+        free['vcpus'] -= resources['vcpus']
+        free['memory'] -= resources['memory']
+        node_workdir = os.path.join(workdir, _job_name(i))
+        states.record(_job_name(i), "RUNNING")
+        log.info("starting %s (attempt %d, %d vcpus, %d MB)", node.output_prefix(), attempts[i],
+                 resources['vcpus'], resources['memory'])
+        running[executor.submit(_run_node, i, resources, node_workdir, TOPDIR)] = (i, resources, node_workdir)
+        return True
+
+    with ProcessPoolExecutor(max_workers=capacity['vcpus'],
+                             mp_context=multiprocessing.get_context("fork")) as executor:
+        while ready or running:
+            # dependency order, first come first served. a node which doesn't
+            # fit waits for the running ones, and so do the nodes after it.
+            while ready and _submit(executor, ready[0]):
+                ready.pop(0)
+
+            done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+            for future in done:
+                i, resources, node_workdir = running.pop(future)
+                free['vcpus'] += resources['vcpus']
+                free['memory'] += resources['memory']
+                node = todo[i]
+                try:
+                    output = future.result()
+                except Exception as exc:
+                    states.record(_job_name(i), "FAILED", reason=str(exc))
+                    if attempts[i] < max_attempt:
+                        log.warning("%s failed, retrying: %s", node.output_prefix(), exc)
+                        attempts[i] += 1
+                        shutil.rmtree(node_workdir, ignore_errors=True)
+                        states.record(_job_name(i), "RUNNABLE")
+                        ready.insert(0, i)
+                        continue
+                    log.error("%s failed: %s (workdir kept in %s)", node.output_prefix(), exc, node_workdir)
+                    failed[i] = exc
+                    stack = list(dependents.get(i, ()))
+                    while stack:
+                        child = stack.pop()
+                        if child not in skipped:
+                            skipped.append(child)
+                            stack.extend(dependents.get(child, ()))
+                    continue
+                publish_result(node, output, built_by)
+                states.record(_job_name(i), "SUCCEEDED")
+                shutil.rmtree(node_workdir, ignore_errors=True)
+                log.info("built %s", node.output_prefix())
+                for child in dependents.get(i, ()):
+                    waiting[child] -= 1
+                    if not waiting[child] and child not in skipped:
+                        states.record(_job_name(child), "RUNNABLE")
+                        ready.append(child)
+
+    if failed:
+        raise Exception("local build: %d nodes failed, %d not built because of them: %s" % (
+            len(failed), len(skipped), ", ".join(todo[i].output_prefix() for i in sorted(failed))))
+    log.info("local build of %d nodes complete", len(todo))
+    return todo
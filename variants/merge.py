@@ -3,12 +3,13 @@ import bunnies.unmarshall
 import logging
 import bunnies.config as config
 
-from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+from .constants import KIND_PREFIX, SAMPLE_NAME_RE, OUTPUT_FORMATS
+from .packing import Packable
 
 log = logging.getLogger(__name__)
 
 
-class Merge(bunnies.Transform):
+class Merge(Packable, bunnies.Transform):
     """
     merge one or more bam files and modify the readgroup with the
     provided information. bams are merged in the order provided.
@@ -19,16 +20,20 @@ class Merge(bunnies.Transform):
     __slots__ = ("sample_name",)
     kind = KIND_PREFIX + "Merge"
 
-    def __init__(self, sample_name=None, aligned_bams=None, manifest=None):
+    def __init__(self, sample_name=None, aligned_bams=None, output_format="bam", manifest=None):
         super().__init__("merge", version=self.VERSION, image=self.MERGE_IMAGE)
 
         if manifest is not None:
             inputs, params = manifest['inputs'], manifest['params']
             sample_name = params.get('sample_name')
+            output_format = params.get('output_format', "bam")
             aligned_bams = []
             for i in range(0, params.get('num_bams')):
                 aligned_bams.append(inputs.get(str(i)).node)
 
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError("output format %r is not one of %s" % (output_format, OUTPUT_FORMATS))
+
         if not SAMPLE_NAME_RE.match(sample_name):
             raise ValueError("sample name %r does not match %s" % (
                 sample_name, SAMPLE_NAME_RE.pattern))
@@ -36,6 +41,9 @@ class Merge(bunnies.Transform):
         self.sample_name = sample_name
         self.params["sample_name"] = sample_name
         self.params["num_bams"] = len(aligned_bams)
+        if output_format != "bam":
+            # bam outputs keep the canonical ids they had before the parameter existed
+            self.params["output_format"] = output_format
 
         if not aligned_bams:
             raise ValueError("merging requires 1 or more aligned bam inputs")
@@ -63,6 +71,10 @@ class Merge(bunnies.Transform):
 
             self.add_input(str(i), bam, desc="aligned input #%d" % (i,))
 
+    @property
+    def output_format(self):
+        return self.params.get("output_format", "bam")
+
     @property
     def ref(self):
         if not self.inputs:
@@ -120,8 +132,14 @@ class Merge(bunnies.Transform):
         import os
         import os.path
         import sys
+        from .timing import Timings
+        from .refcache import cache_reference
+        from .remote import upload_file, upload_files
+        from .bundle import TOPDIR
 
         workdir = params['workdir']
+        timings = Timings(self.name, self.sample_name, vcpus=resources['vcpus'], memory=resources['memory'],
+                          num_bams=self.params['num_bams'], output_format=self.output_format)
 
         s3_output_prefix = self.output_prefix()
 
@@ -134,19 +152,37 @@ class Merge(bunnies.Transform):
 
         all_srcs = []
         all_dests = []
-        for inputi, inputval in self.inputs.items():
-            aligned_target = inputval.ls()
-            bam_src, bam_dest = aligned_target['bam']['url'], os.path.join(local_input_dir, "input_%s.bam" % (inputi,))
-            bai_src, bai_dest = aligned_target['bai']['url'], os.path.join(local_input_dir, "input_%s.bai" % (inputi,))
-            bunnies.transfers.s3_download_file(bai_src, bai_dest)
-            bunnies.transfers.s3_download_file(bam_src, bam_dest)
-            all_srcs.append({"bam": bam_src, "bai": bai_src})
-            all_dests += [bam_dest, bai_dest]
+        input_formats = set()
+        with timings.span("download") as span:
+            for inputi, inputval in self.inputs.items():
+                aligned_target = inputval.ls()
+                input_format = aligned_target.get('format', "bam")
+                input_formats.add(input_format)
+                idx_ext = ".crai" if input_format == "cram" else ".bai"
+                bam_src = aligned_target['bam']['url']
+                bam_dest = os.path.join(local_input_dir, "input_%s.%s" % (inputi, input_format))
+                bai_src = aligned_target['bai']['url']
+                bai_dest = os.path.join(local_input_dir, "input_%s%s" % (inputi, idx_ext))
+                bunnies.transfers.s3_download_file(bai_src, bai_dest)
+                bunnies.transfers.s3_download_file(bam_src, bam_dest)
+                all_srcs.append({"bam": bam_src, "bai": bai_src})
+                all_dests += [bam_dest, bai_dest]
+                span.add_file(bam_dest)
+                span.add_file(bai_dest)
+
+        ext = "." + self.output_format
+        idx_ext = ".crai" if self.output_format == "cram" else ".bai"
+        reference_args = []
+        if self.output_format == "cram" or "cram" in input_formats:
+            # crams are encoded against the reference. use the copy cached on the host.
+            with timings.span("reference") as span:
+                ref_path, _ = cache_reference(self, span=span)
+            reference_args = ["--reference", ref_path]
 
         num_threads = resources['vcpus']
         memory_mb = resources['memory']
         merge_args = [
-            os.path.join(params["scriptdir"], "scripts", "lane_merger.sh"),
+            os.path.join(TOPDIR, "scripts", "lane_merger.sh"),
             "--samtools", "/usr/bin/samtools",
             "--sambamba", "/usr/local/bin/sambamba_v0.6.6",
             "--samplename", self.sample_name,
@@ -154,42 +190,67 @@ class Merge(bunnies.Transform):
             "--threads", str(num_threads),
             "--maxheap", str(memory_mb - 200),
             "--delete-old",
-            os.path.join(local_output_dir, self.sample_name) + ".bam",  # output.bam
+            "--no-md5"
+        ] + reference_args + [
+            os.path.join(local_output_dir, self.sample_name) + ext,  # output.bam or output.cram
         ] + all_dests
 
-        bunnies.run_cmd(merge_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+        with timings.span("merge", threads=num_threads) as span:
+            bunnies.run_cmd(merge_args, stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
+            span.add_file(os.path.join(local_output_dir, self.sample_name) + ext)
 
-        with open(os.path.join(local_output_dir, self.sample_name + ".bam.merged.txt"), "w") as merge_manifest:
+        with open(os.path.join(local_output_dir, self.sample_name + ext + ".merged.txt"), "w") as merge_manifest:
             for src in all_srcs:
                 merge_manifest.write("\t".join([
                     self.sample_name,
                     src['bam'],
-                    os.path.join(s3_output_prefix, self.sample_name + ".bam")
+                    os.path.join(s3_output_prefix, self.sample_name + ext)
                 ]) + "\n")
 
         bunnies.run_cmd(["ls", "-lh",  local_output_dir], stdout=sys.stdout, stderr=sys.stderr, cwd=workdir)
         pfx = self.sample_name
 
-        def _check_output_file(fname, is_optional=False):
-            try:
-                inpath = os.path.join(local_output_dir, fname)
-                output_url = os.path.join(s3_output_prefix, fname)
-                st_size = os.stat(inpath).st_size
-                bunnies.transfers.s3_upload_file(inpath, output_url)
-                return {"size": st_size, "url": output_url}
-            except FileNotFoundError:
+        # crams are published under the same keys as bams
+        output_files = [
+            ("bam", pfx + ext, False),
+            ("bai", pfx + ext + idx_ext, False),
+            ("dupmetrics", pfx + ".dupmetrics.txt", True),
+            ("bamstats", pfx + ".bamstats.txt", False),
+            ("merge_manifest", pfx + ext + ".merged.txt", False)
+        ]
+        output = {}
+        uploads = []
+        for key, fname, is_optional in output_files:
+            inpath = os.path.join(local_output_dir, fname)
+            if not os.path.exists(inpath):
                 if is_optional:
-                    return None
+                    output[key] = None
+                    continue
                 raise Exception("missing file: " + inpath)
-
-        output = {
-            "bam": _check_output_file(pfx + ".bam", False),
-            "bai": _check_output_file(pfx + ".bam.bai", False),
-            "bam_md5": _check_output_file(pfx + ".bam.md5", False),
-            "dupmetrics": _check_output_file(pfx + ".dupmetrics.txt", True),
-            "bamstats": _check_output_file(pfx + ".bamstats.txt", False),
-            "merge_manifest": _check_output_file(pfx + ".bam.merged.txt", False)
-        }
+            uploads.append((key, inpath, os.path.join(s3_output_prefix, fname)))
+
+        # all outputs go up at once, the bam in parallel parts. its md5 is
+        # computed as it is uploaded, instead of in a separate pass.
+        with timings.span("upload") as span:
+            results = upload_files([(inpath, url) for _, inpath, url in uploads], jobs=len(uploads))
+            for (key, _, _), result in zip(uploads, results):
+                output[key] = {"size": result['size'], "url": result['url']}
+                span.add_bytes(result['size'])
+
+            output["bam"]["digests"] = {"md5": results[0]['md5']}
+
+            md5_path = os.path.join(local_output_dir, pfx + ext + ".md5")
+            with open(md5_path, "w") as md5_fd:
+                md5_fd.write("%s  %s\n" % (results[0]['md5'], pfx + ext))
+            result = upload_file(md5_path, os.path.join(s3_output_prefix, pfx + ext + ".md5"))
+            output["bam_md5"] = {"size": result['size'], "url": result['url']}
+
+        if self.output_format != "bam":
+            output["format"] = self.output_format
+
+        timings_path = timings.write(os.path.join(local_output_dir, pfx + ".timings.json"))
+        result = upload_file(timings_path, os.path.join(s3_output_prefix, pfx + ".timings.json"))
+        output["timings"] = {"size": result['size'], "url": result['url']}
         return output
 
 
@@ -0,0 +1,118 @@
+"""
+Parsers for the text metrics published next to the bams
+"""
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# samtools stats summary numbers that are kept, by their SN label
+BAMSTATS_FIELDS = {
+    "raw total sequences": "reads_total",
+    "reads mapped": "reads_mapped",
+    "reads properly paired": "reads_paired",
+    "reads duplicated": "reads_duplicated",
+    "reads QC failed": "reads_qcfail",
+    "bases mapped (cigar)": "bases_mapped",
+    "average length": "read_length",
+    "insert size average": "insert_size",
+    "insert size standard deviation": "insert_size_sd",
+    "error rate": "error_rate",
+}
+
+DUPMETRICS_COUNTS = (
+    "UNPAIRED_READS_EXAMINED", "READ_PAIRS_EXAMINED", "SECONDARY_OR_SUPPLEMENTARY_RDS",
+    "UNMAPPED_READS", "UNPAIRED_READ_DUPLICATES", "READ_PAIR_DUPLICATES",
+    "READ_PAIR_OPTICAL_DUPLICATES"
+)
+
+
+def parse_bamstats(text):
+    """
+    parse the SN (summary numbers) section of samtools stats output.
+    returns {field: float} for the fields in BAMSTATS_FIELDS
+    """
+    stats = {}
+    for line in text.splitlines():
+        if not line.startswith("SN\t"):
+            continue
+        toks = line.split("\t")
+        if len(toks) < 3:
+            continue
+        label = toks[1].rstrip(":")
+        if label in BAMSTATS_FIELDS:
+            try:
+                stats[BAMSTATS_FIELDS[label]] = float(toks[2])
+            except ValueError:
+                log.warning("unparseable bamstats value %r for %s", toks[2], label)
+    return stats
+
+
+def parse_metrics_table(text):
+    """
+    parse the first METRICS CLASS table of a picard metrics file.
+    returns a list of {column: value} rows, values as strings.
+    """
+    rows = []
+    header = None
+    in_metrics = False
+    for line in text.splitlines():
+        if line.startswith("## METRICS CLASS"):
+            if rows:
+                break
+            in_metrics = True
+            header = None
+            continue
+        if not in_metrics:
+            continue
+        if not line.strip() or line.startswith("#"):
+            if header is not None:
+                break
+            continue
+        toks = line.split("\t")
+        if header is None:
+            header = toks
+            continue
+        rows.append(dict(zip(header, toks)))
+    return rows
+
+
+def parse_dupmetrics(text):
+    """
+    parse picard MarkDuplicates metrics, summed over all libraries.
+    returns {column: float}, with dup_rate computed over the totals.
+    """
+    totals = {name: 0.0 for name in DUPMETRICS_COUNTS}
+    rows = parse_metrics_table(text)
+    if not rows:
+        return {}
+    for row in rows:
+        for name in DUPMETRICS_COUNTS:
+            try:
+                totals[name] += float(row.get(name) or 0)
+            except ValueError:
+                pass
+    examined = totals["UNPAIRED_READS_EXAMINED"] + 2 * totals["READ_PAIRS_EXAMINED"]
+    duplicates = totals["UNPAIRED_READ_DUPLICATES"] + 2 * totals["READ_PAIR_DUPLICATES"]
+    totals["dup_rate"] = duplicates / examined if examined else 0.0
+    return totals
+
+
+def parse_alignment_summary(text):
+    """
+    parse picard CollectAlignmentSummaryMetrics output (the illuminametrics file).
+    returns the PAIR row (or the UNPAIRED row for single-end data) as {column: float}
+    """
+    by_category = {}
+    for row in parse_metrics_table(text):
+        values = {}
+        for key, val in row.items():
+            try:
+                values[key] = float(val)
+            except (TypeError, ValueError):
+                continue
+        by_category[row.get("CATEGORY")] = values
+    for category in ("PAIR", "UNPAIRED"):
+        if category in by_category:
+            return by_category[category]
+    return {}
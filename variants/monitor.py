@@ -0,0 +1,362 @@
+"""
+Progress of a running build.
+
+The jobs of the plan (written with --plan-out) are matched with the state
+of the jobs in the queue, by the canonical id in their names, and with
+the timings of those which are done. Each poll prints, by stage: the jobs
+planned, queued, running, done and failed, the failed attempts and the
+failure rate, the input gigabytes done, the throughput over the last
+--window hours and the measured speed against the plan. The jobs left are
+then simulated under --maxvcpus, with their planned durations scaled by
+the measured speed of their stage, for the ETA.
+
+The state of the jobs comes from AWS Batch (--queue), or from a state
+file (--state-file), one json line per change of state of a job. Local
+builds (--local) write one in their workdir:
+
+  python -m variants greg59/samples.json --stage gvcf --plan-out greg59/plan.jsonl
+  python -m variants monitor greg59/plan.jsonl --queue variants-queue --snapshots greg59/progress.jsonl
+  python -m variants monitor greg59/plan.jsonl --state-file /tmp/variants-local-XXXX/jobs.jsonl --once
+
+Each poll is appended to the --snapshots file as one json line.
+"""
+
+import re
+import sys
+import json
+import time
+import argparse
+import logging
+import threading
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+QUEUED = ("SUBMITTED", "PENDING", "RUNNABLE", "STARTING")
+RUNNING = "RUNNING"
+SUCCEEDED = "SUCCEEDED"
+FAILED = "FAILED"
+STATUSES = QUEUED + (RUNNING, SUCCEEDED, FAILED)
+
+# column of the stage rows counting the jobs of each status of Monitor.status()
+COLUMN_OF = {"WAITING": "waiting", "QUEUED": "queued", RUNNING: "running", SUCCEEDED: "done", FAILED: "failed"}
+
+GB = 1024.0 * 1024 * 1024
+
+# the outputs of jobs the queue has never reported are looked up on the
+# first poll, and then on one poll out of this many
+WAITING_PROBE_POLLS = 10
+
+
+class JobStateLog(object):
+    """
+    writer of a state file: one json line per change of state of a job.
+    safe to share between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def record(self, name, status, reason=""):
+        if status not in STATUSES:
+            raise ValueError("unknown job status: %s" % (status,))
+        line = json.dumps({"name": name, "status": status, "time": time.time(), "reason": reason},
+                          sort_keys=True)
+        with self._lock:
+            with open(self.path, "a") as outfd:
+                outfd.write(line + "\n")
+
+
+class StateFileQueue(object):
+    """
+    job states from a state file written by JobStateLog. stands in for the
+    queue api, for local builds and for replaying a build. like in the
+    queue, each attempt of a job is a job of its own.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def poll(self):
+        """[{'name', 'status', 'created', 'started', 'stopped', 'reason'}], the latest state of each attempt"""
+        attempts, latest = [], {}
+        try:
+            infd = open(self.path, "r")
+        except FileNotFoundError:
+            return []
+        with infd:
+            for line in infd:
+                if not line.endswith("\n"):
+                    break  # being written
+                event = json.loads(line)
+                job = latest.get(event['name'])
+                if job is None or (job['status'] == FAILED and event['status'] != FAILED):
+                    job = latest[event['name']] = {"name": event['name'], "created": event['time'],
+                                                   "started": None, "stopped": None}
+                    attempts.append(job)
+                job['status'] = event['status']
+                job['reason'] = event.get('reason', "")
+                if event['status'] == RUNNING:
+                    job['started'] = event['time']
+                    job['stopped'] = None
+                elif event['status'] in (SUCCEEDED, FAILED):
+                    job['stopped'] = event['time']
+        return attempts
+
+
+class BatchQueue(object):
+    """job states from the AWS Batch job queues of the compute environment"""
+    def __init__(self, queues):
+        import boto3
+        self.queues = queues
+        self.client = boto3.session.Session().client("batch")
+
+    def poll(self):
+        jobs = []
+        for queue in self.queues:
+            for status in STATUSES:
+                kwargs = {"jobQueue": queue, "jobStatus": status}
+                while True:
+                    resp = self.client.list_jobs(**kwargs)
+                    for summary in resp['jobSummaryList']:
+                        jobs.append({
+                            "name": summary['jobName'],
+                            "status": summary['status'],
+                            "created": summary.get('createdAt', 0) / 1000.0,
+                            "started": summary['startedAt'] / 1000.0 if summary.get('startedAt') else None,
+                            "stopped": summary['stoppedAt'] / 1000.0 if summary.get('stoppedAt') else None,
+                            "reason": summary.get('statusReason', "")
+                        })
+                    if not resp.get('nextToken'):
+                        break
+                    kwargs['nextToken'] = resp['nextToken']
+        return jobs
+
+
+def match_jobs(plan_jobs, queue_jobs):
+    """
+    ({plan job id: latest queue job}, {plan job id: failed attempts}).
+    queue jobs are matched by a canonical id (sha1_HEX) appearing in their
+    name. a job retried in several queue jobs is represented by the latest
+    created.
+    """
+    by_cid = {job.cid: job.id for job in plan_jobs if job.cid}
+    matched, failures = {}, {}
+    for queue_job in queue_jobs:
+        for token in re.split(r"[^0-9A-Za-z_]+", queue_job['name']):
+            job_id = by_cid.get(token)
+            if job_id is None:
+                continue
+            if job_id not in matched or queue_job['created'] >= matched[job_id]['created']:
+                matched[job_id] = queue_job
+            if queue_job['status'] == FAILED:
+                failures[job_id] = failures.get(job_id, 0) + 1
+            break
+    return matched, failures
+
+
+class Monitor(object):
+    """
+    state of the jobs of a plan, updated by poll(). timings of the jobs
+    which are done are read once, from their output prefix.
+    """
+    def __init__(self, plan_jobs, queue, cache, window=1.0, max_vcpus=1024, probe_every=WAITING_PROBE_POLLS):
+        self.jobs = plan_jobs
+        self.queue = queue
+        self.cache = cache
+        self.window = window
+        self.max_vcpus = max_vcpus
+        self.probe_every = probe_every
+        self.polls = 0
+        self.states = {}
+        self.failures = {}
+        self.done = {}  # job id: (time done, wall seconds from timings or None)
+
+    def _timings(self, job):
+        """
+        (stop time, wall seconds) from the timings of a job which is built,
+        (None, None) if it has none, or None if it is not built. outputs are
+        built once they hold a completion marker: a prefix with some files
+        may be uploading, or be what a failed attempt left.
+        """
+        from .remote import listing_complete
+        if not job.prefix:
+            return None
+        listing = self.cache.list_prefix(job.prefix)
+        if not listing_complete(listing):
+            return None
+        for key in listing:
+            if key.endswith(".timings.json"):
+                try:
+                    doc = json.loads(self.cache.read_text(job.prefix + key))
+                    return doc['start'] + doc['wall_s'], doc['wall_s']
+                except Exception as exc:
+                    log.warning("unreadable timings %s%s: %s", job.prefix, key, exc)
+        return None, None
+
+    def poll(self):
+        now = time.time()
+        matched, failures = match_jobs(self.jobs, self.queue.poll())
+        self.states.update(matched)
+        for job_id, count in failures.items():
+            self.failures[job_id] = max(self.failures.get(job_id, 0), count)
+        # the outputs of the jobs which may be done: those the queue says
+        # succeeded, which are done with or without timings, and those it has
+        # forgotten (it drops old jobs). jobs it has never reported are
+        # mostly waiting for their dependencies, and are only looked up
+        # every probe_every polls, in case another build made them.
+        probe_waiting = self.polls % self.probe_every == 0
+        self.polls += 1
+        check = []
+        for job in self.jobs:
+            state = self.states.get(job.id)
+            if job.id in self.done:
+                continue
+            if state is None:
+                if probe_waiting:
+                    check.append(job)
+            elif state['status'] == SUCCEEDED or job.id not in matched:
+                check.append(job)
+        for job, result in zip(check, self.cache.map(self._timings, check)):
+            state = self.states.get(job.id)
+            if result is None:
+                if state is None or state['status'] != SUCCEEDED:
+                    continue
+                result = (None, None)
+            stopped, wall = result
+            if stopped is None:
+                stopped = state['stopped'] if state and state.get('stopped') else now
+            self.done[job.id] = (stopped, wall)
+        return self.snapshot(now)
+
+    def status(self, job):
+        if job.id in self.done:
+            return SUCCEEDED
+        state = self.states.get(job.id)
+        if state is None:
+            return "WAITING"
+        return "QUEUED" if state['status'] in QUEUED else state['status']
+
+    def snapshot(self, now):
+        """{'time', 'stages': [row per stage], 'jobs_left', 'eta_s'}"""
+        from .schedule import Job, simulate
+        window_start = now - self.window * 3600
+        stages = OrderedDict()
+        for job in self.jobs:
+            row = stages.setdefault(job.kind, OrderedDict([
+                ("stage", job.kind), ("planned", 0), ("waiting", 0), ("queued", 0), ("running", 0),
+                ("done", 0), ("failed", 0), ("failed_attempts", 0), ("gb_done", 0.0), ("gb_left", 0.0),
+                ("window_gb", 0.0), ("planned_s", 0.0), ("wall_s", 0.0)]))
+            status = self.status(job)
+            row['planned'] += 1
+            row[COLUMN_OF[status]] += 1
+            row['failed_attempts'] += self.failures.get(job.id, 0)
+            if status == SUCCEEDED:
+                stopped, wall = self.done[job.id]
+                row['gb_done'] += job.bytes_in / GB
+                if stopped >= window_start:
+                    row['window_gb'] += job.bytes_in / GB
+                if wall:
+                    row['planned_s'] += job.seconds
+                    row['wall_s'] += wall
+            else:
+                row['gb_left'] += job.bytes_in / GB
+
+        speed = {}
+        for kind, row in stages.items():
+            attempts = row['done'] + row['failed_attempts']
+            row['failure_rate'] = row['failed_attempts'] / float(attempts) if attempts else 0.0
+            row['gb_per_hour'] = row['window_gb'] / self.window
+            row['speed'] = row['planned_s'] / row['wall_s'] if row['wall_s'] else None
+            speed[kind] = row['speed'] or 1.0
+            for key in ("window_gb", "planned_s", "wall_s"):
+                del row[key]
+
+        # the jobs left, with the durations of their stage's measured speed.
+        # running jobs are credited the time they have run.
+        left = [job for job in self.jobs if self.status(job) != SUCCEEDED]
+        ids = set(job.id for job in left)
+        remaining = []
+        for job in left:
+            seconds = job.seconds / speed[job.kind]
+            state = self.states.get(job.id)
+            if state and state['status'] == RUNNING and state.get('started'):
+                seconds = max(seconds - (now - state['started']), 60.0)
+            remaining.append(Job(job.id, job.kind, seconds, job.vcpus, [dep for dep in job.deps if dep in ids]))
+        return {"time": now, "stages": list(stages.values()), "jobs_left": len(remaining),
+                "max_vcpus": self.max_vcpus,
+                "eta_s": simulate(remaining, self.max_vcpus)['makespan'] if remaining else 0.0}
+
+
+def format_snapshot(snapshot):
+    columns = ("planned", "waiting", "queued", "running", "done", "failed", "failed_attempts", "failure_rate",
+               "gb_done", "gb_left", "gb_per_hour", "speed")
+    lines = ["# %s" % (time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(snapshot['time'])),),
+             "\t".join(["STAGE"] + [col.upper() for col in columns])]
+    for row in snapshot['stages']:
+        cells = [row['stage']]
+        for col in columns:
+            value = row[col]
+            if value is None:
+                cells.append("-")
+            elif isinstance(value, float):
+                cells.append("%.2f" % (value,))
+            else:
+                cells.append(str(value))
+        lines.append("\t".join(cells))
+    if snapshot['jobs_left']:
+        lines.append("# %d jobs left. eta with %d vcpus: %.1fh (%s)" % (
+            snapshot['jobs_left'], snapshot['max_vcpus'], snapshot['eta_s'] / 3600.0,
+            time.strftime("%Y-%m-%d %H:%M", time.localtime(snapshot['time'] + snapshot['eta_s']))))
+    else:
+        lines.append("# all jobs done")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    from . import setup_logging
+    from .remote import DEFAULT_CACHE_DIR, RemoteCache
+    from .schedule import read_manifest
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="python -m variants monitor", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", metavar="PLAN", type=str,
+                        help="plan of the build, written with python -m variants --plan-out")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--queue", metavar="NAME", type=str, action="append", default=[],
+                        help="AWS Batch job queue of the build. repeat for several queues")
+    source.add_argument("--state-file", metavar="JSONL", type=str, default=None, dest="state_file",
+                        help="state file of the jobs, e.g. the jobs.jsonl of a local build")
+    parser.add_argument("--interval", metavar="SECONDS", type=float, default=300.0,
+                        help="time between polls (default: %(default)s)")
+    parser.add_argument("--once", action="store_true", default=False, help="poll once and exit")
+    parser.add_argument("--window", metavar="HOURS", type=float, default=1.0,
+                        help="throughput is measured over the jobs done in the last HOURS (default: %(default)s)")
+    parser.add_argument("--maxvcpus", metavar="VCPUS", type=int, default=1024, dest="max_vcpus",
+                        help="vcpu budget of the build, for the eta (default: %(default)s)")
+    parser.add_argument("--snapshots", metavar="JSONL", type=str, default=None,
+                        help="append each poll to this file, as one json line")
+    parser.add_argument("--cache", metavar="DIR", type=str, default=DEFAULT_CACHE_DIR,
+                        help="local cache of listings and timings (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    plan_jobs, _ = read_manifest(args.manifest)
+    if plan_jobs and not any(job.cid for job in plan_jobs):
+        log.warning("the plan has no canonical ids. write it again with --plan-out to match queued jobs.")
+    queue = BatchQueue(args.queue) if args.queue else StateFileQueue(args.state_file)
+    monitor = Monitor(plan_jobs, queue, RemoteCache(args.cache), window=args.window, max_vcpus=args.max_vcpus)
+
+    while True:
+        snapshot = monitor.poll()
+        print(format_snapshot(snapshot))
+        sys.stdout.flush()
+        if args.snapshots:
+            with open(args.snapshots, "a") as outfd:
+                outfd.write(json.dumps(snapshot, sort_keys=True) + "\n")
+        if args.once or not snapshot['jobs_left']:
+            return 0
+        time.sleep(args.interval)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+
+from .align import Align
+from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+
+log = logging.getLogger(__name__)
+
+
+class MultiAlign(bunnies.Transform):
+    """
+    Align the reads of one run against several references, fetching the
+    input (and decoding it, for sras) once into gzipped fastqs on local
+    disk. Each alignment is published under the output prefix of the
+    equivalent standalone Align node, so merges and genotypes which depend
+    on the Align nodes are unchanged.
+
+    The aligners share the local fastqs, not a stream: each one reads and
+    decompresses them itself. The align tool takes whole files with a
+    known md5 in its jobfile, so its input can't be teed from one reader.
+    """
+    ALIGN_IMAGE = Align.ALIGN_IMAGE
+    VERSION = "1"
+
+    __slots__ = ("sample_name", "r1", "r2", "members")
+    kind = KIND_PREFIX + "MultiAlign"
+
+    def __init__(self, aligns=None, manifest=None):
+        """
+        aligns=[ Align nodes of the same run, one per reference ]
+        """
+        super().__init__("multialign", version=self.VERSION, image=self.ALIGN_IMAGE, manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            r1 = inputs['r1'].node
+            r2 = inputs['r2'].node if 'r2' in inputs else None
+            aligns = [Align(params['sample_name'], r1, r2,
+                            ref=inputs['ref%d' % (i,)].node,
+                            ref_idx=inputs['ref_idx%d' % (i,)].node,
+                            lossy=params['lossy'])
+                      for i in range(params['num_refs'])]
+
+        if not aligns:
+            raise ValueError("multi-reference alignment requires 1 or more alignments")
+
+        first = aligns[0]
+        for i, align in enumerate(aligns):
+            if (align.r1, align.r2, align.sample_name, align.params['lossy']) != \
+               (first.r1, first.r2, first.sample_name, first.params['lossy']):
+                raise ValueError("alignment %d is not of the same reads as alignment 0" % (i,))
+            if any(align.ref is other.ref for other in aligns[:i]):
+                raise ValueError("alignment %d has the same reference as an earlier alignment" % (i,))
+
+        if not SAMPLE_NAME_RE.match(first.sample_name):
+            raise ValueError("sample name %r does not match %s" % (
+                first.sample_name, SAMPLE_NAME_RE.pattern))
+
+        self.sample_name = first.sample_name
+        self.r1 = first.r1
+        self.r2 = first.r2
+        self.members = list(aligns)
+
+        self.add_input("r1", self.r1, desc="forward reads")
+        if self.r2:
+            self.add_input("r2", self.r2, desc="reverse reads")
+        for i, align in enumerate(aligns):
+            self.add_input("ref%d" % (i,), align.ref, desc="reference fasta %d" % (i,))
+            self.add_input("ref_idx%d" % (i,), align.ref_idx, desc="reference index %d" % (i,))
+
+        self.params["sample_name"] = first.sample_name
+        self.params["lossy"] = first.params['lossy']
+        self.params["num_refs"] = len(aligns)
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("MultiAlign tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.ALIGN_IMAGE
+        }
+
+    def task_resources(self, attempt=1, **kwargs):
+        # the aligners run side by side, each with a share of the node
+        num_refs = self.params['num_refs']
+        return {
+            'vcpus': min(64, 24 * num_refs) if attempt == 1 else 64,
+            'memory': min(250000, 80000 * num_refs),
+            'timeout': 24*3600 * attempt
+        }
+
+    def _fetch_reads(self, workdir, num_threads):
+        """
+        bring the reads to local disk once, as gzipped fastqs. sras are decoded here.
+        returns the read locations for the align jobfile.
+        """
+        import os
+        import os.path
+        import shutil
+        import hashlib
+        from .remote import RangedReader
+
+        def _md5(path):
+            md5 = hashlib.md5()
+            with open(path, "rb") as infd:
+                for block in iter(lambda: infd.read(4*1024*1024), b""):
+                    md5.update(block)
+            return "md5:" + md5.hexdigest()
+
+        def _download(target):
+            path = os.path.join(workdir, os.path.basename(target['url']))
+            with RangedReader(target['url'], size=target.get('size')) as reader, open(path, "wb") as outfd:
+                shutil.copyfileobj(reader, outfd, 16*1024*1024)
+            return path
+
+        r1_target = self.r1.ls()
+        if self.r2:
+            return [[path, _md5(path)] for path in (_download(r1_target), _download(self.r2.ls()))]
+
+        sra_path = _download(r1_target)
+        bunnies.run_cmd(["fasterq-dump", "--split-files", "--skip-technical", "-e", str(num_threads),
+                         "-t", workdir, "-O", workdir, sra_path], cwd=workdir)
+        os.unlink(sra_path)
+        stem = os.path.splitext(os.path.basename(sra_path))[0]
+        locations = []
+        for mate in (1, 2):
+            fastq = os.path.join(workdir, "%s_%d.fastq" % (stem, mate))
+            if not os.path.exists(fastq):
+                locations.append(["", ""])
+                continue
+            bunnies.run_cmd(["pigz", "-p", str(num_threads), fastq], cwd=workdir)
+            locations.append([fastq + ".gz", _md5(fastq + ".gz")])
+        return locations
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import os
+        import os.path
+        from concurrent.futures import ThreadPoolExecutor
+        from .packing import publish_result
+
+        workdir = params['workdir']
+        todo = [align for align in self.members if not align.exists()]
+        log.info("aligning %s against %d references (%d already built)", self.sample_name,
+                 len(self.members), len(self.members) - len(todo))
+        if todo:
+            reads_dir = os.path.join(workdir, "reads")
+            os.makedirs(reads_dir, exist_ok=True)
+            locations = self._fetch_reads(reads_dir, resources['vcpus'])
+            log.info("reads fetched once for all references: %s", locations)
+
+            share = {
+                'vcpus': max(1, resources['vcpus'] // len(todo)),
+                'memory': resources['memory'] // len(todo)
+            }
+
+            def _align(i):
+                align_params = dict(params)
+                align_params['workdir'] = os.path.join(workdir, "ref%d" % (i,))
+                align_params['locations'] = locations
+                os.makedirs(align_params['workdir'], exist_ok=True)
+                output = todo[i].run(resources=share, **align_params)
+                publish_result(todo[i], output, self.output_prefix())
+                return output
+
+            with ThreadPoolExecutor(max_workers=len(todo)) as executor:
+                list(executor.map(_align, range(len(todo))))
+
+        return {
+            "aligns": [align.output_prefix() for align in self.members]
+        }
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(sample_name)s-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'sample_name': self.params['sample_name'],
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(MultiAlign)
@@ -0,0 +1,331 @@
+"""
+Packing of small tasks into shared jobs.
+
+Trivial merges and alignments of small runs spend more time waiting for
+a container, a host and a copy of the reference than doing work. A Pack
+runs several such nodes in one job, in a local process pool, and
+publishes the result of each member under the member's own output
+prefix. Members are Packable: they are considered built once their pack
+has published their result, exactly as if they had run on their own.
+
+Only nodes whose inputs are already built are packed, so that building
+the packs never schedules the members themselves.
+"""
+
+import os
+import os.path
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+import bunnies
+import bunnies.unmarshall
+
+from .constants import KIND_PREFIX, PACKED_RESULT
+
+log = logging.getLogger(__name__)
+
+DEFAULT_BUDGET = {
+    'vcpus': 32,
+    'memory': 120000,
+    'timeout': 6 * 3600
+}
+
+# alignments of runs with less input than this are packed
+DEFAULT_SMALL_ALIGN_BYTES = 1 * 1024 * 1024 * 1024
+
+# the Packable nodes seen built, by packed result url: (url they exist at,
+# packed result or None if their own job built them). outputs don't change
+# once built, so only the lookups which found them are kept.
+_built = {}
+
+
+class Packable(object):
+    """
+    Mixin for transforms which can be built by another job (a Pack, or a
+    MultiAlign), or by a local build, which publishes their result under
+    their output prefix.
+    """
+    __slots__ = ()
+
+    def packed_result_url(self):
+        return os.path.join(self.output_prefix(), PACKED_RESULT)
+
+    def _packed_result(self):
+        import tempfile
+        try:
+            bunnies.utils.get_blob_meta(self.packed_result_url())
+        except bunnies.exc.NoSuchFile:
+            return None
+        with tempfile.NamedTemporaryFile(suffix=".json") as tmp_fd:
+            bunnies.transfers.s3_download_file(self.packed_result_url(), tmp_fd.name)
+            with open(tmp_fd.name, "r") as result_fd:
+                return json.load(result_fd)
+
+    def _lookup(self):
+        """(url the node exists at, packed result or None), or None if it isn't built"""
+        key = self.packed_result_url()
+        found = _built.get(key)
+        if found is None:
+            url = super().exists()
+            if url:
+                found = (url, None)
+            else:
+                result = self._packed_result()
+                if result is not None:
+                    found = (key, result)
+            if found is not None:
+                _built[key] = found
+        return found
+
+    def exists(self):
+        found = self._lookup()
+        return found[0] if found else False
+
+    def ls(self):
+        found = self._lookup()
+        if found is None:
+            raise bunnies.exc.NoSuchFile(self.packed_result_url())
+        if found[1] is None:
+            return super().ls()
+        return found[1]['output']
+
+
+def member_resources(member):
+    """
+    resources given to a member inside a pack. trivial merges keep their own
+    estimate. small alignments don't need the 32 vcpus of a full-size run.
+    """
+    from .align import Align
+    resources = member.task_resources(attempt=1)
+    if isinstance(member, Align):
+        gbs = float(member.input_bytes()) / (1024*1024*1024)
+        return {
+            'vcpus': 8,
+            'memory': 30000,
+            'timeout': max(int(gbs * 2 * 3600), 1800)  # 2h per gb (min 30m)
+        }
+    return resources
+
+
+def is_small(node, small_align_bytes=DEFAULT_SMALL_ALIGN_BYTES):
+    """whether node is worth packing: a trivial merge, or an alignment of a small run"""
+    from .align import Align
+    from .alignchunk import AlignChunk
+    from .merge import Merge
+    if isinstance(node, Merge):
+        return node.params['num_bams'] <= 1
+    if isinstance(node, Align) and not isinstance(node, AlignChunk):
+        return node.input_bytes() < small_align_bytes
+    return False
+
+
+def inputs_built(node):
+    """whether all the transforms node depends on are built already"""
+    for inputval in node.inputs.values():
+        dep = inputval.node
+        if isinstance(dep, bunnies.Transform) and not dep.exists():
+            return False
+    return True
+
+
+def pack_nodes(nodes, budget=None, jobs=32):
+    """
+    bin-pack nodes into groups which fit the budget. nodes of different kinds,
+    or aligned against different references, are not packed together.
+    Members run concurrently within the vcpu and memory budget, and the
+    estimated duration of each pack (sum of member time / slots) stays
+    within the time budget. returns a list of lists of (node, resources).
+    """
+    budget = dict(DEFAULT_BUDGET, **(budget or {}))
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        all_resources = list(executor.map(member_resources, nodes))
+    by_group = {}
+    for node, resources in zip(nodes, all_resources):
+        by_group.setdefault((node.kind, id(getattr(node, 'ref', None))), []).append((node, resources))
+
+    packs = []
+    for group in by_group.values():
+        # first fit, longest first
+        group.sort(key=lambda item: item[1]['timeout'], reverse=True)
+        open_packs = []
+        for node, resources in group:
+            slots = max(1, min(budget['vcpus'] // resources['vcpus'],
+                               budget['memory'] // resources['memory']))
+            for pack in open_packs:
+                if pack['work'] + resources['timeout'] <= budget['timeout'] * pack['slots']:
+                    pack['members'].append((node, resources))
+                    pack['work'] += resources['timeout']
+                    break
+            else:
+                open_packs.append({'members': [(node, resources)], 'work': resources['timeout'], 'slots': slots})
+        packs += [pack['members'] for pack in open_packs if len(pack['members']) > 1]
+    return packs
+
+
+def packable_kinds():
+    """the transforms which can be members of a pack, by kind"""
+    from .align import Align
+    from .merge import Merge
+    return {cls.kind: cls for cls in (Align, Merge)}
+
+
+_running_pack = None
+
+
+def publish_result(member, output, built_by):
+    """
+    write the result of member where Packable looks for it. built_by
+    describes what built it (the output prefix of a pack, or a host).
+    """
+    import tempfile
+    with tempfile.NamedTemporaryFile(mode="w", suffix=".json", delete=False) as result_fd:
+        json.dump({'output': output, 'built_by': built_by}, result_fd, sort_keys=True)
+    bunnies.transfers.s3_upload_file(result_fd.name, member.packed_result_url())
+    os.unlink(result_fd.name)
+
+
+def _run_member(memberi, resources, params):
+    """entry point of the pool workers. the pack is inherited through fork."""
+    member = _running_pack.members[memberi]
+    member_params = dict(params)
+    member_params['workdir'] = os.path.join(params['workdir'], "member%03d" % (memberi,))
+    os.makedirs(member_params['workdir'], exist_ok=True)
+    return member.run(resources=resources, **member_params)
+
+
+class Pack(bunnies.Transform):
+    """
+    Run several small nodes of the same kind in a single job
+    """
+    PACK_IMAGE = "rieseberglab/analytics:7-2.5.8"
+    VERSION = "1"
+
+    __slots__ = ("members",)
+    kind = KIND_PREFIX + "Pack"
+
+    def __init__(self, members=None, member_resources=None, manifest=None):
+        """
+        members=[ Packable nodes ]
+        member_resources=[ resources of each member within the pack ]
+        """
+        super().__init__("pack", version=self.VERSION, image=self.PACK_IMAGE, manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            members = []
+            member_resources = []
+            for desc in params['members']:
+                member_cls = packable_kinds()[desc['kind']]
+                member_inputs = {key: inputs[packkey] for key, packkey in desc['inputs'].items()}
+                members.append(member_cls(manifest={'inputs': member_inputs, 'params': desc['params']}))
+                member_resources.append(desc['resources'])
+
+        if not members:
+            raise ValueError("a pack requires 1 or more members")
+        if len(set(member.kind for member in members)) > 1:
+            raise ValueError("members of a pack must all be of the same kind")
+
+        self.members = list(members)
+        descs = []
+        for memberi, (member, resources) in enumerate(zip(members, member_resources)):
+            desc = {'kind': member.kind, 'params': member.params, 'inputs': {}, 'resources': resources}
+            for key, inputval in member.inputs.items():
+                packkey = "m%d_%s" % (memberi, key)
+                self.add_input(packkey, inputval.node, desc="input %s of member %d" % (key, memberi))
+                desc['inputs'][key] = packkey
+            descs.append(desc)
+        self.params['members'] = descs
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("Pack tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.PACK_IMAGE
+        }
+
+    def _slots(self, vcpus, memory):
+        largest = max(self.params['members'], key=lambda desc: desc['resources']['vcpus'])['resources']
+        return max(1, min(vcpus // largest['vcpus'], memory // largest['memory']))
+
+    def task_resources(self, attempt=1, **kwargs):
+        descs = self.params['members']
+        vcpus = min(DEFAULT_BUDGET['vcpus'], sum(desc['resources']['vcpus'] for desc in descs))
+        memory = min(DEFAULT_BUDGET['memory'], sum(desc['resources']['memory'] for desc in descs))
+        work = sum(desc['resources']['timeout'] for desc in descs)
+        longest = max(desc['resources']['timeout'] for desc in descs)
+        # the pack lasts at least as long as its longest member
+        timeout = max(int(1.5 * work / self._slots(vcpus, memory)), longest, 3600)
+        return {
+            'vcpus': vcpus,
+            'memory': memory,
+            'timeout': timeout * attempt
+        }
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+
+        global _running_pack
+        _running_pack = self
+
+        slots = self._slots(resources['vcpus'], resources['memory'])
+        descs = self.params['members']
+        todo = [i for i, member in enumerate(self.members) if not member.exists()]
+        log.info("pack of %d %s: %d already built, running %d with %d slots",
+                 len(self.members), self.members[0].kind, len(self.members) - len(todo), len(todo), slots)
+
+        failed = []
+        with ProcessPoolExecutor(max_workers=slots, mp_context=multiprocessing.get_context("fork")) as executor:
+            futures = {i: executor.submit(_run_member, i, descs[i]['resources'], params) for i in todo}
+            for i, future in futures.items():
+                try:
+                    output = future.result()
+                except Exception as exc:
+                    log.error("member %d (%s) failed: %s", i, self.members[i].output_prefix(), exc)
+                    failed.append(i)
+                    continue
+                publish_result(self.members[i], output, self.output_prefix())
+
+        if failed:
+            # a retry of the pack only runs the members which failed
+            raise Exception("%d of %d members failed: %s" % (len(failed), len(todo), failed))
+
+        return {
+            "members": [member.output_prefix() for member in self.members]
+        }
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(kind)s-%(num)d-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'kind': self.params['members'][0]['kind'].split(".")[-1].lower(),
+            'num': len(self.params['members']),
+            'cid': self.canonical_id
+        }
+
+
+def plan_packs(nodes, budget=None, small_align_bytes=DEFAULT_SMALL_ALIGN_BYTES, jobs=32):
+    """
+    pack the small, unbuilt nodes among nodes whose inputs are all built.
+    the nodes are looked up in `jobs` threads. returns a list of Pack nodes
+    """
+    def _candidate(node):
+        return is_small(node, small_align_bytes) and not node.exists() and inputs_built(node)
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        candidates = [node for node, is_candidate in zip(nodes, executor.map(_candidate, nodes)) if is_candidate]
+    packs = [Pack([node for node, _ in members], [resources for _, resources in members])
+             for members in pack_nodes(candidates, budget, jobs=jobs)]
+    log.info("packing %d of %d nodes into %d packs", sum(len(pack.members) for pack in packs),
+             len(nodes), len(packs))
+    return packs
+
+
+bunnies.unmarshall.register_kind(Pack)
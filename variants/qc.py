@@ -0,0 +1,302 @@
+"""
+Quality control of aligned samples.
+
+Reads the bamstats, dupmetrics and (for Align outputs) illuminametrics
+files of many outputs concurrently, and computes per sample:
+
+  coverage      -- mapped bases / genome size
+  insert_size   -- average insert size
+  dup_rate      -- fraction of duplicate reads
+  mapping_rate  -- fraction of reads mapped
+
+A sample fails QC when a metric crosses an absolute threshold, or when it
+is an outlier relative to the other samples on the same reference (robust
+z-score over the median and MAD).
+
+  python -m variants qc greg59/greg59.merged.tsv --output greg59/qc.tsv
+
+The same checks can gate the genotyping stage; see --qc-gate in
+python -m variants --help.
+"""
+
+import sys
+import argparse
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from .metrics import parse_bamstats, parse_dupmetrics, parse_alignment_summary
+from .references import fai_url, parse_fai
+from .remote import RemoteCache, DEFAULT_CACHE_DIR
+from .report import Frame, load_table, output_kind
+
+log = logging.getLogger(__name__)
+
+METRICS = ("coverage", "insert_size", "dup_rate", "mapping_rate")
+
+# which side of the distribution is bad. -1: low values, +1: high values, 0: both
+DIRECTIONS = {
+    "coverage": -1,
+    "insert_size": 0,
+    "dup_rate": 1,
+    "mapping_rate": -1,
+}
+
+DEFAULT_THRESHOLDS = {
+    "min_coverage": 2.0,
+    "max_dup_rate": 0.4,
+    "min_mapping_rate": 0.85,
+    "max_z": 4.0,
+}
+
+# MAD to standard deviation, for normally distributed values
+MAD_SCALE = 1.4826
+
+
+def _read_optional(cache, url):
+    if not url:
+        return None
+    try:
+        return cache.read_text(url)
+    except Exception as exc:
+        log.warning("cannot read %s: %s", url, exc)
+        return None
+
+
+def sample_metrics(cache, urls):
+    """
+    urls is {"bamstats": url, "dupmetrics": url, "illuminametrics": url}, any may be None.
+    returns the raw numbers needed to compute the QC metrics
+    """
+    rec = {}
+    bamstats = _read_optional(cache, urls.get("bamstats"))
+    if bamstats:
+        stats = parse_bamstats(bamstats)
+        rec['bases_mapped'] = stats.get('bases_mapped')
+        rec['insert_size'] = stats.get('insert_size')
+        if stats.get('reads_total'):
+            rec['mapping_rate'] = stats.get('reads_mapped', 0.0) / stats['reads_total']
+    dupmetrics = _read_optional(cache, urls.get("dupmetrics"))
+    if dupmetrics:
+        rec['dup_rate'] = parse_dupmetrics(dupmetrics).get('dup_rate')
+    if rec.get('mapping_rate') is None:
+        illumina = _read_optional(cache, urls.get("illuminametrics"))
+        if illumina:
+            rec['mapping_rate'] = parse_alignment_summary(illumina).get("PCT_PF_READS_ALIGNED")
+    return rec
+
+
+def genome_sizes(cache, refnames):
+    """total length of each reference, from its fasta index"""
+    return {name: float(sum(length for _, length in parse_fai(cache.read_text(fai_url(name)))))
+            for name in set(refnames)}
+
+
+def metric_arrays(records, sizes):
+    """
+    records are dicts with 'reference' and the output of sample_metrics().
+    returns {metric: float array}, NaN where unknown
+    """
+    def _col(name):
+        return np.array([rec.get(name) if rec.get(name) is not None else np.nan for rec in records],
+                        dtype=np.float64)
+
+    genome = np.array([sizes.get(rec['reference'], np.nan) for rec in records], dtype=np.float64)
+    arrays = OrderedDict()
+    arrays['coverage'] = _col('bases_mapped') / genome
+    arrays['insert_size'] = _col('insert_size')
+    arrays['dup_rate'] = _col('dup_rate')
+    arrays['mapping_rate'] = _col('mapping_rate')
+    return arrays
+
+
+def robust_z(values, groups):
+    """
+    (x - median) / (MAD_SCALE * MAD), computed within each group. NaNs are ignored,
+    and a group without spread gets z=0.
+    """
+    z = np.zeros(len(values), dtype=np.float64)
+    for group in np.unique(groups):
+        idx = np.nonzero((groups == group) & ~np.isnan(values))[0]
+        if not len(idx):
+            continue
+        vals = values[idx]
+        median = np.median(vals)
+        mad = np.median(np.abs(vals - median)) * MAD_SCALE
+        if mad > 0:
+            z[idx] = (vals - median) / mad
+    return z
+
+
+def evaluate(arrays, groups, thresholds=None):
+    """
+    flag failing samples. returns (failed bool array, reasons list of str)
+    """
+    thresholds = dict(DEFAULT_THRESHOLDS, **(thresholds or {}))
+    n = len(groups)
+    checks = OrderedDict()
+
+    with np.errstate(invalid="ignore"):
+        checks['low_coverage'] = arrays['coverage'] < thresholds['min_coverage']
+        checks['high_dup_rate'] = arrays['dup_rate'] > thresholds['max_dup_rate']
+        checks['low_mapping_rate'] = arrays['mapping_rate'] < thresholds['min_mapping_rate']
+        # dupmetrics are optional: trivial merges do not produce them
+        checks['missing_bamstats'] = np.isnan(arrays['coverage'])
+        for metric in METRICS:
+            z = robust_z(arrays[metric], groups)
+            direction = DIRECTIONS[metric]
+            if direction == 0:
+                checks['outlier_' + metric] = np.abs(z) > thresholds['max_z']
+            else:
+                checks['outlier_' + metric] = z * direction > thresholds['max_z']
+
+    names = list(checks)
+    matrix = np.column_stack([checks[name] for name in names]) if n else np.zeros((0, len(names)), dtype=bool)
+    failed = matrix.any(axis=1)
+    reasons = [",".join(names[j] for j in np.nonzero(row)[0]) for row in matrix]
+    return failed, reasons
+
+
+def qc_frame(records, arrays, failed, reasons):
+    columns = OrderedDict()
+    for key in ("set", "sample", "reference", "url"):
+        columns[key] = np.array([rec.get(key, "") for rec in records], dtype=str)
+    columns.update(arrays)
+    columns['status'] = np.where(failed, "FAIL", "PASS") if len(failed) else np.array([], dtype=str)
+    columns['reasons'] = np.array(reasons, dtype=str)
+    return Frame(columns)
+
+
+def evaluate_outputs(cache, records, thresholds=None, sizes=None):
+    """
+    records: dicts with 'sample', 'reference' and 'urls' (see sample_metrics).
+    fetches the metrics concurrently, and returns a Frame with one row per record.
+    sizes optionally provides the genome size of references, by name.
+    """
+    fetched = cache.map(lambda rec: sample_metrics(cache, rec['urls']), records)
+    for rec, metrics in zip(records, fetched):
+        rec.update(metrics)
+    sizes = dict(sizes or {})
+    unknown = [rec['reference'] for rec in records if rec['reference'] not in sizes]
+    sizes.update(genome_sizes(cache, unknown))
+    arrays = metric_arrays(records, sizes)
+    groups = np.array([rec['reference'] for rec in records], dtype=str)
+    failed, reasons = evaluate(arrays, groups, thresholds)
+    return qc_frame(records, arrays, failed, reasons)
+
+
+def gate_genotypes(gvcfs, refname_of, cache, thresholds=None):
+    """
+    Drop Genotype targets whose merged bam fails QC. Genotypes whose merge is
+    not built yet are replaced by the merge itself, so that QC can be
+    evaluated on the next run. The merges are looked up concurrently, in the
+    threads of cache.
+
+    returns (targets, qc frame)
+    """
+    def _outputs(gvcf):
+        """outputs of the merge of gvcf, or None if it isn't built"""
+        merged = gvcf.sample_bam
+        return merged.ls() if merged.exists() else None
+
+    records = []
+    evaluated = []
+    targets = []
+    for gvcf, outputs in zip(gvcfs, cache.map(_outputs, gvcfs)):
+        if outputs is None:
+            targets.append(gvcf.sample_bam)
+            continue
+        records.append({
+            "sample": gvcf.sample_name,
+            "reference": refname_of(gvcf.ref),
+            "url": gvcf.sample_bam.output_prefix(),
+            "urls": {key: (outputs.get(key) or {}).get('url') for key in ("bamstats", "dupmetrics")}
+        })
+        evaluated.append(gvcf)
+
+    frame = evaluate_outputs(cache, records, thresholds)
+    passed = frame['status'] == "PASS"
+    targets += [gvcf for gvcf, ok in zip(evaluated, passed) if ok]
+    log.info("qc gate: %d samples pass, %d fail, %d held back until merged",
+             int(passed.sum()), int((~passed).sum()), len(gvcfs) - len(evaluated))
+    for i in np.nonzero(~passed)[0]:
+        log.warning("qc gate: not genotyping %s (%s): %s",
+                    frame['sample'][i], frame['reference'][i], frame['reasons'][i])
+    return targets, frame
+
+
+def _table_records(tables):
+    records = []
+    for set_name, path in tables:
+        for row in load_table(path, set_name):
+            kind = output_kind(row['url'])
+            if kind not in ("align", "merge"):
+                continue
+            pfx = row['url'] + row['sample']
+            row['urls'] = {
+                "bamstats": pfx + ".bamstats.txt",
+                "dupmetrics": pfx + ".dupmetrics.txt",
+                "illuminametrics": pfx + ".illuminametrics.txt" if kind == "align" else None
+            }
+            records.append(row)
+    return records
+
+
+def main(argv=None):
+    from . import setup_logging
+    from .report import named_path
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="python -m variants qc", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tables", metavar="[SET=]TABLE", nargs="+", type=named_path,
+                        help="table of align or merge outputs. the sample set defaults to the directory name")
+    parser.add_argument("--min-coverage", type=float, default=DEFAULT_THRESHOLDS['min_coverage'],
+                        help="(default: %(default)s)")
+    parser.add_argument("--max-dup-rate", type=float, default=DEFAULT_THRESHOLDS['max_dup_rate'],
+                        help="(default: %(default)s)")
+    parser.add_argument("--min-mapping-rate", type=float, default=DEFAULT_THRESHOLDS['min_mapping_rate'],
+                        help="(default: %(default)s)")
+    parser.add_argument("--max-z", type=float, default=DEFAULT_THRESHOLDS['max_z'],
+                        help="robust z-score beyond which a sample is an outlier (default: %(default)s)")
+    parser.add_argument("--genome-size", metavar="REF=BP", action="append", default=[],
+                        type=named_path,
+                        help="genome size of a reference. default is the total length in its fasta index")
+    parser.add_argument("--failed-only", action="store_true", default=False,
+                        help="only print samples failing QC")
+    parser.add_argument("--output", metavar="TSV", type=str, default=None,
+                        help="write to this file instead of stdout")
+    parser.add_argument("--cache", metavar="DIR", type=str, default=DEFAULT_CACHE_DIR,
+                        help="local cache of metrics files (default: %(default)s)")
+    parser.add_argument("--jobs", metavar="N", type=int, default=32,
+                        help="concurrent requests (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    thresholds = {
+        "min_coverage": args.min_coverage,
+        "max_dup_rate": args.max_dup_rate,
+        "min_mapping_rate": args.min_mapping_rate,
+        "max_z": args.max_z,
+    }
+    cache = RemoteCache(args.cache, jobs=args.jobs)
+    records = _table_records(args.tables)
+    log.info("fetching metrics of %d outputs...", len(records))
+    sizes = {name: float(size) for name, size in args.genome_size}
+    frame = evaluate_outputs(cache, records, thresholds, sizes)
+
+    failed = frame['status'] == "FAIL"
+    log.info("%d of %d samples fail QC", int(failed.sum()), len(frame))
+    if args.failed_only:
+        frame = frame.filter(failed)
+
+    if args.output:
+        with open(args.output, "w") as outfd:
+            frame.write_tsv(outfd)
+    else:
+        frame.write_tsv(sys.stdout)
+    return 1 if failed.any() else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
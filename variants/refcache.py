@@ -0,0 +1,160 @@
+"""
+Reference files cached on the compute hosts.
+
+Jobs get their reference from the content-addressed store (cas) in
+/localscratch, which is shared by the jobs of a host. Fetches of the same
+digest are serialized with a lock, so jobs starting together on a new
+host wait for the one copy instead of each fetching it, and fetched
+digests are marked warm, so later jobs don't even run cas.
+
+The first job to start on a host prewarms it: it fetches the references
+of the whole submitted graph, which the driver passes in a startup hook.
+The other jobs only wait for the digests they need.
+
+Hits, misses and the time spent waiting are added to the attributes of
+the timings span of the fetch.
+"""
+
+import os
+import os.path
+import time
+import fcntl
+import logging
+import contextlib
+
+log = logging.getLogger(__name__)
+
+# shared by the jobs of a host. local builds can point it elsewhere (--local-cas-dir)
+CAS_DIR = "/localscratch/cas"
+
+
+def _warm_dir(casdir):
+    path = os.path.join(casdir, ".warm")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+@contextlib.contextmanager
+def _locked(path, blocking=True):
+    """flock on path. yields False if not blocking and the lock is held elsewhere."""
+    with open(path, "a") as lock_fd:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        except BlockingIOError:
+            yield False
+            return
+        try:
+            yield True
+        finally:
+            fcntl.flock(lock_fd, fcntl.LOCK_UN)
+
+
+def _warm_path(casdir, md5_digest):
+    """path of the cached copy of a digest, if it is marked warm and still there"""
+    marker = os.path.join(_warm_dir(casdir), md5_digest)
+    try:
+        with open(marker, "r") as marker_fd:
+            path = marker_fd.read().strip()
+    except FileNotFoundError:
+        return None
+    return path if os.path.exists(path) else None
+
+
+def cache_file(url, md5_digest, casdir=None, span=None):
+    """
+    local path of the file at url, fetched into casdir once per host.
+    span=timings span counting the hits, misses and wait of the fetch
+    """
+    import bunnies
+    casdir = casdir or CAS_DIR
+
+    def _count(key, value=1):
+        if span is not None:
+            span.attrs[key] = span.attrs.get(key, 0) + value
+
+    os.makedirs(casdir, exist_ok=True)
+    path = _warm_path(casdir, md5_digest)
+    if path:
+        _count("cache_hits")
+        return path
+
+    start = time.time()
+    with _locked(os.path.join(_warm_dir(casdir), md5_digest + ".lock")):
+        # another job may have fetched it while we waited
+        path = _warm_path(casdir, md5_digest)
+        if path:
+            _count("cache_hits")
+            _count("cache_wait_s", time.time() - start)
+            return path
+        path = bunnies.run_cmd([
+            "cas", "-put", url, "-get", "md5:" + md5_digest, casdir
+        ]).stdout.decode('utf-8').strip()
+        marker = os.path.join(_warm_dir(casdir), md5_digest)
+        with open(marker + ".tmp", "w") as marker_fd:
+            marker_fd.write(path + "\n")
+        os.replace(marker + ".tmp", marker)
+    _count("cache_misses")
+    if span is not None:
+        span.add_file(path)
+    return path
+
+
+def cache_reference(node, casdir=None, span=None, with_fasta=True):
+    """
+    (fasta path, fai path) of the reference of node. the fasta path is None
+    unless with_fasta.
+    """
+    ref_idx_target = node.ref_idx.ls()
+    ref_idx_path = cache_file(ref_idx_target['url'], ref_idx_target['digests']['md5'], casdir, span)
+    ref_path = None
+    if with_fasta:
+        ref_target = node.ref.ls()
+        ref_path = cache_file(ref_target['url'], ref_target['digests']['md5'], casdir, span)
+        if span is not None:
+            span.attrs['ref_md5'] = ref_target['digests']['md5']
+    return ref_path, ref_idx_path
+
+
+def reference_bundles(targets):
+    """[[url, md5] ...] of the reference files of the nodes of the graph of targets"""
+    import bunnies
+    seen, files, stack = set(), {}, list(targets)
+    while stack:
+        node = stack.pop()
+        if id(node) in seen:
+            continue
+        seen.add(id(node))
+        for inputval in node.inputs.values():
+            if isinstance(inputval.node, bunnies.Transform):
+                stack.append(inputval.node)
+        for attr in ("ref", "ref_idx"):
+            ref_file = getattr(node, attr, None)
+            if ref_file is not None:
+                files[id(ref_file)] = ref_file
+    bundles = {}
+    for ref_file in files.values():
+        target = ref_file.ls()
+        bundles[target['digests']['md5']] = target['url']
+    return sorted([url, md5] for md5, url in bundles.items())
+
+
+def prewarm_host(bundles, casdir=None, jobs=4):
+    """
+    fetch the bundles [[url, md5] ...] into the cache of this host, unless
+    another job of the host is doing it already. runs in the startup hook
+    of every job.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    casdir = casdir or CAS_DIR
+    os.makedirs(casdir, exist_ok=True)
+    cold = [(url, md5) for url, md5 in bundles if not _warm_path(casdir, md5)]
+    if not cold:
+        return 0
+    with _locked(os.path.join(_warm_dir(casdir), "prewarm.lock"), blocking=False) as acquired:
+        if not acquired:
+            return 0
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            list(executor.map(lambda bundle: cache_file(bundle[0], bundle[1], casdir), cold))
+        log.info("prewarmed %d reference files in %.1fs", len(cold), time.time() - start)
+    return len(cold)
@@ -0,0 +1,64 @@
+"""
+Genome references known to the pipeline
+"""
+
+from collections import namedtuple, OrderedDict
+
+Reference = namedtuple("Reference", ["name", "ref", "ref_idx"])
+
+# shortname => (fasta url, fasta description, index url, index description)
+REFERENCE_URLS = OrderedDict([
+    ("xrqv2", ("s3://rieseberg-references/HanXRQ2.0-20180814/annotated/HanXRQr2.0-SUNRISE-2.1.genome.fasta",
+               "HanXRQv2 genome reference (.fasta)",
+               "s3://rieseberg-references/HanXRQ2.0-20180814/annotated/HanXRQr2.0-SUNRISE-2.1.genome.fasta.fai",
+               "HanXRQv2 genome reference index")),
+    ("psc8", ("s3://rieseberg-references/HanPSC8r1.0-20181105/HanPSC8_genome.fasta",
+              "HanPSC8v1 genome reference (.fasta)",
+              "s3://rieseberg-references/HanPSC8r1.0-20181105/HanPSC8_genome.fasta.fai",
+              "HanPSC8v1 genome reference index")),
+    ("ha412", ("s3://ubc-sunflower-genome/references/HA412/genome/Ha412HOv2.0-20181130.fasta",
+               "Ha412HO genome reference (.fasta)",
+               "s3://ubc-sunflower-genome/references/HA412/genome/Ha412HOv2.0-20181130.fasta.fai",
+               "Ha412HO genome reference index")),
+])
+
+SUPPORTED_REFERENCES = tuple(REFERENCE_URLS)
+
+
+def get_reference(shortname):
+    from . import InputFile
+
+    shortname = shortname.lower()
+    if shortname in get_reference.cache:
+        return get_reference.cache[shortname]
+
+    if shortname not in REFERENCE_URLS:
+        raise Exception("unrecognized reference name: " + shortname)
+
+    ref_url, ref_desc, idx_url, idx_desc = REFERENCE_URLS[shortname]
+    ref = InputFile(ref_url, desc=ref_desc)
+    ref_idx = InputFile(idx_url, desc=idx_desc)
+
+    get_reference.cache[shortname] = Reference(shortname, ref, ref_idx)
+    return get_reference.cache[shortname]
+
+
+get_reference.cache = {}
+
+
+def fai_url(shortname):
+    return REFERENCE_URLS[shortname.lower()][2]
+
+
+def parse_fai(text):
+    """
+    contig table of a fasta index. returns [(contig, length), ...] in file order
+    """
+    contigs = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        toks = line.split("\t")
+        contigs.append((toks[0], int(toks[1])))
+    return contigs
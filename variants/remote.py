@@ -0,0 +1,374 @@
+"""
+Read access to build outputs, with a local cache.
+
+URLs are either s3://bucket/key or plain local paths, so reports and
+checks can be run against a local copy of the outputs.
+"""
+
+import io
+import os
+import os.path
+import json
+import hashlib
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .constants import COMPLETION_MARKERS
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "variants")
+
+# seconds a listing without a completion marker is kept, when it holds the
+# outputs of a job built before the markers existed
+LEGACY_LISTING_TTL = 15 * 60
+
+_s3_local = threading.local()
+
+
+def _s3_client():
+    # boto3 clients are thread safe, but sessions are not. one per thread.
+    if not hasattr(_s3_local, "client"):
+        import boto3
+        _s3_local.client = boto3.session.Session().client("s3")
+    return _s3_local.client
+
+
+def split_s3_url(url):
+    if not url.startswith("s3://"):
+        raise ValueError("not an s3 url: %s" % (url,))
+    bucket, _, key = url[len("s3://"):].partition("/")
+    return bucket, key
+
+
+def list_prefix(url):
+    """
+    list the objects directly under a prefix (s3://bucket/prefix/ or local dir).
+    returns {basename: size}
+    """
+    if not url.endswith("/"):
+        url += "/"
+    listing = {}
+    if not url.startswith("s3://"):
+        if os.path.isdir(url):
+            for fname in os.listdir(url):
+                path = os.path.join(url, fname)
+                if os.path.isfile(path):
+                    listing[fname] = os.stat(path).st_size
+        return listing
+
+    bucket, key = split_s3_url(url)
+    paginator = _s3_client().get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=key, Delimiter="/"):
+        for obj in page.get("Contents", []):
+            listing[obj['Key'][len(key):]] = obj['Size']
+    return listing
+
+
+def read_bytes(url, start=None, end=None):
+    """
+    read an object, or the byte range [start, end) of it
+    """
+    if not url.startswith("s3://"):
+        with open(url, "rb") as infd:
+            if start is None:
+                return infd.read()
+            infd.seek(start)
+            return infd.read(end - start)
+
+    bucket, key = split_s3_url(url)
+    kwargs = {}
+    if start is not None:
+        kwargs['Range'] = "bytes=%d-%d" % (start, end - 1)
+    resp = _s3_client().get_object(Bucket=bucket, Key=key, **kwargs)
+    return resp['Body'].read()
+
+
+def object_size(url):
+    if not url.startswith("s3://"):
+        return os.stat(url).st_size
+    bucket, key = split_s3_url(url)
+    return _s3_client().head_object(Bucket=bucket, Key=key)['ContentLength']
+
+
+def object_exists(url):
+    if not url.startswith("s3://"):
+        return os.path.exists(url)
+    from botocore.exceptions import ClientError
+    try:
+        object_size(url)
+    except ClientError as exc:
+        if exc.response.get('Error', {}).get('Code') in ("404", "NoSuchKey", "NotFound"):
+            return False
+        raise
+    return True
+
+
+def _verify_upload(url, size, etag=None):
+    """check the size (and the etag, when s3 computes it from the data) of an uploaded object"""
+    if not url.startswith("s3://"):
+        remote_size, remote_etag = os.stat(url).st_size, None
+    else:
+        bucket, key = split_s3_url(url)
+        head = _s3_client().head_object(Bucket=bucket, Key=key)
+        remote_size = head['ContentLength']
+        # etags of kms-encrypted objects are not md5s
+        remote_etag = None if head.get('ServerSideEncryption') == "aws:kms" else head['ETag'].strip('"')
+    if remote_size != size:
+        raise Exception("uploaded %s has %d bytes. expected %d" % (url, remote_size, size))
+    if etag and remote_etag and remote_etag != etag:
+        raise Exception("uploaded %s has etag %s. expected %s" % (url, remote_etag, etag))
+
+
+def upload_file(path, url, part_size=64*1024*1024, parallel=8):
+    """
+    upload the file at path to url. the md5 of the data is computed as it is
+    read for the upload. files larger than part_size are sent as a multipart
+    upload, with `parallel` parts in flight. the size and etag of the remote
+    object are verified. returns {"url", "size", "md5", "seconds"}
+    """
+    start = time.time()
+    md5 = hashlib.md5()
+    size = 0
+
+    if not url.startswith("s3://"):
+        os.makedirs(os.path.dirname(url) or ".", exist_ok=True)
+        with open(path, "rb") as infd, open(url + ".tmp", "wb") as outfd:
+            for block in iter(lambda: infd.read(4*1024*1024), b""):
+                md5.update(block)
+                outfd.write(block)
+                size += len(block)
+        os.replace(url + ".tmp", url)
+        _verify_upload(url, size)
+        return {"url": url, "size": size, "md5": md5.hexdigest(), "seconds": time.time() - start}
+
+    bucket, key = split_s3_url(url)
+    client = _s3_client()
+    if os.stat(path).st_size <= part_size:
+        with open(path, "rb") as infd:
+            data = infd.read()
+        md5.update(data)
+        size = len(data)
+        client.put_object(Bucket=bucket, Key=key, Body=data)
+        _verify_upload(url, size, md5.hexdigest())
+        return {"url": url, "size": size, "md5": md5.hexdigest(), "seconds": time.time() - start}
+
+    upload_id = client.create_multipart_upload(Bucket=bucket, Key=key)['UploadId']
+    # bounds the number of parts held in memory
+    in_flight = threading.BoundedSemaphore(parallel)
+    part_digests = []
+
+    def _put_part(part_number, data):
+        try:
+            resp = _s3_client().upload_part(Bucket=bucket, Key=key, UploadId=upload_id,
+                                            PartNumber=part_number, Body=data)
+            return {"PartNumber": part_number, "ETag": resp['ETag']}
+        finally:
+            in_flight.release()
+
+    try:
+        futures = []
+        with ThreadPoolExecutor(max_workers=parallel) as executor, open(path, "rb") as infd:
+            while True:
+                in_flight.acquire()
+                data = infd.read(part_size)
+                if not data:
+                    in_flight.release()
+                    break
+                md5.update(data)
+                part_digests.append(hashlib.md5(data).digest())
+                size += len(data)
+                futures.append(executor.submit(_put_part, len(futures) + 1, data))
+            parts = [future.result() for future in futures]
+        client.complete_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id,
+                                         MultipartUpload={"Parts": parts})
+    except BaseException:
+        client.abort_multipart_upload(Bucket=bucket, Key=key, UploadId=upload_id)
+        raise
+
+    multipart_etag = "%s-%d" % (hashlib.md5(b"".join(part_digests)).hexdigest(), len(part_digests))
+    _verify_upload(url, size, multipart_etag)
+    return {"url": url, "size": size, "md5": md5.hexdigest(), "seconds": time.time() - start}
+
+
+def upload_files(uploads, jobs=4, **kwargs):
+    """
+    upload [(path, url) ...] concurrently. returns the results of upload_file, in order.
+    """
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(executor.map(lambda upload: upload_file(upload[0], upload[1], **kwargs), uploads))
+    elapsed = time.time() - start
+    total = sum(result['size'] for result in results)
+    for result in results:
+        log.info("uploaded %s: %d bytes in %.1fs (%.1f MB/s)", result['url'], result['size'], result['seconds'],
+                 result['size'] / 1048576.0 / result['seconds'] if result['seconds'] else 0.0)
+    log.info("uploaded %d files, %d bytes in %.1fs (%.1f MB/s)", len(results), total, elapsed,
+             total / 1048576.0 / elapsed if elapsed else 0.0)
+    return results
+
+
+def listing_complete(listing):
+    """whether a listing {basename: size} holds a completion marker"""
+    return any(name.endswith(COMPLETION_MARKERS) for name in listing)
+
+
+class RemoteCache(object):
+    """
+    Local cache of prefix listings and small objects.
+
+    Build outputs live under prefixes named after their canonical id, so
+    their contents never change once they are complete. Listings are only
+    kept once they are: while a job runs, its prefix fills up, and its
+    outputs are uploaded concurrently, so only the completion markers the
+    jobs write last tell that it is done.
+    """
+    def __init__(self, cachedir=DEFAULT_CACHE_DIR, refresh=False, jobs=16):
+        self.cachedir = cachedir
+        self.refresh = refresh
+        self.jobs = jobs
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        for sub in ("list", "blob"):
+            os.makedirs(os.path.join(cachedir, sub), exist_ok=True)
+
+    def _path(self, kind, url, suffix=""):
+        digest = hashlib.sha1((url + suffix).encode("utf-8")).hexdigest()
+        return os.path.join(self.cachedir, kind, digest[0:2], digest)
+
+    def _load(self, path, ttl=None):
+        expired = ttl is not None and os.path.exists(path) and time.time() - os.stat(path).st_mtime > ttl
+        if self.refresh or expired or not os.path.exists(path):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        with open(path, "rb") as infd:
+            return infd.read()
+
+    def _store(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.%d.%d.tmp" % (path, os.getpid(), threading.get_ident())
+        with open(tmp, "wb") as outfd:
+            outfd.write(data)
+        os.replace(tmp, path)
+
+    def list_prefix(self, url, outputs=()):
+        """
+        listing of url. it is cached if it holds a completion marker (the files
+        the jobs write last). outputs built before the markers existed are
+        recognized by one of outputs (the names of their main files), and
+        their listing is only kept for LEGACY_LISTING_TTL seconds.
+        """
+        # listings cached before the markers were checked are ignored
+        path = self._path("list", url, "#marked")
+        legacy_path = self._path("list", url, "#legacy")
+        data = self._load(path)
+        if data is None and outputs:
+            data = self._load(legacy_path, ttl=LEGACY_LISTING_TTL)
+        if data is not None:
+            return json.loads(data.decode("utf-8"))
+        listing = list_prefix(url)
+        if listing_complete(listing):
+            self._store(path, json.dumps(listing, sort_keys=True).encode("utf-8"))
+        elif any(name in listing for name in outputs):
+            self._store(legacy_path, json.dumps(listing, sort_keys=True).encode("utf-8"))
+        return listing
+
+    def read_bytes(self, url, start=None, end=None):
+        suffix = "" if start is None else ":%d-%d" % (start, end)
+        path = self._path("blob", url, suffix)
+        data = self._load(path)
+        if data is not None:
+            return data
+        data = read_bytes(url, start, end)
+        self._store(path, data)
+        return data
+
+    def read_text(self, url):
+        return self.read_bytes(url).decode("utf-8")
+
+    def local_path(self, url):
+        """path of a local copy of the object at url. local paths are their own copy."""
+        if not url.startswith("s3://"):
+            return url
+        path = self._path("blob", url)
+        if self.refresh or not os.path.exists(path):
+            self._store(path, read_bytes(url))
+        return path
+
+    def map(self, func, items):
+        """apply func to all items concurrently. results are in the order of items."""
+        with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+            return list(executor.map(func, items))
+
+
+def presigned_url(url, expires=7*24*3600):
+    """
+    an https url which can be read without credentials (e.g. by htslib tools).
+    local paths are returned unchanged.
+    """
+    if not url.startswith("s3://"):
+        return url
+    bucket, key = split_s3_url(url)
+    return _s3_client().generate_presigned_url("get_object", Params={'Bucket': bucket, 'Key': key},
+                                               ExpiresIn=expires)
+
+
+def htslib_url(url, index_url):
+    """url of an indexed file, in the form htslib expects when the index is not at url + suffix"""
+    return "%s##idx##%s" % (presigned_url(url), presigned_url(index_url))
+
+
+class RangedReader(io.RawIOBase):
+    """
+    Sequential reader over an object, which keeps `parallel` ranged reads of
+    part_size bytes in flight ahead of the reader.
+    """
+    def __init__(self, url, size=None, part_size=64*1024*1024, parallel=8):
+        super().__init__()
+        self.url = url
+        self.size = object_size(url) if size is None else size
+        self.part_size = part_size
+        self._executor = ThreadPoolExecutor(max_workers=parallel)
+        self._parts = deque()
+        self._next_offset = 0
+        self._buf = memoryview(b"")
+        self.bytes_read = 0
+        for _ in range(parallel):
+            self._submit_next()
+
+    def _submit_next(self):
+        if self._next_offset >= self.size:
+            return
+        start, end = self._next_offset, min(self._next_offset + self.part_size, self.size)
+        self._parts.append(self._executor.submit(read_bytes, self.url, start, end))
+        self._next_offset = end
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not len(self._buf):
+            if not self._parts:
+                return 0
+            data = self._parts.popleft().result()
+            self._submit_next()
+            self._buf = memoryview(data)
+        n = min(len(b), len(self._buf))
+        b[:n] = self._buf[:n]
+        self._buf = self._buf[n:]
+        self.bytes_read += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for part in self._parts:
+                part.cancel()
+            self._executor.shutdown(wait=False)
+        super().close()
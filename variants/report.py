@@ -0,0 +1,337 @@
+"""
+Report on the outputs of previous builds.
+
+Loads one or more output tables, as printed by the driver:
+
+  SAMPLENAME  REFERENCE  OUTPUTURL  [COMPLETE]
+
+(e.g. greg59/greg59.merged.tsv), lists each output prefix and reads the
+bamstats and dupmetrics published there. Everything ends up in a single
+columnar frame, one row per output, over which the reports are computed.
+Listings of complete outputs and metrics files are kept in a local
+cache, so that repeated reports only list the outputs still being built.
+
+  python -m variants report greg59/greg59.merged.tsv marco160/marco160.gvcf.tsv
+  python -m variants report --by reference *.tsv
+  python -m variants report --missing gvcf --samples greg59=greg59/sample-names.tsv greg59/*.tsv
+"""
+
+import os.path
+import sys
+import argparse
+import logging
+from collections import OrderedDict
+
+import numpy as np
+
+from .metrics import parse_bamstats, parse_dupmetrics
+from .remote import RemoteCache, DEFAULT_CACHE_DIR
+
+log = logging.getLogger(__name__)
+
+# suffixes of the main output file of each kind of transform
+PRIMARY_OUTPUT = {
+    "align": (".bam", ".cram"),
+    "merge": (".bam", ".cram"),
+    "genotype": (".g.vcf.gz",),
+}
+
+# the kinds of transform which provide each type of output
+PROVIDERS = {
+    "bam": ("merge",),
+    "gvcf": ("genotype",),
+}
+
+FLOAT_COLUMNS = ("reads_total", "reads_mapped", "bases_mapped", "insert_size",
+                 "read_length", "dup_rate", "mapping_rate")
+SIZE_COLUMNS = ("total_bytes", "bam_bytes", "gvcf_bytes")
+
+
+class Frame(object):
+    """
+    A table stored column-wise, as equal length numpy arrays
+    """
+    def __init__(self, columns=None):
+        self.columns = OrderedDict(columns or ())
+        lengths = set(len(col) for col in self.columns.values())
+        if len(lengths) > 1:
+            raise ValueError("columns have different lengths: %s" % (sorted(lengths),))
+
+    @classmethod
+    def from_records(cls, records, dtypes):
+        """dtypes is an ordered list of (name, numpy dtype)"""
+        columns = OrderedDict()
+        for name, dtype in dtypes:
+            columns[name] = np.array([rec.get(name) for rec in records], dtype=dtype)
+        return cls(columns)
+
+    def __len__(self):
+        for col in self.columns.values():
+            return len(col)
+        return 0
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def filter(self, mask):
+        return Frame((name, col[mask]) for name, col in self.columns.items())
+
+    def concat(self, other):
+        if not len(self):
+            return other
+        return Frame((name, np.concatenate([col, other[name]])) for name, col in self.columns.items())
+
+    def key_codes(self, keys):
+        """
+        group rows by the values of columns keys. returns (codes, first) where codes
+        assigns a group number to each row, and first is the index of the first row
+        of each group.
+        """
+        combined = np.zeros(len(self), dtype=np.int64)
+        for key in keys:
+            _, inverse = np.unique(self[key], return_inverse=True)
+            combined = combined * (inverse.max() + 1 if len(inverse) else 1) + inverse
+        _, first, codes = np.unique(combined, return_index=True, return_inverse=True)
+        return codes, first
+
+    def groupby(self, keys, aggregates):
+        """
+        aggregates is a list of (output_name, function, column), function one of
+        count, sum, mean, min, max. NaNs are ignored by sum and mean.
+        """
+        codes, first = self.key_codes(keys)
+        ngroups = len(first)
+        out = OrderedDict((key, self[key][first]) for key in keys)
+        for outname, func, colname in aggregates:
+            if func == "count":
+                if colname is None:
+                    out[outname] = np.bincount(codes, minlength=ngroups)
+                else:
+                    out[outname] = np.bincount(codes, weights=self[colname].astype(np.float64),
+                                               minlength=ngroups).astype(np.int64)
+                continue
+            values = self[colname].astype(np.float64)
+            valid = ~np.isnan(values)
+            sums = np.bincount(codes[valid], weights=values[valid], minlength=ngroups)
+            if func == "sum":
+                out[outname] = sums
+            elif func == "mean":
+                counts = np.bincount(codes[valid], minlength=ngroups)
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    out[outname] = sums / counts
+            elif func in ("min", "max"):
+                init = np.inf if func == "min" else -np.inf
+                result = np.full(ngroups, init)
+                ufunc = np.minimum if func == "min" else np.maximum
+                ufunc.at(result, codes[valid], values[valid])
+                result[np.isinf(result)] = np.nan
+                out[outname] = result
+            else:
+                raise ValueError("unknown aggregate: %s" % (func,))
+        return Frame(out)
+
+    def sort(self, keys):
+        order = np.lexsort([self[key] for key in reversed(keys)])
+        return Frame((name, col[order]) for name, col in self.columns.items())
+
+    def write_tsv(self, outfd, float_format="%.4g"):
+        names = list(self.columns)
+        outfd.write("\t".join(name.upper() for name in names) + "\n")
+        for i in range(len(self)):
+            cells = []
+            for name in names:
+                val = self.columns[name][i]
+                if isinstance(val, (float, np.floating)):
+                    cells.append("" if np.isnan(val) else float_format % (val,))
+                else:
+                    cells.append(str(val))
+            outfd.write("\t".join(cells) + "\n")
+
+
+def output_kind(url):
+    """
+    the kind of transform which built an output prefix, e.g.
+    s3://bucket/build/merge.1-SAMPLE-sha1_abc/ => merge
+    """
+    base = os.path.basename(url.rstrip("/"))
+    return base.split(".", 1)[0] if "." in base else "unknown"
+
+
+def load_table(path, set_name=None):
+    """
+    read a SAMPLENAME REFERENCE URL table. the sample set defaults to the
+    name of the directory containing the table.
+    """
+    if set_name is None:
+        set_name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+    rows = []
+    with open(path, "r") as infd:
+        for lineno, line in enumerate(infd):
+            line = line.strip()
+            if not line or line.startswith("#") or line.startswith("SAMPLENAME"):
+                continue
+            toks = line.split("\t")
+            if len(toks) < 3:
+                raise ValueError("%s:%d: expected SAMPLENAME REFERENCE URL columns" % (path, lineno + 1))
+            rows.append({
+                "set": set_name,
+                "sample": toks[0],
+                "reference": toks[1],
+                "url": toks[2] if toks[2].endswith("/") else toks[2] + "/"
+            })
+    return rows
+
+
+def load_sample_names(path):
+    names = []
+    with open(path, "r") as infd:
+        for line in infd:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            names.append(line.split()[0])
+    return names
+
+
+def _describe_output(cache, row):
+    """fill in the columns of one output row from its listing and metrics files"""
+    sample, kind = row['sample'], output_kind(row['url'])
+    listing = cache.list_prefix(row['url'], [sample + suffix for suffix in PRIMARY_OUTPUT.get(kind, ())])
+    rec = dict(row)
+    rec['kind'] = kind
+    if kind in PRIMARY_OUTPUT:
+        rec['complete'] = any((sample + suffix) in listing for suffix in PRIMARY_OUTPUT[kind])
+    else:
+        rec['complete'] = bool(listing)
+    rec['total_bytes'] = float(sum(listing.values()))
+    rec['bam_bytes'] = float(listing.get(sample + ".bam", 0) or listing.get(sample + ".cram", 0))
+    rec['gvcf_bytes'] = float(listing.get(sample + ".g.vcf.gz", 0))
+
+    if sample + ".bamstats.txt" in listing:
+        stats = parse_bamstats(cache.read_text(row['url'] + sample + ".bamstats.txt"))
+        rec.update(stats)
+        if stats.get('reads_total'):
+            rec['mapping_rate'] = stats.get('reads_mapped', 0.0) / stats['reads_total']
+    if sample + ".dupmetrics.txt" in listing:
+        rec['dup_rate'] = parse_dupmetrics(cache.read_text(row['url'] + sample + ".dupmetrics.txt")).get('dup_rate')
+    return rec
+
+
+def load_outputs(tables, cache):
+    """
+    load all rows of tables (list of (set_name, path)) into a frame, one row per output
+    """
+    rows = []
+    for set_name, path in tables:
+        rows += load_table(path, set_name)
+    log.info("describing %d outputs...", len(rows))
+    records = cache.map(lambda row: _describe_output(cache, row), rows)
+
+    dtypes = [("set", str), ("sample", str), ("reference", str), ("kind", str), ("url", str),
+              ("complete", bool)]
+    dtypes += [(name, np.float64) for name in SIZE_COLUMNS + FLOAT_COLUMNS]
+    for rec in records:
+        for name in FLOAT_COLUMNS:
+            if rec.get(name) is None:
+                rec[name] = np.nan
+    return Frame.from_records(records, dtypes)
+
+
+def summary(frame, keys):
+    """per group counts, sizes and mean metrics"""
+    gib = 1024.0 ** 3
+    out = frame.groupby(keys, [
+        ("outputs", "count", None),
+        ("complete", "count", "complete"),
+        ("total_gib", "sum", "total_bytes"),
+        ("bam_gib", "sum", "bam_bytes"),
+        ("gvcf_gib", "sum", "gvcf_bytes"),
+        ("mean_mapping_rate", "mean", "mapping_rate"),
+        ("mean_dup_rate", "mean", "dup_rate"),
+        ("max_dup_rate", "max", "dup_rate"),
+    ])
+    for name in ("total_gib", "bam_gib", "gvcf_gib"):
+        out.columns[name] = out[name] / gib
+    return out.sort(keys)
+
+
+def missing(frame, output_type, expected_samples=None):
+    """
+    completeness join: (set, sample, reference) combinations that do not have
+    a complete output of output_type. The expected combinations are those found
+    in any table, plus the samples in expected_samples ({set: [names]}) for
+    every reference seen in that set.
+    """
+    expected = set(zip(frame['set'], frame['sample'], frame['reference']))
+    for set_name, names in (expected_samples or {}).items():
+        refs = set(frame['reference'][frame['set'] == set_name])
+        expected.update((set_name, name, ref) for name in names for ref in refs)
+
+    mask = np.isin(frame['kind'], PROVIDERS[output_type]) & frame['complete']
+    present = set(zip(frame['set'][mask], frame['sample'][mask], frame['reference'][mask]))
+
+    absent = sorted(expected - present)
+    return Frame(OrderedDict([
+        ("set", np.array([t[0] for t in absent], dtype=str)),
+        ("sample", np.array([t[1] for t in absent], dtype=str)),
+        ("reference", np.array([t[2] for t in absent], dtype=str)),
+    ]))
+
+
+def named_path(arg):
+    """parse NAME=PATH, or PATH (name is then the directory name)"""
+    if "=" in arg:
+        name, path = arg.split("=", 1)
+        return name, path
+    return None, arg
+
+
+def main(argv=None):
+    from . import setup_logging
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="python -m variants report", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("tables", metavar="[SET=]TABLE", nargs="+", type=named_path,
+                        help="output table. the sample set defaults to the directory name")
+    parser.add_argument("--by", metavar="COLS", type=str, default="set,reference,kind",
+                        help="comma-separated grouping columns for the summary (default: %(default)s)")
+    parser.add_argument("--missing", metavar="OUTPUT", choices=sorted(PROVIDERS), default=None,
+                        help="instead of the summary, list samples lacking this output (%s)" % (
+                            ", ".join(sorted(PROVIDERS)),))
+    parser.add_argument("--samples", metavar="SET=SAMPLENAMES", action="append", default=[],
+                        type=named_path,
+                        help="samples expected in a set, for --missing. may be repeated")
+    parser.add_argument("--dump", metavar="TSV", type=str, default=None,
+                        help="also write the full frame, one row per output, to this file")
+    parser.add_argument("--cache", metavar="DIR", type=str, default=DEFAULT_CACHE_DIR,
+                        help="local cache of listings and metrics (default: %(default)s)")
+    parser.add_argument("--refresh", action="store_true", default=False,
+                        help="ignore cached entries")
+    parser.add_argument("--jobs", metavar="N", type=int, default=32,
+                        help="concurrent requests (default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    cache = RemoteCache(args.cache, refresh=args.refresh, jobs=args.jobs)
+    frame = load_outputs(args.tables, cache)
+    log.info("loaded %d outputs. cache: %d hits, %d misses", len(frame), cache.hits, cache.misses)
+
+    if args.dump:
+        with open(args.dump, "w") as outfd:
+            frame.write_tsv(outfd)
+
+    if args.missing:
+        expected = {}
+        for set_name, path in args.samples:
+            if set_name is None:
+                set_name = os.path.basename(os.path.dirname(os.path.abspath(path)))
+            expected.setdefault(set_name, []).extend(load_sample_names(path))
+        missing(frame, args.missing, expected).write_tsv(sys.stdout)
+    else:
+        keys = [key.strip() for key in args.by.split(",") if key.strip()]
+        summary(frame, keys).write_tsv(sys.stdout)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
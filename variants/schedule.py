@@ -0,0 +1,505 @@
+"""
+Submission order and admission control for pipeline builds.
+
+The duration of each job is estimated from the size of its inputs (or of
+the inputs upstream of it, when they are not built yet). Targets are
+submitted in order of their critical path: the longest chain of jobs
+which must run before the target is built. With a hold-back fraction,
+targets whose chain is much shorter than the longest are built in a
+second round, so that short jobs don't take the vcpus the long chains
+need early on.
+
+The plan can be saved as a manifest (one job per line) and replayed by a
+simulator, which reports the projected makespan for a vcpu budget:
+
+  python -m variants samples.json --dry-run --plan-out plan.jsonl
+  python -m variants simulate plan.jsonl --maxvcpus 1024 --order critical
+
+The manifest also records the canonical id and output prefix of each job,
+which python -m variants monitor uses to follow the build.
+
+With --estimate, the driver prints the totals of the plan by stage and by
+reference instead of building. The rates of the stages can then come from
+the timings recorded by the jobs already built (--history).
+"""
+
+import sys
+import json
+import heapq
+import logging
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+GB = 1024.0 * 1024 * 1024
+
+# seconds per gb of input, and output bytes per input byte, by transform name.
+# rough figures for 32-vcpu alignments and the resources of each transform.
+RATES = {
+    "align": (2400, 1.1),
+    "alignchunk": (2400, 1.1),
+    "multialign": (3000, 1.1),
+    "splitreads": (240, 1.0),
+    "merge": (1200, 1.0),
+    "genotype": (2400, 0.05),
+    "depth": (120, 0.001),
+}
+
+# trivial merges only rewrite headers and checksum
+TRIVIAL_MERGE_RATE = 300
+
+# vcpus of the first attempt, when the transform can't tell before its inputs exist
+DEFAULT_VCPUS = {
+    "align": 32,
+    "alignchunk": 32,
+    "multialign": 64,
+    "splitreads": 8,
+    "merge": 8,
+    "genotype": 28,
+    "depth": 8,
+    "genomicsdb": 8,
+    "jointgenotype": 2,
+    "gathervcfs": 4,
+    "pack": 32,
+}
+
+# memory (mb) of the first attempt, when the transform can't tell
+DEFAULT_MEMORY = {
+    "align": 120000,
+    "alignchunk": 120000,
+    "multialign": 240000,
+    "splitreads": 8192,
+    "merge": 16000,
+    "genotype": 156 * 1024,
+    "depth": 8000,
+    "genomicsdb": 32 * 1024,
+}
+
+# jobs of unknown size
+DEFAULT_SECONDS = 3600
+MIN_SECONDS = 600
+
+
+class Job(object):
+    """one node of the plan"""
+    __slots__ = ("id", "kind", "seconds", "vcpus", "deps", "label", "memory", "bytes_in", "bytes_out", "ref",
+                 "cid", "prefix")
+
+    def __init__(self, id, kind, seconds, vcpus, deps, label="", memory=0, bytes_in=0, bytes_out=0, ref="",
+                 cid="", prefix=""):
+        self.id = id
+        self.kind = kind
+        self.seconds = float(seconds)
+        self.vcpus = int(vcpus)
+        self.deps = list(deps)
+        self.label = label
+        self.memory = int(memory)
+        self.bytes_in = float(bytes_in)
+        self.bytes_out = float(bytes_out)
+        self.ref = ref
+        self.cid = cid
+        self.prefix = prefix
+
+    def to_dict(self):
+        return {"id": self.id, "kind": self.kind, "seconds": self.seconds, "vcpus": self.vcpus,
+                "deps": self.deps, "label": self.label, "memory": self.memory,
+                "bytes_in": self.bytes_in, "bytes_out": self.bytes_out, "ref": self.ref,
+                "cid": self.cid, "prefix": self.prefix}
+
+    @classmethod
+    def from_dict(cls, doc):
+        return cls(doc['id'], doc['kind'], doc['seconds'], doc['vcpus'], doc['deps'], doc.get('label', ""),
+                   memory=doc.get('memory', 0), bytes_in=doc.get('bytes_in', 0),
+                   bytes_out=doc.get('bytes_out', 0), ref=doc.get('ref', ""),
+                   cid=doc.get('cid', ""), prefix=doc.get('prefix', ""))
+
+
+def _dependencies(node):
+    import bunnies
+    return [inputval.node for inputval in node.inputs.values()
+            if isinstance(inputval.node, bunnies.Transform)]
+
+
+def _file_inputs(node):
+    import bunnies
+    return [inputval.node for inputval in node.inputs.values()
+            if not isinstance(inputval.node, bunnies.Transform)]
+
+
+def _task_resources(node):
+    """resources of the first attempt of node, or {} when its inputs can't tell"""
+    try:
+        return node.task_resources(attempt=1)
+    except Exception:
+        return {}
+
+
+def _output_bytes(node):
+    """size of the main output of a built node, and the url of its timings"""
+    output = node.ls()
+    timings = output.get('timings', {}).get('url') if isinstance(output.get('timings'), dict) else None
+    for key in ("bam", "gvcf", "vcf", "workspace"):
+        if isinstance(output.get(key), dict):
+            return output[key].get('size') or 0, timings
+    if 'chunks' in output:
+        return sum(chunk['r1']['size'] + (chunk['r2']['size'] if chunk['r2'] else 0)
+                   for chunk in output['chunks']), timings
+    return 0, timings
+
+
+def historical_rates(samples, min_samples=3):
+    """
+    {transform name: seconds per gb of input}, the median over
+    samples=[(name, input bytes, wall seconds)] of built jobs
+    """
+    import numpy as np
+    by_name = {}
+    for name, in_bytes, wall in samples:
+        if in_bytes > 0 and wall > 0:
+            by_name.setdefault(name, []).append(wall / (in_bytes / GB))
+    return {name: float(np.median(rates)) for name, rates in by_name.items() if len(rates) >= min_samples}
+
+
+def plan(targets, jobs=32, refname_of=None, history=None):
+    """
+    estimate the jobs needed to build targets. built nodes are not jobs.
+    history (a RemoteCache) enables rates measured from the timings of
+    the built nodes, when there are enough of them.
+    returns (list of Job in dependency order, {id(target node): job id})
+    """
+    nodes = []
+    seen = set()
+
+    def _walk(node):
+        if id(node) in seen:
+            return
+        seen.add(id(node))
+        for dep in _dependencies(node):
+            _walk(dep)
+        nodes.append(node)
+
+    for target in targets:
+        _walk(target)
+
+    # all the remote lookups, concurrently
+    files = {}
+    for node in nodes:
+        for infile in _file_inputs(node):
+            files[id(infile)] = infile
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        built = dict(zip([id(node) for node in nodes], executor.map(lambda node: bool(node.exists()), nodes)))
+        file_bytes = dict(zip(files, executor.map(lambda infile: infile.ls().get('size') or 0, files.values())))
+        built_nodes = [node for node in nodes if built[id(node)]]
+        built_outputs = dict(zip([id(node) for node in built_nodes], executor.map(_output_bytes, built_nodes)))
+        # the resources of the nodes which can start, which list their inputs
+        startable = [node for node in nodes
+                     if not built[id(node)] and all(built[id(dep)] for dep in _dependencies(node))]
+        node_resources = dict(zip([id(node) for node in startable], executor.map(_task_resources, startable)))
+    log.info("planning %d nodes (%d built, %d input files)", len(nodes), len(built_nodes), len(files))
+
+    in_bytes = {}
+    out_bytes = {}
+    for node in nodes:
+        deps = _dependencies(node)
+        in_bytes[id(node)] = sum(file_bytes[id(infile)] for infile in _file_inputs(node)) + \
+            sum(out_bytes[id(dep)] for dep in deps)
+        if node.name == "alignchunk" and not in_bytes[id(node)]:
+            in_bytes[id(node)] = (out_bytes.get(id(node.split)) or 0) / node.split.params['num_chunks']
+        if built[id(node)]:
+            out_bytes[id(node)] = built_outputs[id(node)][0]
+        else:
+            out_bytes[id(node)] = in_bytes[id(node)] * RATES.get(node.name, (None, 1.0))[1]
+
+    rates = {name: rate for name, (rate, _) in RATES.items()}
+    if history is not None:
+        timed = [node for node in built_nodes if built_outputs[id(node)][1]]
+
+        def _wall(node):
+            try:
+                return json.loads(history.read_text(built_outputs[id(node)][1]))['wall_s']
+            except Exception as exc:
+                log.warning("unreadable timings for %s: %s", node.output_prefix(), exc)
+                return 0.0
+        walls = history.map(_wall, timed)
+        measured = historical_rates([(node.name, in_bytes[id(node)], wall) for node, wall in zip(timed, walls)])
+        for name, rate in sorted(measured.items()):
+            log.info("historical rate of %s: %.0fs per gb (default %s)", name, rate, rates.get(name))
+        rates.update(measured)
+
+    job_ids = {}
+    plan_jobs = []
+    for node in nodes:
+        if built[id(node)]:
+            continue
+        deps = _dependencies(node)
+        node_in = in_bytes[id(node)]
+        seconds_per_gb = rates.get(node.name)
+        if node.name == "merge" and node.params['num_bams'] <= 1:
+            seconds_per_gb = TRIVIAL_MERGE_RATE
+        if seconds_per_gb is None or not node_in:
+            seconds = DEFAULT_SECONDS
+        else:
+            seconds = max(node_in / GB * seconds_per_gb, MIN_SECONDS)
+
+        resources = node_resources.get(id(node), {})
+        ref = getattr(node, "ref", None)
+        job_ids[id(node)] = len(plan_jobs)
+        plan_jobs.append(Job(len(plan_jobs), node.name, seconds,
+                             resources.get('vcpus') or DEFAULT_VCPUS.get(node.name, 4),
+                             [job_ids[id(dep)] for dep in deps if id(dep) in job_ids],
+                             label=getattr(node, "sample_name", ""),
+                             memory=resources.get('memory') or DEFAULT_MEMORY.get(node.name, 8192),
+                             bytes_in=node_in, bytes_out=out_bytes[id(node)],
+                             ref=(refname_of(ref) if refname_of and ref is not None else ""),
+                             cid=node.canonical_id, prefix=node.output_prefix()))
+    return plan_jobs, job_ids
+
+
+def estimate(jobs, max_vcpus, rounds=None):
+    """
+    totals of the plan by stage and by reference, and the simulated makespan.
+    returns (rows, simulation). each row is (group, key, totals dict)
+    """
+    groups = {}
+    for job in jobs:
+        for group, key in (("stage", job.kind), ("reference", job.ref or "-"), ("total", "all")):
+            totals = groups.setdefault((group, key), {
+                "jobs": 0, "vcpu_hours": 0.0, "memory_gb_hours": 0.0, "gb_in": 0.0, "gb_out": 0.0,
+                "job_hours": 0.0})
+            hours = job.seconds / 3600.0
+            totals["jobs"] += 1
+            totals["job_hours"] += hours
+            totals["vcpu_hours"] += job.vcpus * hours
+            totals["memory_gb_hours"] += job.memory / 1024.0 * hours
+            totals["gb_in"] += job.bytes_in / GB
+            totals["gb_out"] += job.bytes_out / GB
+    order = {"stage": 0, "reference": 1, "total": 2}
+    rows = [(group, key, totals) for (group, key), totals in
+            sorted(groups.items(), key=lambda item: (order[item[0][0]], item[0][1]))]
+    return rows, simulate(jobs, max_vcpus, order="critical", rounds=rounds)
+
+
+def format_estimate(rows, simulation, max_vcpus):
+    columns = ("jobs", "job_hours", "vcpu_hours", "memory_gb_hours", "gb_in", "gb_out")
+    lines = ["\t".join(["GROUP", "KEY"] + [col.upper() for col in columns])]
+    for group, key, totals in rows:
+        lines.append("\t".join([group, key] + ["%d" % totals[col] if col == "jobs" else "%.1f" % totals[col]
+                                               for col in columns]))
+    lines.append("# makespan with %d vcpus: %.1fh (%.1f%% utilization)" % (
+        max_vcpus, simulation['makespan'] / 3600.0, 100.0 * simulation['utilization']))
+    return "\n".join(lines)
+
+
+def chain_lengths(jobs):
+    """{job id: seconds of the longest chain of jobs ending with that job}"""
+    lengths = {}
+    for job in jobs:
+        lengths[job.id] = job.seconds + max([lengths[dep] for dep in job.deps] or [0.0])
+    return lengths
+
+
+def upward_ranks(jobs):
+    """{job id: seconds of the longest chain of jobs starting with that job}"""
+    dependents = {}
+    for job in jobs:
+        for dep in job.deps:
+            dependents.setdefault(dep, []).append(job.id)
+    ranks = {}
+    for job in reversed(jobs):
+        ranks[job.id] = job.seconds + max([ranks[child] for child in dependents.get(job.id, ())] or [0.0])
+    return ranks
+
+
+def order_targets(targets, target_ids, jobs, affinity_band=0.0):
+    """
+    targets sorted by decreasing critical path. built targets go last.
+
+    affinity_band=targets whose critical paths are within this fraction of
+    the longest of each other are grouped by reference, in the order the
+    references first appear. jobs submitted together then share their
+    reference, and land on hosts which have it cached already.
+    """
+    lengths = chain_lengths(jobs)
+    refs = dict((job.id, job.ref) for job in jobs)
+    ordered = sorted(targets, key=lambda target: -lengths.get(target_ids.get(id(target)), 0.0))
+    if affinity_band <= 0 or not ordered:
+        return ordered
+
+    band = affinity_band * lengths.get(target_ids.get(id(ordered[0])), 0.0)
+    grouped, start = [], 0
+    while start < len(ordered):
+        head = lengths.get(target_ids.get(id(ordered[start])), 0.0)
+        end = start
+        while end < len(ordered) and lengths.get(target_ids.get(id(ordered[end])), 0.0) >= head - band:
+            end += 1
+        end = max(end, start + 1)
+        members = ordered[start:end]
+        first_seen = {}
+        for target in members:
+            first_seen.setdefault(refs.get(target_ids.get(id(target)), ""), len(first_seen))
+        grouped += sorted(members, key=lambda target: first_seen[refs.get(target_ids.get(id(target)), "")])
+        start = end
+    return grouped
+
+
+def hold_back(targets, target_ids, jobs, fraction):
+    """
+    split the ordered targets in (first, held): targets whose critical path
+    is shorter than fraction * the longest are held for a second round.
+    """
+    lengths = chain_lengths(jobs)
+    longest = max([lengths.get(target_ids.get(id(target)), 0.0) for target in targets] or [0.0])
+    first, held = [], []
+    for target in targets:
+        length = lengths.get(target_ids.get(id(target)), 0.0)
+        (first if length >= fraction * longest else held).append(target)
+    return first, held
+
+
+def simulate(jobs, max_vcpus, order="critical", rounds=None):
+    """
+    list scheduling of jobs on a pool of max_vcpus. ready jobs start in
+    priority order when enough vcpus are free. order is "critical"
+    (longest remaining chain first) or "fifo" (plan order).
+    rounds={job id: round}: jobs of a round don't start before all the
+    jobs of the earlier rounds are done.
+    returns {"makespan", "starts": {id: t}, "ends": {id: t}, "utilization"}
+    """
+    ranks = upward_ranks(jobs) if order == "critical" else {job.id: -job.id for job in jobs}
+    rounds = rounds or {}
+    by_id = {job.id: job for job in jobs}
+    waiting = {job.id: len(job.deps) for job in jobs}
+    dependents = {}
+    for job in jobs:
+        for dep in job.deps:
+            dependents.setdefault(dep, []).append(job.id)
+    left_in_round = {}
+    for job in jobs:
+        left_in_round[rounds.get(job.id, 0)] = left_in_round.get(rounds.get(job.id, 0), 0) + 1
+
+    def _current_round():
+        return min([r for r, left in left_in_round.items() if left] or [0])
+
+    ready = [(-ranks[job.id], job.id) for job in jobs if not job.deps]
+    heapq.heapify(ready)
+    running = []  # (end, job id)
+    now, free = 0.0, max_vcpus
+    starts, ends = {}, {}
+    busy = 0.0
+
+    while ready or running:
+        deferred = []
+        while ready:
+            prio, job_id = heapq.heappop(ready)
+            job = by_id[job_id]
+            vcpus = min(job.vcpus, max_vcpus)
+            if rounds.get(job_id, 0) > _current_round() or vcpus > free:
+                deferred.append((prio, job_id))
+                continue
+            free -= vcpus
+            starts[job_id] = now
+            busy += vcpus * job.seconds
+            heapq.heappush(running, (now + job.seconds, job_id))
+        for item in deferred:
+            heapq.heappush(ready, item)
+        if not running:
+            raise Exception("jobs can't be scheduled: %d ready, none fit" % (len(ready),))
+        now, job_id = heapq.heappop(running)
+        ends[job_id] = now
+        free += min(by_id[job_id].vcpus, max_vcpus)
+        left_in_round[rounds.get(job_id, 0)] -= 1
+        for child in dependents.get(job_id, ()):
+            waiting[child] -= 1
+            if not waiting[child]:
+                heapq.heappush(ready, (-ranks[child], child))
+
+    makespan = max(ends.values()) if ends else 0.0
+    return {
+        "makespan": makespan,
+        "starts": starts,
+        "ends": ends,
+        "utilization": busy / (makespan * max_vcpus) if makespan else 0.0
+    }
+
+
+def write_manifest(jobs, path, rounds=None):
+    with open(path, "w") as outfd:
+        for job in jobs:
+            doc = job.to_dict()
+            if rounds:
+                doc['round'] = rounds.get(job.id, 0)
+            outfd.write(json.dumps(doc, sort_keys=True) + "\n")
+
+
+def read_manifest(path):
+    """returns (jobs, rounds)"""
+    jobs, rounds = [], {}
+    with open(path, "r") as infd:
+        for line in infd:
+            if not line.strip():
+                continue
+            doc = json.loads(line)
+            jobs.append(Job.from_dict(doc))
+            rounds[doc['id']] = doc.get('round', 0)
+    return jobs, rounds
+
+
+def job_rounds(jobs, round_targets):
+    """
+    {job id: round}, given the job ids of the targets of each round. a job
+    shared by several rounds belongs to the earliest.
+    """
+    by_id = {job.id: job for job in jobs}
+    rounds = {}
+    for round_i, target_ids in enumerate(round_targets):
+        stack = list(target_ids)
+        while stack:
+            job_id = stack.pop()
+            if job_id in rounds:
+                continue
+            rounds[job_id] = round_i
+            stack.extend(by_id[job_id].deps)
+    return rounds
+
+
+def _hours(seconds):
+    return "%.1fh" % (seconds / 3600.0,)
+
+
+def main(argv=None):
+    from . import setup_logging
+    setup_logging(logging.INFO)
+
+    parser = argparse.ArgumentParser(prog="python -m variants simulate", description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("manifest", metavar="PLAN", type=str,
+                        help="plan written with python -m variants --plan-out")
+    parser.add_argument("--maxvcpus", metavar="VCPUS", type=int, action="append", default=[],
+                        dest="max_vcpus", help="vcpu budget. repeat to compare budgets (default: 1024)")
+    parser.add_argument("--order", choices=("critical", "fifo", "both"), default="both",
+                        help="priority of ready jobs (default: %(default)s)")
+    parser.add_argument("--ignore-rounds", action="store_true", default=False,
+                        help="ignore the held back rounds recorded in the plan")
+    args = parser.parse_args(argv)
+
+    jobs, rounds = read_manifest(args.manifest)
+    if args.ignore_rounds:
+        rounds = {}
+    lengths = chain_lengths(jobs)
+    print("%d jobs, %s of work, longest chain %s" % (
+        len(jobs), _hours(sum(job.seconds * job.vcpus for job in jobs)) + " x vcpu",
+        _hours(max(lengths.values() or [0.0]))))
+
+    orders = ("critical", "fifo") if args.order == "both" else (args.order,)
+    print("\t".join(["VCPUS", "ORDER", "MAKESPAN", "UTILIZATION"]))
+    for max_vcpus in args.max_vcpus or [1024]:
+        for order in orders:
+            result = simulate(jobs, max_vcpus, order=order, rounds=rounds)
+            print("\t".join([str(max_vcpus), order, _hours(result['makespan']),
+                             "%.1f%%" % (100.0 * result['utilization'],)]))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import bunnies
+import bunnies.unmarshall
+import logging
+import itertools
+import math
+
+from .constants import KIND_PREFIX, SAMPLE_NAME_RE
+
+log = logging.getLogger(__name__)
+
+# reads are dealt to the chunks round-robin, in blocks of this many reads
+# (or pairs), so that all chunks get the same number of reads +/- one block.
+BLOCK_READS = 100000
+
+# default amount of (compressed) input per chunk
+DEFAULT_CHUNK_BYTES = 8 * 1024 * 1024 * 1024
+
+# spots of an sra looked at to tell paired runs from single-end ones
+LAYOUT_SPOTS = 10000
+
+
+def num_chunks_for_size(input_bytes, chunk_bytes=DEFAULT_CHUNK_BYTES):
+    """number of chunks to cut a run of input_bytes into"""
+    if chunk_bytes <= 0:
+        return 1
+    return max(1, int(math.ceil(float(input_bytes) / chunk_bytes)))
+
+
+def _fastq_records(lines):
+    """group an iterator of fastq lines in 4-line records"""
+    while True:
+        record = [next(lines, None) for _ in range(4)]
+        if record[0] is None:
+            return
+        if record[3] is None:
+            raise Exception("truncated fastq record: %r" % (record[0],))
+        yield b"".join(record)
+
+
+def _pair_mates(r1_records, r2_records):
+    """zip the records of two mate files, which must have the same number of reads"""
+    for rec1, rec2 in itertools.zip_longest(r1_records, r2_records):
+        if rec1 is None or rec2 is None:
+            raise Exception("mate files have different numbers of reads")
+        yield rec1, rec2
+
+
+def _deinterleave(records):
+    """
+    pair up the records of fastq-dump --split-spot --readids output, in which
+    the mates of a spot are named NAME.1 and NAME.2. yields (r1, r2 or None)
+    """
+    pending = None
+    for record in records:
+        name = record.split(None, 1)[0]
+        if pending is not None:
+            pending_name = pending.split(None, 1)[0]
+            if pending_name.endswith(b".1") and name.endswith(b".2") and pending_name[:-2] == name[:-2]:
+                yield pending, record
+                pending = None
+                continue
+            yield pending, None
+        pending = record
+    if pending is not None:
+        yield pending, None
+
+
+def _mate_record(record):
+    """
+    a record of fastq-dump --readids, named like its mate. the .1/.2 suffix
+    is dropped from the name and the name is not repeated on the + line.
+    """
+    header, seq, _, qual = record.split(b"\n", 3)
+    fields = header.split(None, 1)
+    if fields[0][-2:] in (b".1", b".2"):
+        fields[0] = fields[0][:-2]
+    return b" ".join(fields) + b"\n" + seq + b"\n+\n" + qual
+
+
+def _mate_pairs(spots, layout_spots=LAYOUT_SPOTS):
+    """
+    (r1, r2 or None) of the spots of _deinterleave, with the mates named
+    alike, so that the mate files stay in lock-step: the run is paired if
+    any of its first layout_spots spots is, and spots with a single read are
+    dropped from paired runs. single-end runs keep only the first read.
+    """
+    head = list(itertools.islice(spots, layout_spots))
+    paired = any(rec2 is not None for _, rec2 in head)
+    dropped = 0
+    for rec1, rec2 in itertools.chain(head, spots):
+        if paired and rec2 is None:
+            dropped += 1
+            continue
+        if not paired and rec2 is not None:
+            dropped += 1
+            rec2 = None
+        yield _mate_record(rec1), _mate_record(rec2) if rec2 is not None else None
+    if dropped:
+        log.warning("%d reads without a mate dropped from a %s run", dropped,
+                    "paired" if paired else "single-end")
+
+
+class SplitReads(bunnies.Transform):
+    """
+    Split the reads of a sequencing run (paired fastq or sra) into chunks
+    of the same number of reads, which can be aligned in parallel.
+    """
+    SPLIT_IMAGE = "rieseberglab/analytics:7-2.5.8"
+    VERSION = "1"
+
+    __slots__ = ("sample_name", "r1", "r2")
+    kind = KIND_PREFIX + "SplitReads"
+
+    def __init__(self, sample_name=None, r1=None, r2=None, num_chunks=None, manifest=None):
+        super().__init__("splitreads", version=self.VERSION, image=self.SPLIT_IMAGE, manifest=manifest)
+
+        if manifest is not None:
+            inputs, params = manifest['inputs'], manifest['params']
+            r1 = inputs['r1'].node
+            r2 = inputs['r2'].node if 'r2' in inputs else None
+            sample_name = params['sample_name']
+            num_chunks = params['num_chunks']
+
+        if None in (sample_name, r1, num_chunks):
+            raise Exception("invalid parameters for read splitting")
+
+        if not SAMPLE_NAME_RE.match(sample_name):
+            raise ValueError("sample name %r does not match %s" % (
+                sample_name, SAMPLE_NAME_RE.pattern))
+
+        if num_chunks < 2:
+            raise ValueError("splitting requires 2 chunks or more")
+
+        self.sample_name = sample_name
+        self.r1 = r1
+        self.r2 = r2
+
+        self.add_input("r1", r1, desc="forward reads")
+        if r2:
+            self.add_input("r2", r2, desc="reverse reads")
+
+        self.params["sample_name"] = sample_name
+        self.params["num_chunks"] = int(num_chunks)
+
+    @classmethod
+    def task_template(cls, compute_env):
+        scratchdisk = compute_env.get_disk('scratch') or compute_env.get_disk('localscratch')
+        if not scratchdisk:
+            raise Exception("SplitReads tasks require a scratch disk")
+
+        return {
+            'jobtype': 'batch',
+            'image': cls.SPLIT_IMAGE
+        }
+
+    def task_resources(self, attempt=1, **kwargs):
+        input_size = self.r1.ls()['size'] + (self.r2.ls()['size'] if self.r2 else 0)
+        gbs = float(input_size) / (1024*1024*1024)
+
+        # decompress, deal and recompress. 4 min per gb of fastq input. an sra
+        # is fetched whole, then decoded by a single fastq-dump: 15 min per gb.
+        # (min 1h)
+        seconds_per_gb = 4*60 if self.r2 else 15*60
+        return {
+            'vcpus': 8,
+            'memory': 8 * 1024,
+            'timeout': max(int(gbs*seconds_per_gb), 3600) * attempt
+        }
+
+    def run(self, resources=None, **params):
+        """ this runs in the image """
+        import os
+        import os.path
+        import io
+        import gzip
+        import shutil
+        import hashlib
+        import subprocess
+        from .remote import RangedReader
+
+        workdir = params['workdir']
+        s3_output_prefix = self.output_prefix()
+        local_output_dir = os.path.join(workdir, "output")
+        os.makedirs(local_output_dir, exist_ok=True)
+
+        num_chunks = self.params['num_chunks']
+        r1_target = self.r1.ls()
+        r2_target = self.r2.ls() if self.r2 else None
+        compressor = ["pigz", "-p", "2", "-c"] if shutil.which("pigz") else ["gzip", "-1", "-c"]
+
+        def _open_fastq(target):
+            reader = RangedReader(target['url'], size=target.get('size'))
+            return io.BufferedReader(gzip.GzipFile(fileobj=io.BufferedReader(reader, 4*1024*1024)),
+                                     4*1024*1024)
+
+        if r2_target is not None:
+            # paired fastqs: read both mates in lock-step
+            r1_records = _fastq_records(iter(_open_fastq(r1_target)))
+            r2_records = _fastq_records(iter(_open_fastq(r2_target)))
+            pairs = _pair_mates(r1_records, r2_records)
+            sra_process = None
+        else:
+            # sra: fetch it with ranged reads, then decode it to interleaved fastq.
+            # fastq-dump needs random access to the whole file, so it can't
+            # decode while the fetch streams in. the mates are dealt to the
+            # chunks here rather than by fastq-dump --split-files, so that
+            # both mates of a pair land in the same chunk, in lock-step.
+            sra_path = os.path.join(workdir, os.path.basename(r1_target['url']))
+            with open(sra_path, "wb") as sra_fd:
+                shutil.copyfileobj(RangedReader(r1_target['url'], size=r1_target.get('size')), sra_fd,
+                                   16*1024*1024)
+            sra_process = subprocess.Popen(["fastq-dump", "--split-spot", "--readids", "--skip-technical",
+                                            "--stdout", sra_path], stdout=subprocess.PIPE, cwd=workdir)
+            pairs = _mate_pairs(_deinterleave(_fastq_records(iter(sra_process.stdout))))
+
+        def _chunk_path(chunki, mate):
+            return os.path.join(local_output_dir, "%s.chunk%04d_R%d.fastq.gz" % (self.sample_name, chunki, mate))
+
+        writers = {}
+
+        def _writer(chunki, mate):
+            if (chunki, mate) not in writers:
+                out_fd = open(_chunk_path(chunki, mate), "wb")
+                writers[(chunki, mate)] = (subprocess.Popen(compressor, stdin=subprocess.PIPE, stdout=out_fd),
+                                           out_fd)
+            return writers[(chunki, mate)][0].stdin
+
+        counts = [0] * num_chunks
+        for i, (rec1, rec2) in enumerate(pairs):
+            chunki = (i // BLOCK_READS) % num_chunks
+            _writer(chunki, 1).write(rec1)
+            if rec2 is not None:
+                _writer(chunki, 2).write(rec2)
+            counts[chunki] += 1
+
+        if sra_process is not None:
+            if sra_process.wait() != 0:
+                raise Exception("fastq-dump failed with code %d" % (sra_process.returncode,))
+            os.unlink(sra_path)
+
+        for proc, out_fd in writers.values():
+            proc.stdin.close()
+            if proc.wait() != 0:
+                raise Exception("compressor failed with code %d" % (proc.returncode,))
+            out_fd.close()
+
+        log.info("split %d reads of %s into %d chunks: %s", sum(counts), self.sample_name, num_chunks, counts)
+
+        def _upload(path):
+            md5 = hashlib.md5()
+            with open(path, "rb") as chunk_fd:
+                for block in iter(lambda: chunk_fd.read(4*1024*1024), b""):
+                    md5.update(block)
+            output_url = os.path.join(s3_output_prefix, os.path.basename(path))
+            bunnies.transfers.s3_upload_file(path, output_url)
+            return {"url": output_url, "size": os.stat(path).st_size, "digests": {"md5": md5.hexdigest()}}
+
+        chunks = []
+        for chunki in range(num_chunks):
+            if not counts[chunki]:
+                raise Exception("chunk %d of %s is empty. too many chunks for the input." % (
+                    chunki, self.sample_name))
+            chunks.append({
+                "r1": _upload(_chunk_path(chunki, 1)),
+                "r2": _upload(_chunk_path(chunki, 2)) if (chunki, 2) in writers else None,
+                "reads": counts[chunki]
+            })
+
+        return {"chunks": chunks, "num_reads": sum(counts)}
+
+    def output_prefix(self, write_url=None):
+        return "%(repo)s%(name)s.%(version)s-%(sample_name)s-%(cid)s/" % {
+            'repo': self.repo_path(write_url=write_url),
+            'name': self.name,
+            'version': self.version,
+            'sample_name': self.params['sample_name'],
+            'cid': self.canonical_id
+        }
+
+
+bunnies.unmarshall.register_kind(SplitReads)
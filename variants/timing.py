@@ -0,0 +1,138 @@
+"""
+Per-phase timings of the jobs.
+
+    timings = Timings("align", sample_name)
+    with timings.span("reference") as span:
+        ...
+        span.add_bytes(size)
+    timings.write(path)
+
+Each span records its wall time, the cpu time of the job and of the
+tools it waited on, the bytes it moved (as reported by the caller), and
+the peak rss seen so far. Cpu and rss are process-wide: spans which run
+concurrently in threads see each other's usage.
+"""
+
+import os
+import json
+import time
+import resource
+import threading
+import contextlib
+
+TIMINGS_VERSION = 1
+
+
+def _cpu_seconds():
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return (self_usage.ru_utime + self_usage.ru_stime,
+            children.ru_utime + children.ru_stime)
+
+
+def _peak_rss_mb():
+    # ru_maxrss is in KiB on linux. children is the largest waited-for process.
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return max(self_usage.ru_maxrss, children.ru_maxrss) / 1024.0
+
+
+class Span(object):
+    __slots__ = ("phase", "attrs", "start", "wall", "cpu_self", "cpu_children", "bytes",
+                 "peak_rss_mb", "error", "_cpu0")
+
+    def __init__(self, phase, attrs):
+        self.phase = phase
+        self.attrs = attrs
+        self.start = time.time()
+        self.wall = None
+        self.cpu_self = None
+        self.cpu_children = None
+        self.bytes = 0
+        self.peak_rss_mb = None
+        self.error = None
+        self._cpu0 = _cpu_seconds()
+
+    def add_bytes(self, nbytes):
+        self.bytes += int(nbytes or 0)
+
+    def add_file(self, path):
+        """count the size of a file moved during the span"""
+        self.add_bytes(os.stat(path).st_size)
+
+    def finish(self, error=None):
+        cpu_self, cpu_children = _cpu_seconds()
+        self.wall = time.time() - self.start
+        self.cpu_self = cpu_self - self._cpu0[0]
+        self.cpu_children = cpu_children - self._cpu0[1]
+        self.peak_rss_mb = _peak_rss_mb()
+        self.error = error
+
+    def to_dict(self):
+        doc = {
+            "phase": self.phase,
+            "start": self.start,
+            "wall_s": self.wall,
+            "cpu_s": self.cpu_self,
+            "children_cpu_s": self.cpu_children,
+            "bytes": self.bytes,
+            "mb_per_s": (self.bytes / 1048576.0 / self.wall) if self.bytes and self.wall else None,
+            "peak_rss_mb": self.peak_rss_mb,
+        }
+        if self.attrs:
+            doc["attrs"] = self.attrs
+        if self.error:
+            doc["error"] = self.error
+        return doc
+
+
+class Timings(object):
+    """
+    the spans of one job, in the order they started
+    """
+    def __init__(self, transform, sample_name, **attrs):
+        self.transform = transform
+        self.sample_name = sample_name
+        self.attrs = attrs
+        self.start = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, phase, **attrs):
+        span = Span(phase, attrs)
+        with self._lock:
+            self.spans.append(span)
+        try:
+            yield span
+        except BaseException as exc:
+            span.finish(error="%s: %s" % (type(exc).__name__, exc))
+            raise
+        span.finish()
+
+    def summary(self):
+        """{phase: total wall seconds}, over all the spans of each phase"""
+        totals = {}
+        for span in self.spans:
+            if span.wall is not None:
+                totals[span.phase] = totals.get(span.phase, 0.0) + span.wall
+        return totals
+
+    def to_dict(self):
+        return {
+            "version": TIMINGS_VERSION,
+            "transform": self.transform,
+            "sample_name": self.sample_name,
+            "attrs": self.attrs,
+            "start": self.start,
+            "wall_s": time.time() - self.start,
+            "peak_rss_mb": _peak_rss_mb(),
+            "phases": self.summary(),
+            "spans": [span.to_dict() for span in self.spans],
+        }
+
+    def write(self, path):
+        with open(path, "w") as outfd:
+            json.dump(self.to_dict(), outfd, indent=1, sort_keys=True)
+            outfd.write("\n")
+        return path